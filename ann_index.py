@@ -0,0 +1,200 @@
+"""
+Approximate nearest-neighbour search for large embedding galleries.
+
+The default backend is an inverted-file (IVF) index in pure NumPy: rows are
+grouped under spherical k-means centroids and a query only scores the rows
+of its `nprobe` closest lists. When `hnswlib` is installed, ANN_BACKEND=hnsw
+uses an HNSW graph instead. `nprobe` (IVF) and `ef` (HNSW) trade recall for
+latency. Indexes are built at training time and stored next to the gallery
+as <name>.ann; galleries smaller than ANN_MIN_GALLERY_SIZE are searched
+exactly.
+"""
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # optional backend
+    hnswlib = None
+
+ANN_SUFFIX = ".ann"
+ANN_BACKEND = os.environ.get("ANN_BACKEND", "ivf").lower()
+# Galleries with fewer rows than this are matched by exact search
+ANN_MIN_GALLERY_SIZE = int(os.environ.get("ANN_MIN_GALLERY_SIZE", 10000))
+# Lists probed per query (IVF); higher is slower with better recall
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 8))
+# Search breadth (HNSW); higher is slower with better recall
+ANN_EF = int(os.environ.get("ANN_EF", 64))
+
+
+def gallery_fingerprint(ids, matrix):
+    """
+    Identifies the gallery an index was built for: its row ids and the exact
+    float32 rows, so an index built for an older version of the same people is
+    rejected. Build indexes from the matrix EmbeddingGallery will match against.
+    """
+    digest = hashlib.sha1()
+    for person_id in ids:
+        digest.update(str(person_id).encode("utf-8"))
+        digest.update(b"\0")
+    rows = np.ascontiguousarray(matrix, dtype=np.float32)
+    digest.update(str(rows.shape).encode("utf-8"))
+    digest.update(memoryview(rows).cast("B"))
+    return digest.hexdigest()
+
+
+def spherical_kmeans(matrix, nlist, iterations, seed):
+    """
+    K-means on the unit sphere (cosine similarity), shared by IVF training and gallery prototypes.
+    :param matrix: (n, D) L2-normalized float32 rows.
+    :return: (nlist, D) unit-length centroids.
+    """
+    rng = np.random.default_rng(seed)
+    # Train on a sample; a few dozen points per centroid is plenty
+    sample = matrix
+    if len(matrix) > 64 * nlist:
+        sample = matrix[rng.choice(len(matrix), 64 * nlist, replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        # Re-seed empty lists from random points so no centroid is wasted
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    backend = "ivf"
+
+    def __init__(self, centroids, order, offsets, fingerprint, nprobe=None):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.fingerprint = fingerprint
+        self.nprobe = nprobe or ANN_NPROBE
+
+    @classmethod
+    def build(cls, ids, matrix, nlist=None, iterations=10, seed=0):
+        """`matrix` rows must be L2-normalized (as in EmbeddingGallery)."""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        nlist = min(nlist or max(1, int(4 * np.sqrt(len(matrix)))), len(matrix))
+        centroids = spherical_kmeans(matrix, nlist, iterations, seed)
+
+        assign = np.empty(len(matrix), dtype=np.int64)
+        for start in range(0, len(matrix), 65536):
+            assign[start:start + 65536] = np.argmax(matrix[start:start + 65536] @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+        return cls(centroids, order, offsets, gallery_fingerprint(ids, matrix))
+
+    def search(self, matrix, queries, k, nprobe=None):
+        """Returns (rows, scores), each (N, k), best first; rows of -1 pad short results."""
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            candidates = np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in probes[i]])
+            if len(candidates) == 0:
+                continue
+            candidate_scores = matrix[candidates] @ query
+            top = min(k, len(candidates))
+            best = np.argpartition(-candidate_scores, top - 1)[:top]
+            best = best[np.argsort(-candidate_scores[best])]
+            rows[i, :top] = candidates[best]
+            scores[i, :top] = candidate_scores[best]
+        return rows, scores
+
+    def dumps(self):
+        out = io.BytesIO()
+        np.savez(out, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                 header=np.frombuffer(json.dumps({"backend": self.backend, "fingerprint": self.fingerprint}).encode(), np.uint8))
+        return out.getvalue()
+
+    @classmethod
+    def _from_npz(cls, data, header):
+        return cls(data["centroids"], data["order"], data["offsets"], header["fingerprint"])
+
+
+class HNSWIndex:
+    backend = "hnsw"
+
+    def __init__(self, graph, fingerprint, ef=None):
+        self.graph = graph
+        self.fingerprint = fingerprint
+        self.ef = ef or ANN_EF
+
+    @classmethod
+    def build(cls, ids, matrix, m=16, ef_construction=200):
+        if hnswlib is None:
+            raise RuntimeError("ANN_BACKEND=hnsw requires the hnswlib package")
+        matrix = np.asarray(matrix, dtype=np.float32)
+        graph = hnswlib.Index(space="ip", dim=matrix.shape[1])
+        graph.init_index(max_elements=len(matrix), M=m, ef_construction=ef_construction)
+        graph.add_items(matrix, np.arange(len(matrix)))
+        return cls(graph, gallery_fingerprint(ids, matrix))
+
+    def search(self, matrix, queries, k, ef=None):
+        self.graph.set_ef(max(ef or self.ef, k))
+        labels, distances = self.graph.knn_query(queries, k=min(k, self.graph.get_current_count()))
+        # hnswlib's inner-product distance is 1 - dot
+        return labels.astype(np.int64), (1.0 - distances).astype(np.float32)
+
+    def dumps(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "index.bin")
+            self.graph.save_index(path)
+            with open(path, "rb") as f:
+                graph_bytes = f.read()
+        out = io.BytesIO()
+        header = {"backend": self.backend, "fingerprint": self.fingerprint, "dim": self.graph.dim}
+        np.savez(out, graph=np.frombuffer(graph_bytes, np.uint8),
+                 header=np.frombuffer(json.dumps(header).encode(), np.uint8))
+        return out.getvalue()
+
+    @classmethod
+    def _from_npz(cls, data, header):
+        if hnswlib is None:
+            raise RuntimeError("Loading an HNSW index requires the hnswlib package")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "index.bin")
+            data["graph"].tofile(path)
+            graph = hnswlib.Index(space="ip", dim=header["dim"])
+            graph.load_index(path)
+        return cls(graph, header["fingerprint"])
+
+
+_BACKENDS = {"ivf": IVFIndex, "hnsw": HNSWIndex}
+
+
+def build_index(ids, matrix, backend=None):
+    return _BACKENDS[(backend or ANN_BACKEND).lower()].build(ids, matrix)
+
+
+def loads_index(body):
+    with np.load(io.BytesIO(body), allow_pickle=False) as data:
+        header = json.loads(data["header"].tobytes().decode("utf-8"))
+        return _BACKENDS[header["backend"]]._from_npz(data, header)
+
+
+def ann_key(gallery_name):
+    return f"{gallery_name}{ANN_SUFFIX}"
+
+
+def publish_ann_index(bucket_name, gallery_name, ids, matrix):
+    """Builds and uploads <name>.ann when the gallery is large enough to need one; pass an EmbeddingGallery's ids and matrix."""
+    if len(ids) < ANN_MIN_GALLERY_SIZE:
+        return None
+    from utils.s3_utils import upload_bytes_to_s3
+
+    index = build_index(ids, matrix)
+    return upload_bytes_to_s3(index.dumps(), bucket_name, ann_key(gallery_name))
@@ -1,8 +1,13 @@
 # app.py
-from flask import Flask
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
 from attendance_routes import attendance_bp # Assuming this exists
 from memorysnap_routes import memorysnap_bp
+from jobs_routes import jobs_bp
+from model_registry import warm_up, model_stats
+import metrics
+from metrics import METRICS_SERVER_TIMING
+import time
 from dotenv import load_dotenv
 import os # Import os for environment variables
 
@@ -16,11 +21,53 @@ CORS(app)
 
 app.register_blueprint(attendance_bp)
 app.register_blueprint(memorysnap_bp)
+app.register_blueprint(jobs_bp)
+
+# Models load lazily on first use; PRELOAD_MODELS ("all" or e.g. "yolo,facenet")
+# loads them in each worker at startup instead. Don't combine this with
+# `gunicorn --preload`: TensorFlow is not fork-safe, so models loaded in the
+# master would be broken in the forked workers.
+preload_models = os.environ.get("PRELOAD_MODELS", "").strip()
+if preload_models:
+    try:
+        warm_up(None if preload_models == "all" else [name.strip() for name in preload_models.split(",") if name.strip()])
+    except ValueError as e:
+        raise SystemExit(f"❌ Invalid PRELOAD_MODELS={preload_models!r}: {e}")
+
+@app.before_request
+def _start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.start_request()
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.get("request_started")
+    if started is None:
+        return response
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    if METRICS_SERVER_TIMING:
+        response.headers["Server-Timing"] = metrics.server_timing_header(
+            metrics.request_timings(), time.perf_counter() - started)
+
+    # Streamed bodies are still being produced here, so measure until the response closes
+    def observe():
+        metrics.observe("faceapp_http_request_duration_seconds", time.perf_counter() - started, endpoint=endpoint)
+        metrics.increment("faceapp_http_requests_total", endpoint=endpoint, status=response.status_code)
+    response.call_on_close(observe)
+    return response
 
 @app.route("/")
 def index():
     return "Face Recognition Flask API running"
 
+@app.route("/api/models")
+def models_status():
+    return jsonify(model_stats())
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     # Use environment variable for port, default to 5001
     port = int(os.environ.get("PORT", 5001))
@@ -1,20 +1,55 @@
 from flask import Blueprint, request, jsonify, url_for
 import os, cv2, uuid
-from embeddings import process_images, get_face_embedding,process_faces_from_urls
-from recognize import recognize_face
-from face_utils import detect_and_crop_faces
-import numpy as np
-from utils.s3_utils import upload_image_array_to_s3 ,upload_file_to_s3
+from embeddings import process_images
+from recognize import assign_faces, EmbeddingGallery
+from face_utils import crop_faces
+from face_cache import analyze_image, content_key
+from utils.s3_utils import upload_image_arrays_to_s3 ,upload_file_to_s3
+from utils.image_utils import decode_for_detection
+from gallery_cache import get_gallery, invalidate_gallery, gallery_key, GalleryNotFoundError
+from gallery_format import GALLERY_SUFFIX, read_gallery
+from ann_index import publish_ann_index
+from training_jobs import submit_training_job
+from enrollment import add_faces, remove_faces, save_enrollment
+from jobs_routes import is_async_request, job_accepted_response
+from metrics import timed
+from tracking import FaceTracker, vote_tracks, iter_video_frames, iter_burst_frames
 
 
 attendance_bp = Blueprint("attendance", __name__)
 
+def _train_class_gallery(image_path, embedding_path, bucket, gallery_name, progress=None):
+    try:
+        # IMAGE_PATH is a local StudentData/<department>/<year>/<class>/<student>/ tree
+        images = process_images(image_path, embedding_path, progress=progress)
+        # Upload the embedding file to S3
+        s3_url = upload_file_to_s3(embedding_path, bucket, gallery_key(gallery_name))
+        # Large galleries also get an ANN index stored next to them
+        gallery = EmbeddingGallery.from_gallery_data(read_gallery(embedding_path, mmap=False))
+        publish_ann_index(bucket, gallery_name, gallery.ids, gallery.matrix)
+        # Keep per-image embeddings next to the gallery for incremental edits
+        save_enrollment(bucket, gallery_name, images)
+        invalidate_gallery(bucket, gallery_name)
+    finally:
+        # The path is unique per run, so a failed job must not leave it behind
+        if os.path.exists(embedding_path):
+            os.remove(embedding_path)
+    return {
+        "message": "Model trained successfully",
+        "embeddingPath": s3_url
+    }
+
+
+def _count_images(image_path):
+    return sum(len(files) for _, _, files in os.walk(image_path))
+
+
 @attendance_bp.route("/api/train-model/<classID>", methods=["POST"])
 def train_attendance_model(classID):
     department = request.json.get("department")
     year = request.json.get("year")
     IMAGE_PATH = f"StudentData/{department}/{year}/{classID}"
-    EMBEDDING_PATH = f"/tmp/TrainedModels/{department}_{year}_{classID}.pkl"  # Use /tmp for temp storage
+    EMBEDDING_PATH = f"/tmp/TrainedModels/{department}_{year}_{classID}-{uuid.uuid4()}{GALLERY_SUFFIX}"  # Use /tmp for temp storage
 
     S3_BUCKET_ATTENDANCE_EMBEDDINGS = os.environ.get('S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS')
     if not S3_BUCKET_ATTENDANCE_EMBEDDINGS:
@@ -24,45 +59,194 @@ def train_attendance_model(classID):
         return jsonify({"error": "Image path does not exist"}), 404
 
     os.makedirs(os.path.dirname(EMBEDDING_PATH), exist_ok=True)
+    gallery_name = f"{department}_{year}_{classID}"
+
+    if is_async_request(request.json):
+        job_id = submit_training_job(
+            "attendance", _count_images(IMAGE_PATH),
+            lambda progress: _train_class_gallery(IMAGE_PATH, EMBEDDING_PATH, S3_BUCKET_ATTENDANCE_EMBEDDINGS, gallery_name, progress),
+        )
+        return job_accepted_response(job_id)
 
     try:
-        process_faces_from_urls(IMAGE_PATH, EMBEDDING_PATH)
-        # Upload the embedding file to S3
-        s3_key = f"{department}_{year}_{classID}.pkl"
-        s3_url = upload_file_to_s3(EMBEDDING_PATH, S3_BUCKET_ATTENDANCE_EMBEDDINGS, s3_key)
-        os.remove(EMBEDDING_PATH)
-        return jsonify({
-            "message": "Model trained successfully",
-            "embeddingPath": s3_url
-        }), 200
+        return jsonify(_train_class_gallery(IMAGE_PATH, EMBEDDING_PATH, S3_BUCKET_ATTENDANCE_EMBEDDINGS, gallery_name)), 200
     except Exception as e:
         print(f"Error in train_attendance_model: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@attendance_bp.route("/api/train-model/<classID>/students", methods=["POST"])
+def add_students(classID):
+    department = request.json.get("department")
+    year = request.json.get("year")
+    faces = request.json.get("faces") # [{"person_id": ..., "imageUrl": ...}] to add to the class gallery
+
+    if not all([department, year, faces]):
+        return jsonify({"error": "department, year and faces are required"}), 400
+
+    S3_BUCKET_ATTENDANCE_EMBEDDINGS = os.environ.get('S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS')
+    if not S3_BUCKET_ATTENDANCE_EMBEDDINGS:
+        return jsonify({"error": "S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS not set"}), 500
+
+    gallery_name = f"{department}_{year}_{classID}"
+
+    def train(progress=None):
+        return add_faces(S3_BUCKET_ATTENDANCE_EMBEDDINGS, gallery_name, faces, progress=progress)
+
+    if is_async_request(request.json):
+        return job_accepted_response(submit_training_job("attendance-add", len(faces), train))
+
+    try:
+        return jsonify(train()), 200
+    except Exception as e:
+        print(f"Error in add_students: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+@attendance_bp.route("/api/train-model/<classID>/students", methods=["DELETE"])
+def remove_students(classID):
+    department = request.json.get("department")
+    year = request.json.get("year")
+    person_ids = request.json.get("personIds") or []
+    image_urls = request.json.get("imageUrls") or []
+
+    if not all([department, year]) or not (person_ids or image_urls):
+        return jsonify({"error": "department, year and personIds or imageUrls are required"}), 400
+
+    S3_BUCKET_ATTENDANCE_EMBEDDINGS = os.environ.get('S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS')
+    if not S3_BUCKET_ATTENDANCE_EMBEDDINGS:
+        return jsonify({"error": "S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS not set"}), 500
+
+    try:
+        gallery_name = f"{department}_{year}_{classID}"
+        return jsonify(remove_faces(S3_BUCKET_ATTENDANCE_EMBEDDINGS, gallery_name, person_ids, image_urls)), 200
+    except Exception as e:
+        print(f"Error in remove_students: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @attendance_bp.route("/api/recognize_attendance", methods=["POST"])
 def recognize_attendance():
     if 'file' not in request.files:
         return jsonify({"error": "No file uploaded"}), 400
 
+    # The class gallery published by train_attendance_model
+    department = request.form.get("department")
+    year = request.form.get("year")
+    class_id = request.form.get("classID")
+    if not all([department, year, class_id]):
+        return jsonify({"error": "department, year and classID are required"}), 400
+
+    S3_BUCKET_ATTENDANCE_EMBEDDINGS = os.environ.get('S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS')
+    if not S3_BUCKET_ATTENDANCE_EMBEDDINGS:
+        return jsonify({"error": "S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS not set"}), 500
+
+    try:
+        known_embeddings = get_gallery(S3_BUCKET_ATTENDANCE_EMBEDDINGS, f"{department}_{year}_{class_id}")
+    except GalleryNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+
     file = request.files['file']
-    image = cv2.imdecode(np.frombuffer(file.read(), np.uint8), cv2.IMREAD_COLOR)
+    image_bytes = file.read()
+    image, preview = decode_for_detection(image_bytes)
+    if image is None:
+        return jsonify({"error": "Could not decode uploaded image"}), 400
 
-    faces = detect_and_crop_faces(image)
     recognized, unknown = [], []
 
     S3_BUCKET_UNKNOWN_FACES = os.environ.get('S3_BUCKET_NAME_FOR_UNKNOWN_FACES')
     if not S3_BUCKET_UNKNOWN_FACES:
         return jsonify({"error": "S3_BUCKET_NAME_FOR_UNKNOWN_FACES not set"}), 500
 
-    for face in faces:
-        embedding = get_face_embedding(face)
-        name = recognize_face(embedding)
-        if name.lower() == "unknown":
-            uid = str(uuid.uuid4())
-            s3_key = f"unknown_faces/{uid}.jpg"
-            s3_url = upload_image_array_to_s3(face, S3_BUCKET_UNKNOWN_FACES, s3_key)
-            unknown.append({"id": uid, "imageUrl": s3_url})
+    # YOLO crops are embedded directly; no second MTCNN pass per face. A photo
+    # submitted again is served from the face cache and only matched.
+    analysis = analyze_image(image, content_key(image_bytes), preview=preview)
+    # All faces are matched together, so one student is never counted for two faces
+    matches = assign_faces(analysis.embeddings, known_embeddings)
+    unknown_faces = []
+    for i, match in enumerate(matches):
+        if match.name.lower() == "unknown":
+            unknown_faces.append(i)
         else:
-            recognized.append(name)
+            recognized.append(match.name)
+
+    if unknown_faces:
+        # One concurrent batch of uploads instead of a round trip per face
+        faces, _ = crop_faces(image, analysis.boxes, analysis.points)
+        uids = [str(uuid.uuid4()) for _ in unknown_faces]
+        with timed("upload"):
+            s3_urls = upload_image_arrays_to_s3([faces[i] for i in unknown_faces], S3_BUCKET_UNKNOWN_FACES,
+                                                [f"unknown_faces/{uid}.jpg" for uid in uids])
+        unknown = [{"id": uid, "imageUrl": s3_url} for uid, s3_url in zip(uids, s3_urls)]
+
+    return jsonify({
+        "recognized": recognized,
+        "unknown": unknown,
+        "no_face_present": len(analysis.embeddings),
+        # Per face, in detection order: name, score and margin over the runner-up
+        "faces": [match._asdict() for match in matches],
+    })
+
+
+# Attendance from a short classroom video ("video") or a burst of photos
+# ("frames", several files). Faces are tracked across frames and each track
+# is embedded only on its best few frames, then voted to one identity.
+@attendance_bp.route("/api/recognize_attendance/video", methods=["POST"])
+def recognize_attendance_video():
+    video = request.files.get("video")
+    frames = request.files.getlist("frames")
+    if video is None and not frames:
+        return jsonify({"error": "Upload a 'video' file or one or more 'frames' files"}), 400
+
+    department = request.form.get("department")
+    year = request.form.get("year")
+    class_id = request.form.get("classID")
+    if not all([department, year, class_id]):
+        return jsonify({"error": "department, year and classID are required"}), 400
+
+    S3_BUCKET_ATTENDANCE_EMBEDDINGS = os.environ.get('S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS')
+    if not S3_BUCKET_ATTENDANCE_EMBEDDINGS:
+        return jsonify({"error": "S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS not set"}), 500
+    S3_BUCKET_UNKNOWN_FACES = os.environ.get('S3_BUCKET_NAME_FOR_UNKNOWN_FACES')
+    if not S3_BUCKET_UNKNOWN_FACES:
+        return jsonify({"error": "S3_BUCKET_NAME_FOR_UNKNOWN_FACES not set"}), 500
+
+    try:
+        known_embeddings = get_gallery(S3_BUCKET_ATTENDANCE_EMBEDDINGS, f"{department}_{year}_{class_id}")
+    except GalleryNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+
+    if video is not None:
+        suffix = os.path.splitext(video.filename or "")[1] or ".mp4"
+        frame_source = iter_video_frames(video.read(), suffix=suffix)
+    else:
+        frame_source = iter_burst_frames(f.read() for f in frames)
+
+    tracker = FaceTracker()
+    try:
+        for frame_index, frame in frame_source:
+            tracker.update(frame, frame_index)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    tracks = tracker.tracks()
+    results = vote_tracks(tracks, known_embeddings)
+
+    # Each unknown person is uploaded once, from their best frame
+    unknown_tracks = [track for track, result in zip(tracks, results) if result["name"] == "unknown"]
+    unknown = []
+    if unknown_tracks:
+        uids = [str(uuid.uuid4()) for _ in unknown_tracks]
+        with timed("upload"):
+            s3_urls = upload_image_arrays_to_s3(
+                [cv2.cvtColor(track.candidates[0][2], cv2.COLOR_RGB2BGR) for track in unknown_tracks],
+                S3_BUCKET_UNKNOWN_FACES, [f"unknown_faces/{uid}.jpg" for uid in uids])
+        unknown = [{"id": uid, "imageUrl": s3_url, "trackId": track.track_id}
+                   for uid, s3_url, track in zip(uids, s3_urls, unknown_tracks)]
 
-    return jsonify({"recognized": list(set(recognized)), "unknown": unknown, "no_face_present": len(faces)})
\ No newline at end of file
+    recognized = sorted({result["name"] for result in results if result["name"] != "unknown"})
+    return jsonify({
+        "recognized": recognized,
+        "unknown": unknown,
+        "no_face_present": len(tracks),
+        "frames": tracker.frames,
+        "tracks": results,
+    })
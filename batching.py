@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+# Coalesce model calls from concurrent requests into shared forward passes
+MICROBATCH_ENABLED = os.environ.get("MICROBATCH_ENABLED", "").lower() in ("1", "true", "yes")
+# How long the first queued item may wait for others to join its batch
+MICROBATCH_MAX_WAIT_MS = float(os.environ.get("MICROBATCH_MAX_WAIT_MS", 5))
+# Images per batched YOLO call (FaceNet batches use EMBEDDING_MAX_BATCH_SIZE)
+MICROBATCH_MAX_DETECT_BATCH = int(os.environ.get("MICROBATCH_MAX_DETECT_BATCH", 8))
+
+
+class MicroBatcher:
+    """
+    Collects items submitted from many threads and runs them through
+    `run_batch(items) -> results` together. A batch is dispatched when it
+    reaches max_batch_size or when its first item has waited max_wait_ms.
+    """
+
+    def __init__(self, run_batch, max_batch_size, max_wait_ms=MICROBATCH_MAX_WAIT_MS, name="microbatch"):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self._queue = Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def submit_many(self, items):
+        """Queues every item and blocks until all of their results are ready."""
+        self._ensure_started()
+        futures = []
+        for item in items:
+            future = Future()
+            self._queue.put((item, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def submit(self, item):
+        return self.submit_many([item])[0]
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+
+            items = [item for item, _ in batch]
+            try:
+                results = self.run_batch(items)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
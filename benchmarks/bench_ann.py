@@ -0,0 +1,72 @@
+"""
+ANN vs exact search on synthetic galleries.
+
+    python benchmarks/bench_ann.py --sizes 1000 10000 50000 --nprobe 1 4 8 16
+
+Prints one JSON object with build time, recall@1 against exact search and
+per-query latency for each gallery size and nprobe setting.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ann_index import IVFIndex  # noqa: E402
+from recognize import EmbeddingGallery  # noqa: E402
+
+
+def synthetic_gallery(size, dim, rng):
+    # Identities cluster loosely, like faces of similar-looking people
+    centers = rng.normal(size=(max(1, size // 50), dim)).astype(np.float32)
+    matrix = centers[rng.integers(0, len(centers), size)] + rng.normal(scale=0.8, size=(size, dim)).astype(np.float32)
+    return [f"person-{i}" for i in range(size)], matrix
+
+
+def bench_size(size, dim, queries, nprobes, rng):
+    ids, matrix = synthetic_gallery(size, dim, rng)
+    gallery = EmbeddingGallery(ids, matrix)
+    truth_rows = rng.integers(0, size, queries)
+    probes = gallery.matrix[truth_rows] + rng.normal(scale=0.03, size=(queries, dim)).astype(np.float32)
+
+    start = time.perf_counter()
+    exact_ids, _ = gallery.match(probes, exact=True)
+    exact_ms = (time.perf_counter() - start) * 1000 / queries
+
+    start = time.perf_counter()
+    index = IVFIndex.build(ids, gallery.matrix)
+    build_s = time.perf_counter() - start
+    gallery.attach_index(index)
+
+    result = {"size": size, "exact_ms_per_query": round(exact_ms, 4), "ivf_build_s": round(build_s, 3),
+              "nlist": len(index.centroids), "ivf": []}
+    for nprobe in nprobes:
+        index.nprobe = nprobe
+        start = time.perf_counter()
+        ann_ids, _ = gallery.match(probes)
+        ann_ms = (time.perf_counter() - start) * 1000 / queries
+        recall = float(np.mean(ann_ids[:, 0] == exact_ids[:, 0]))
+        result["ivf"].append({"nprobe": nprobe, "ms_per_query": round(ann_ms, 4), "recall_at_1": round(recall, 4)})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = [bench_size(size, args.dim, args.queries, args.nprobe, rng) for size in args.sizes]
+    print(json.dumps({"benchmark": "ann_vs_exact", "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
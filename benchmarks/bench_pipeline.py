@@ -0,0 +1,294 @@
+"""
+End-to-end benchmarks for the recognition hot paths, runnable offline.
+
+    python benchmarks/bench_pipeline.py --output bench-results.json
+    python benchmarks/bench_pipeline.py --only recognize_face --gallery-sizes 10 1000 100000
+
+Covers detect_and_crop_faces, get_face_embedding, recognize_face across
+gallery sizes, process_faces_from_urls, and the /classify-faces and
+/api/recognize_attendance routes through the Flask test client. S3 is
+replaced by moto when installed or by an in-memory client, image URLs are
+served from a local HTTP server, and the models are deterministic stubs
+unless --models real is given (which needs the real packages and weights).
+
+Writes one JSON document (printed, or to --output) with the commit, settings
+and timing percentiles, for comparison across commits.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARKS = ["detect_and_crop_faces", "get_face_embedding", "recognize_face",
+              "process_faces_from_urls", "classify_faces_route", "recognize_attendance_route"]
+
+TRIP_ID = "bench-trip"
+CLASS_FORM = {"department": "bench", "year": "1", "classID": "A"}
+
+
+def _configure_environment(workdir):
+    # Module-level settings are read at import time, so these go first
+    defaults = {
+        "AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench", "AWS_REGION": "us-east-1",
+        "S3_BUCKET_NAME_FOR_CROPPED_FACES": "bench-cropped-faces",
+        "S3_BUCKET_NAME_FOR_EMBEDDINGS": "bench-embeddings",
+        "S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS": "bench-attendance-embeddings",
+        "S3_BUCKET_NAME_FOR_UNKNOWN_FACES": "bench-unknown-faces",
+        "GALLERY_CACHE_DIR": os.path.join(workdir, "gallery_cache"),
+        "S3_UPLOAD_SPOOL_DIR": os.path.join(workdir, "upload_spool"),
+        "TRAINING_JOBS_DB": os.path.join(workdir, "training_jobs.sqlite3"),
+        "FACE_CACHE_DIR": "",
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    # Always measure in-process inference
+    os.environ["INFERENCE_SERVER_ADDRESS"] = ""
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def timed(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples = np.array(samples)
+    return {
+        "repeat": repeat,
+        "mean_ms": round(float(samples.mean()), 3),
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples, 95)), 3),
+        "min_ms": round(float(samples.min()), 3),
+    }
+
+
+def _people(count):
+    return [f"person-{i:04d}" for i in range(count)]
+
+
+# ---------------------------------------------------------------- benchmarks
+
+def bench_detect_and_crop_faces(args, ctx):
+    from face_utils import detect_and_crop_faces
+    from stand_ins import synthetic_photo
+
+    results = []
+    for width, height in args.image_sizes:
+        image, faces = synthetic_photo(_people(args.faces_per_photo), width, height, seed=args.seed)
+        crops = detect_and_crop_faces(image)
+        results.append({"image": f"{width}x{height}", "faces_drawn": len(faces), "faces_found": len(crops),
+                        **timed(lambda: detect_and_crop_faces(image), args.repeat)})
+    return results
+
+
+def bench_get_face_embedding(args, ctx):
+    from embeddings import get_face_embedding
+    from stand_ins import synthetic_photo
+
+    image, _ = synthetic_photo(_people(1), 640, 480, seed=args.seed)
+    return [{"image": "640x480", **timed(lambda: get_face_embedding(image), args.repeat)}]
+
+
+def bench_recognize_face(args, ctx):
+    from recognize import EmbeddingGallery, recognize_face, recognize_faces
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for size in args.gallery_sizes:
+        ids = _people(size)
+        matrix = rng.normal(size=(size, 512)).astype(np.float32)
+        known = dict(zip(ids, matrix))
+        gallery = EmbeddingGallery(ids, matrix)
+        probe = matrix[size // 2] + rng.normal(scale=0.05, size=512).astype(np.float32)
+        probes = matrix[rng.integers(0, size, args.faces_per_photo)]
+        result = {
+            "gallery_size": size,
+            "gallery": timed(lambda: recognize_face(probe, gallery), args.repeat),
+            "gallery_batch": {"faces": len(probes), **timed(lambda: recognize_faces(probes, gallery), args.repeat)},
+        }
+        # The legacy dict input is converted on every call; skip it where that alone takes seconds
+        if size <= 10000:
+            result["dict"] = timed(lambda: recognize_face(probe, known), max(1, args.repeat // 4))
+        results.append(result)
+    return results
+
+
+def bench_process_faces_from_urls(args, ctx):
+    from embeddings import process_faces_from_urls
+    from gallery_format import GALLERY_SUFFIX
+
+    face_data_list = ctx["enrollment_list"]
+    output = os.path.join(ctx["workdir"], f"bench-enrollment{GALLERY_SUFFIX}")
+    timing = timed(lambda: process_faces_from_urls(face_data_list, output), max(1, args.repeat // 4), warmup=0)
+    return [{"images": len(face_data_list), "people": args.people, **timing}]
+
+
+def bench_classify_faces_route(args, ctx):
+    from face_cache import face_cache
+
+    client, body = ctx["client"], {"tripId": TRIP_ID, "embeddingPath": "bench", "imageUrls": ctx["photo_urls"]}
+
+    def classify(stream=False):
+        path = "/classify-faces?stream=true" if stream else "/classify-faces"
+        response = client.post(path, json=body)
+        response.get_data()
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return response
+
+    def cold():
+        face_cache.clear()
+        classify()
+
+    recognized = sum(len(r.get("recognized", [])) for r in classify().get_json()["results"])
+    repeat = max(1, args.repeat // 4)
+    return [{
+        "images": len(ctx["photo_urls"]),
+        "faces_recognized": recognized,
+        "cold_cache": timed(cold, repeat),
+        "warm_cache": timed(classify, repeat),
+        "warm_cache_stream": timed(lambda: classify(stream=True), repeat),
+    }]
+
+
+def bench_recognize_attendance_route(args, ctx):
+    import io
+    from face_cache import face_cache
+
+    client, photo = ctx["client"], ctx["attendance_photo"]
+
+    def recognize():
+        face_cache.clear()
+        data = {**CLASS_FORM, "file": (io.BytesIO(photo), "class.jpg")}
+        response = client.post("/api/recognize_attendance", data=data, content_type="multipart/form-data")
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return response
+
+    result = recognize().get_json()
+    return [{"faces": result["no_face_present"], "recognized": len(result["recognized"]),
+             "unknown": len(result["unknown"]), **timed(recognize, args.repeat)}]
+
+
+# ---------------------------------------------------------------- fixtures
+
+def _prepare(args, server, workdir):
+    from stand_ins import encode_jpeg, synthetic_photo
+
+    people = _people(args.people)
+    ctx = {"workdir": workdir, "enrollment_list": [], "photo_urls": []}
+    for person in people:
+        for shot in range(args.shots_per_person):
+            image, _ = synthetic_photo([person], 480, 640, seed=args.seed + shot)
+            url = server.add(f"/enroll/{person}/{shot}.jpg", encode_jpeg(image))
+            ctx["enrollment_list"].append({"person_id": person, "imageUrl": url})
+
+    rng = np.random.default_rng(args.seed)
+    for i in range(args.photos):
+        # Mostly enrolled people plus one stranger per photo
+        members = list(rng.choice(people, size=min(args.faces_per_photo - 1, len(people)), replace=False))
+        image, _ = synthetic_photo(members + [f"stranger-{i}"], 1920, 1080, seed=args.seed + i)
+        ctx["photo_urls"].append(server.add(f"/trip/{i}.jpg", encode_jpeg(image)))
+
+    members = list(rng.choice(people, size=min(args.faces_per_photo, len(people)), replace=False))
+    ctx["attendance_photo"] = encode_jpeg(synthetic_photo(members + ["stranger-x"], 1920, 1080, seed=args.seed)[0])
+    return ctx
+
+
+def _publish_galleries(ctx):
+    from embeddings import process_faces_from_urls
+    from gallery_cache import gallery_key
+    from gallery_format import GALLERY_SUFFIX
+    from utils.s3_utils import upload_file_to_s3
+
+    path = os.path.join(ctx["workdir"], f"bench-gallery{GALLERY_SUFFIX}")
+    process_faces_from_urls(ctx["enrollment_list"], path)
+    upload_file_to_s3(path, os.environ["S3_BUCKET_NAME_FOR_EMBEDDINGS"], gallery_key(TRIP_ID))
+    class_gallery = f"{CLASS_FORM['department']}_{CLASS_FORM['year']}_{CLASS_FORM['classID']}"
+    upload_file_to_s3(path, os.environ["S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS"], gallery_key(class_gallery))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--models", choices=["stub", "real"], default="stub")
+    parser.add_argument("--s3", choices=["auto", "moto", "memory"], default="auto")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--gallery-sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--image-sizes", nargs="+", default=["640x480", "1920x1080", "4032x3024"])
+    parser.add_argument("--faces-per-photo", type=int, default=6)
+    parser.add_argument("--people", type=int, default=20)
+    parser.add_argument("--shots-per-person", type=int, default=2)
+    parser.add_argument("--photos", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    args.image_sizes = [tuple(int(v) for v in size.lower().split("x")) for size in args.image_sizes]
+
+    workdir = tempfile.mkdtemp(prefix="faceapp-bench-")
+    _configure_environment(workdir)
+
+    from stand_ins import LocalImageServer, install_s3, register_stub_models
+    if args.models == "stub":
+        register_stub_models()
+    buckets = [os.environ[name] for name in ("S3_BUCKET_NAME_FOR_CROPPED_FACES", "S3_BUCKET_NAME_FOR_EMBEDDINGS",
+                                             "S3_BUCKET_NAME_FOR_ATTENDANCE_EMBEDDINGS", "S3_BUCKET_NAME_FOR_UNKNOWN_FACES")]
+    s3_backend, stop_s3 = install_s3(args.s3, buckets)
+
+    report = {
+        "benchmark": "pipeline",
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "models": args.models,
+        "s3": s3_backend,
+        "settings": {k: v for k, v in vars(args).items() if k not in ("only", "output")},
+        "results": {},
+    }
+    # The pipeline logs progress with print(); keep stdout for the JSON report
+    try:
+        with contextlib.redirect_stdout(sys.stderr), LocalImageServer() as server:
+            ctx = _prepare(args, server, workdir)
+            if {"classify_faces_route", "recognize_attendance_route"} & set(args.only):
+                from app import app
+                ctx["client"] = app.test_client()
+                _publish_galleries(ctx)
+            for name in args.only:
+                print(f"⏱️ {name}", file=sys.stderr)
+                report["results"][name] = globals()[f"bench_{name}"](args, ctx)
+    finally:
+        stop_s3()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+        print(f"✅ Results written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Offline stand-ins for the benchmarks: synthetic face photos, deterministic
+model stubs, an in-memory S3 client and a local HTTP image server.
+
+The stubs are cheap but keep the shapes, dtypes and call patterns of the real
+models, and their cost still grows with the image and batch size, so the
+timings show the pipeline's own overhead (decode, resize, crop, copies,
+matching, I/O) rather than network inference.
+"""
+import hashlib
+import io
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+from botocore.exceptions import ClientError
+
+# Synthetic faces are drawn in this BGR colour (+/- texture) on a grey background
+SKIN_BGR = np.array([90, 140, 210])
+_SKIN_LOW = np.clip(SKIN_BGR - 45, 0, 255).astype(np.uint8)
+_SKIN_HIGH = np.clip(SKIN_BGR + 45, 0, 255).astype(np.uint8)
+_MIN_FACE_AREA = 64
+
+
+# ---------------------------------------------------------------- synthetic images
+
+def identity_texture(identity, seed=0):
+    """Fixed 8x8 pattern that makes one synthetic person's face distinguishable."""
+    digest = hashlib.sha1(f"{seed}:{identity}".encode("utf-8")).digest()
+    rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+    return rng.uniform(-30, 30, size=(8, 8)).astype(np.float32)
+
+
+def draw_face(image, identity, box, seed=0):
+    x1, y1, x2, y2 = box
+    width, height = x2 - x1, y2 - y1
+    texture = cv2.resize(identity_texture(identity, seed), (width, height), interpolation=cv2.INTER_NEAREST)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(mask, (width // 2, height // 2), (width // 2 - 1, height // 2 - 1), 0, 0, 360, 255, -1)
+    face = np.clip(SKIN_BGR + texture[..., None], 0, 255).astype(np.uint8)
+    region = image[y1:y2, x1:x2]
+    region[mask > 0] = face[mask > 0]
+
+
+def synthetic_photo(identities, width, height, face_size=None, seed=0):
+    """
+    A grey photo with one synthetic face per identity laid out on a grid.
+    :return: (BGR image, list of (identity, box)).
+    """
+    rng = np.random.default_rng(seed)
+    image = rng.integers(90, 110, size=(height, width, 3), dtype=np.uint8)
+    if not identities:
+        return image, []
+    columns = int(np.ceil(np.sqrt(len(identities))))
+    rows = int(np.ceil(len(identities) / columns))
+    cell_w, cell_h = width // columns, height // rows
+    size = face_size or int(min(cell_w, cell_h) * 0.6)
+    faces = []
+    for i, identity in enumerate(identities):
+        cx = (i % columns) * cell_w + cell_w // 2
+        cy = (i // columns) * cell_h + cell_h // 2
+        box = (cx - size // 2, cy - size // 2, cx - size // 2 + size, cy - size // 2 + size)
+        draw_face(image, identity, box, seed)
+        faces.append((identity, box))
+    return image, faces
+
+
+def encode_jpeg(image, quality=90):
+    return cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+# ---------------------------------------------------------------- model stubs
+
+def _skin_boxes(image_bgr):
+    mask = cv2.inRange(image_bgr, _SKIN_LOW, _SKIN_HIGH)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    boxes = [(x, y, x + w, y + h) for x, y, w, h, area in stats[1:count] if area >= _MIN_FACE_AREA]
+    return np.array(boxes, dtype=np.float32).reshape(-1, 4)
+
+
+class _Tensor:
+    def __init__(self, array):
+        self._array = array
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self._array
+
+
+class _YoloResult:
+    def __init__(self, boxes):
+        self.boxes = type("Boxes", (), {"xyxy": _Tensor(boxes)})()
+        self.keypoints = None
+
+
+class StubYOLO:
+    """Finds the synthetic faces by colour; accepts one image or a list, like ultralytics."""
+
+    def __call__(self, images, **kwargs):
+        if isinstance(images, list):
+            return [_YoloResult(_skin_boxes(image)) for image in images]
+        return [_YoloResult(_skin_boxes(images))]
+
+
+class StubMTCNN:
+    def detect_faces(self, image_rgb):
+        boxes = _skin_boxes(cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR))
+        detections = []
+        for x1, y1, x2, y2 in boxes.astype(int):
+            w, h = x2 - x1, y2 - y1
+            detections.append({
+                "box": [int(x1), int(y1), int(w), int(h)],
+                "confidence": 0.99,
+                "keypoints": {"left_eye": (int(x1 + w * 0.3), int(y1 + h * 0.4)),
+                              "right_eye": (int(x1 + w * 0.7), int(y1 + h * 0.4))},
+            })
+        detections.sort(key=lambda d: d["box"][2] * d["box"][3], reverse=True)
+        return detections
+
+
+class StubFaceNet:
+    """Fixed random projection of a 16x16 luminance thumbnail; same texture, similar embedding."""
+
+    def __init__(self, seed=0):
+        self.projection = np.random.default_rng(seed).normal(size=(256, 512)).astype(np.float32)
+
+    def embeddings(self, faces):
+        faces = np.asarray(faces)
+        thumbs = np.empty((len(faces), 256), dtype=np.float32)
+        for i, face in enumerate(faces):
+            gray = face.astype(np.float32).mean(axis=2)
+            thumbs[i] = cv2.resize(gray, (16, 16), interpolation=cv2.INTER_AREA).ravel()
+        thumbs -= thumbs.mean(axis=1, keepdims=True)
+        return thumbs @ self.projection
+
+
+def register_stub_models():
+    from model_registry import register_model
+    register_model("yolo", StubYOLO)
+    register_model("mtcnn", StubMTCNN)
+    register_model("facenet", StubFaceNet)
+
+
+# ---------------------------------------------------------------- S3 and HTTP
+
+class MemoryS3Client:
+    """The subset of the boto3 S3 client used by utils/s3_utils.py, kept in memory."""
+
+    def __init__(self):
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def _not_found(self, operation):
+        return ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, operation)
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, IfMatch=None, IfNoneMatch=None, **kwargs):
+        body = Body.read() if hasattr(Body, "read") else bytes(Body)
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        with self._lock:
+            current = self.objects.get((Bucket, Key))
+            if (IfNoneMatch == "*" and current is not None) or (IfMatch and (current is None or current[1] != IfMatch)):
+                raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": "At least one of the "
+                                             "pre-conditions you specified did not hold"}}, "PutObject")
+            self.objects[(Bucket, Key)] = (body, etag, datetime.now(timezone.utc))
+        return {"ETag": etag}
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, "rb") as f:
+            self.put_object(Bucket, Key, f.read())
+
+    def _get(self, bucket, key, operation):
+        with self._lock:
+            if (bucket, key) not in self.objects:
+                raise self._not_found(operation)
+            return self.objects[(bucket, key)]
+
+    def get_object(self, Bucket, Key, **kwargs):
+        body, etag, modified = self._get(Bucket, Key, "GetObject")
+        return {"Body": io.BytesIO(body), "ETag": etag, "LastModified": modified, "ContentLength": len(body)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        body, etag, modified = self._get(Bucket, Key, "HeadObject")
+        return {"ETag": etag, "LastModified": modified, "ContentLength": len(body)}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        body, _, _ = self._get(Bucket, Key, "GetObject")
+        with open(Filename, "wb") as f:
+            f.write(body)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+
+def install_s3(backend="auto", buckets=()):
+    """
+    Points utils.s3_utils at moto (if installed and requested) or MemoryS3Client.
+    :return: (backend name, cleanup callable).
+    """
+    from utils import s3_utils
+
+    if backend in ("auto", "moto"):
+        try:
+            from moto import mock_aws
+        except ImportError:
+            if backend == "moto":
+                raise
+        else:
+            mock = mock_aws()
+            mock.start()
+            s3_utils._s3_client = None
+            client = s3_utils._get_s3_client()
+            for bucket in buckets:
+                client.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": client.meta.region_name}
+                                     if client.meta.region_name != "us-east-1" else {})
+            return "moto", mock.stop
+
+    s3_utils._s3_client = MemoryS3Client()
+    return "memory", lambda: None
+
+
+class LocalImageServer:
+    """Serves registered bytes over HTTP on 127.0.0.1 with ETag, conditional GET and HEAD support."""
+
+    def __init__(self):
+        self.files = {}
+        files = self.files
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send_headers(self):
+                body = files.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return None
+                etag = f'"{hashlib.md5(body).hexdigest()}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return None
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return body
+
+            def do_HEAD(self):
+                self._send_headers()
+
+            def do_GET(self):
+                body = self._send_headers()
+                if body is not None:
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add(self, path, body):
+        self.files[path] = body
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}{path}"
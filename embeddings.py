@@ -1,18 +1,23 @@
 import os
-import pickle
 import cv2
 import numpy as np
-from mtcnn import MTCNN
-from keras_facenet import FaceNet
+from prototypes import save_prototype_gallery
+from model_registry import get_model
+from inference_server import remote_inference_enabled, get_inference_client
+from batching import MicroBatcher, MICROBATCH_ENABLED
+from metrics import timed
 
-# Initialize MTCNN and FaceNet
-detector = MTCNN()
-embedder = FaceNet()
+# Upper bound on faces sent through FaceNet in one forward pass; keeps
+# memory bounded on CPU-only hosts when a photo contains many faces.
+EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", 32))
+EMBEDDING_DIM = 512
 
-# Get 512-d face embedding from image
-def get_face_embedding(image):
+
+# Locate the face with MTCNN and return it as a 160x160 RGB crop
+@timed("mtcnn")
+def _extract_face(image):
     image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    detections = detector.detect_faces(image_rgb)
+    detections = get_model("mtcnn").detect_faces(image_rgb)
 
     if not detections:
         return None
@@ -20,14 +25,140 @@ def get_face_embedding(image):
     x, y, width, height = detections[0]['box']
     x, y = max(0, x), max(0, y)  # Ensure no negative values
     face = image_rgb[y:y+height, x:x+width]
-    face = cv2.resize(face, (160, 160))
+    return cv2.resize(face, (160, 160))
+
+
+# Run FaceNet over 160x160 RGB faces in chunks of at most max_batch_size
+@timed("facenet")
+def embed_faces(faces_rgb, max_batch_size=None):
+    max_batch_size = max_batch_size or EMBEDDING_MAX_BATCH_SIZE
+    if len(faces_rgb) == 0:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    if remote_inference_enabled():
+        return get_inference_client().embed(faces_rgb, max_batch_size)
+    if MICROBATCH_ENABLED and max_batch_size >= EMBEDDING_MAX_BATCH_SIZE:
+        # Faces from concurrent requests share FaceNet forward passes of at most
+        # EMBEDDING_MAX_BATCH_SIZE; a caller asking for smaller passes runs its own
+        return np.stack(_embed_batcher.submit_many(list(faces_rgb)))
+    return _embed_faces_local(faces_rgb, max_batch_size)
+
+
+def _embed_faces_local(faces_rgb, max_batch_size):
+    embedder = get_model("facenet")
+    out = np.empty((len(faces_rgb), EMBEDDING_DIM), dtype=np.float32)
+    for start in range(0, len(faces_rgb), max_batch_size):
+        chunk = np.asarray(faces_rgb[start:start + max_batch_size])
+        out[start:start + len(chunk)] = embedder.embeddings(chunk)
+    return out
+
+
+_embed_batcher = MicroBatcher(
+    lambda faces: list(_embed_faces_local(np.stack(faces), EMBEDDING_MAX_BATCH_SIZE)),
+    EMBEDDING_MAX_BATCH_SIZE,
+    name="facenet-microbatch",
+)
+
+
+# Get 512-d face embedding from image
+def get_face_embedding(image):
+    face = _extract_face(image)
+    if face is None:
+        return None
 
     # Get 512-d embedding
-    embedding = embedder.embeddings(np.expand_dims(face, axis=0))[0]
-    return embedding
+    return embed_faces([face])[0]
 
 
-def process_images(input_dir, output_pkl):
+# Batched get_face_embedding for the BGR crops returned by detect_and_crop_faces.
+# Returns an (N, 512) array and a boolean mask of the rows where a face was found;
+# rows without a face are left as zeros.
+def get_face_embeddings(images, max_batch_size=None):
+    faces = [_extract_face(image) for image in images]
+    valid = np.array([face is not None for face in faces], dtype=bool)
+    embeddings = np.zeros((len(faces), EMBEDDING_DIM), dtype=np.float32)
+    if valid.any():
+        embeddings[valid] = embed_faces([f for f in faces if f is not None], max_batch_size)
+    return embeddings, valid
+
+
+# Which detector finds the face in enrollment images: "yolo" reuses the
+# detect_and_crop_faces path used at recognition time, "mtcnn" keeps the
+# original MTCNN crop. Using the same detector end to end keeps training
+# and recognition crops consistent.
+FACE_DETECTOR_BACKEND = os.environ.get("FACE_DETECTOR_BACKEND", "yolo").lower()
+
+
+# Rotate a crop so the eyes are level, using landmarks from the first detector
+def _align_face(face, landmarks):
+    (lx, ly), (rx, ry) = sorted(map(tuple, landmarks[:2]))
+    angle = np.degrees(np.arctan2(ry - ly, rx - lx))
+    center = ((lx + rx) / 2.0, (ly + ry) / 2.0)
+    matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
+    return cv2.warpAffine(face, matrix, (face.shape[1], face.shape[0]),
+                          flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+# Turn a BGR crop from the first detector into a 160x160 RGB FaceNet input
+def _prepare_aligned_face(face, landmarks=None):
+    if face.shape[:2] != (160, 160):
+        face = cv2.resize(face, (160, 160))
+    face = cv2.cvtColor(face, cv2.COLOR_BGR2RGB)
+    if landmarks is not None:
+        face = _align_face(face, landmarks)
+    return face
+
+
+# Embed BGR crops that are already cropped/aligned (e.g. by YOLO in
+# detect_and_crop_faces) without running MTCNN on them again.
+# `landmarks` is an optional per-face list of (5, 2) keypoints in crop
+# coordinates; faces with landmarks are rotated so the eyes are level.
+# With is_rgb, `faces` is the (N, 160, 160, 3) RGB batch from
+# face_utils.detect_face_batch and goes to FaceNet without per-face copies.
+def embed_aligned_faces(faces, landmarks=None, max_batch_size=None, is_rgb=False):
+    if landmarks is None:
+        landmarks = [None] * len(faces)
+    if not is_rgb:
+        faces_rgb = [_prepare_aligned_face(face, points) for face, points in zip(faces, landmarks)]
+        return embed_faces(faces_rgb, max_batch_size)
+
+    faces_rgb = faces
+    if any(points is not None for points in landmarks):
+        # Align into a copy; the caller may still need the unrotated crops
+        faces_rgb = np.array(faces, dtype=np.uint8)
+        for i, points in enumerate(landmarks):
+            if points is not None:
+                faces_rgb[i] = _align_face(faces_rgb[i], points)
+    return embed_faces(faces_rgb, max_batch_size)
+
+
+# The most confident face in an enrollment image as a 160x160 RGB FaceNet
+# input, found with the configured detector backend.
+def _training_face(image, detector_backend=None):
+    backend = (detector_backend or FACE_DETECTOR_BACKEND).lower()
+    if backend == "mtcnn":
+        return _extract_face(image)
+    if backend != "yolo":
+        raise ValueError(f"Unknown face detector backend: {backend}")
+
+    from face_utils import detect_face_batch  # face_utils imports this module
+    faces, landmarks = detect_face_batch(image)
+    if not len(faces):
+        return None
+    if landmarks[0] is not None:
+        return _align_face(faces[0], landmarks[0])
+    return faces[0]
+
+
+def get_training_embedding(image, detector_backend=None):
+    face = _training_face(image, detector_backend)
+    if face is None:
+        return None
+    return embed_faces([face])[0]
+
+
+# `progress`, when given, is called once per image as
+# progress(processed=1, faces_found=0|1, failures=0|1).
+def process_images(input_dir, output_pkl, detector_backend=None, progress=None):
     face_data = {}
     print("🔍 Starting embedding process...")
 
@@ -36,7 +167,7 @@ def process_images(input_dir, output_pkl):
         if not os.path.isdir(person_path):
             continue
 
-        embeddings = []
+        embeddings = {}
         print(f"📂 Processing: {person_name}")
 
         for file in os.listdir(person_path):
@@ -45,88 +176,148 @@ def process_images(input_dir, output_pkl):
 
             if img is None:
                 print(f"  ⚠️ Skipping unreadable: {file}")
+                if progress:
+                    progress(processed=1, failures=1)
                 continue
 
-            embedding = get_face_embedding(img)
+            embedding = get_training_embedding(img, detector_backend)
             if embedding is not None:
-                embeddings.append(embedding)
+                embeddings[file] = embedding
                 print(f"  ✅ Processed: {file}")
             else:
                 print(f"  ❌ No face detected: {file}")
+            if progress:
+                found = embedding is not None
+                progress(processed=1, faces_found=int(found), failures=int(not found))
 
         if embeddings:
-            avg_embedding = np.mean(embeddings, axis=0)
-            face_data[person_name] = avg_embedding
+            face_data[person_name] = embeddings
         else:
             print(f"  ⚠️ No valid embeddings for {person_name}")
 
     os.makedirs(os.path.dirname(output_pkl), exist_ok=True)
 
     try:
-        with open(output_pkl, 'wb') as f:
-            pickle.dump(face_data, f)
-            print(f"✅ Embeddings saved at: {output_pkl}")
+        # .fgal prototype gallery, or a legacy averaged pickle when output_pkl ends in .pkl
+        save_prototype_gallery(output_pkl, face_data)
+        print(f"✅ Embeddings saved at: {output_pkl}")
     except Exception as e:
         print(f"❌ Error saving file: {e}")
+
+    # Per-image embeddings, kept so the gallery can be edited incrementally
+    return face_data
+
 import requests
-import numpy as np
-import cv2
-import pickle
 import os
 from collections import defaultdict
-from embeddings import get_face_embedding  # keep this function as-is
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from embeddings import _training_face, embed_faces, save_prototype_gallery, EMBEDDING_MAX_BATCH_SIZE
+from utils.s3_utils import download_image_from_s3_url
 
-def process_faces_from_urls(face_data_list, output_pkl):
-    face_data = defaultdict(list)
-    print("🔍 Starting embedding process from URLs...\n")
+# Concurrent image downloads while building a gallery from URLs
+TRAINING_DOWNLOAD_WORKERS = int(os.environ.get("TRAINING_DOWNLOAD_WORKERS", 8))
 
-    for face in face_data_list:
-        person_id = face.get("person_id")
-        image_url = face.get("imageUrl")
+# Download and embed [{"person_id", "imageUrl"}, ...] entries.
+# Returns {person_id: {image_url: embedding}}. `progress` gets processed=1 per
+# image as it is detected and faces_found/failures per image once it is embedded.
+def embed_faces_from_urls(face_data_list, detector_backend=None, workers=None, progress=None):
+    face_data = defaultdict(dict)
 
-        if not person_id or not image_url:
-            print(f"⚠️ Skipping incomplete entry: {face}")
-            continue
+    # Faces waiting for the next batched FaceNet pass
+    pending_keys, pending_faces = [], []
 
+    def flush():
+        if not pending_faces:
+            return
+        batch_keys, batch_faces = list(pending_keys), list(pending_faces)
+        pending_keys.clear()
+        pending_faces.clear()
         try:
-            # Download the image
-            response = requests.get(image_url)
-            if response.status_code != 200:
-                print(f"❌ Failed to fetch image for {person_id}")
+            embeddings = list(embed_faces(batch_faces))
+        except Exception as e:
+            # One bad crop (or a transient inference error) must not drop the whole batch
+            print(f"⚠️ Batch embedding failed ({e}); retrying {len(batch_faces)} faces one at a time")
+            embeddings = []
+            for (person_id, _), face in zip(batch_keys, batch_faces):
+                try:
+                    embeddings.append(embed_faces([face])[0])
+                except Exception as e:
+                    print(f"❌ Failed to embed image for {person_id}: {e}")
+                    embeddings.append(None)
+
+        embedded = 0
+        for (person_id, image_url), embedding in zip(batch_keys, embeddings):
+            if embedding is None:
                 continue
+            face_data[person_id][image_url] = embedding
+            embedded += 1
+            print(f"✅ Embedded image for {person_id}")
+        if progress:
+            progress(faces_found=embedded, failures=len(batch_keys) - embedded)
 
-            image_array = np.frombuffer(response.content, np.uint8)
-            image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
+    with ThreadPoolExecutor(max_workers=workers or TRAINING_DOWNLOAD_WORKERS) as pool:
+        # Downloads run on the pool (pooled session, timeout and retries from s3_utils);
+        # detection and embedding stay on this thread as images arrive.
+        futures = {}
+        for face in face_data_list:
+            person_id = face.get("person_id")
+            image_url = face.get("imageUrl")
 
-            if image is None:
-                print(f"❌ Invalid image for {person_id}")
+            if not person_id or not image_url:
+                print(f"⚠️ Skipping incomplete entry: {face}")
                 continue
 
-            # Generate embedding
-            embedding = get_face_embedding(image)
-            if embedding is not None:
-                face_data[person_id].append(embedding)
-                print(f"✅ Embedded image for {person_id}")
-            else:
-                print(f"❌ No face detected for {person_id}")
+            futures[pool.submit(download_image_from_s3_url, image_url)] = (person_id, image_url)
 
-        except Exception as e:
-            print(f"⚠️ Error processing {person_id}: {e}")
+        for future in as_completed(futures):
+            person_id, image_url = futures[future]
+            # Queued faces are counted as found or failed when their batch is embedded
+            queued = False
+            try:
+                try:
+                    image = future.result()
+                except requests.exceptions.RequestException:
+                    print(f"❌ Failed to fetch image for {person_id}")
+                    continue
+                except ValueError:
+                    print(f"❌ Invalid image for {person_id}")
+                    continue
 
-    # Average embeddings
-    averaged_data = {}
-    for person_id, embeddings in face_data.items():
-        if embeddings:
-            avg_embedding = np.mean(embeddings, axis=0)
-            averaged_data[person_id] = avg_embedding
-        else:
-            print(f"⚠️ No valid embeddings for {person_id}")
+                face = _training_face(image, detector_backend)
+                if face is None:
+                    print(f"❌ No face detected for {person_id}")
+                    continue
+
+                pending_keys.append((person_id, image_url))
+                pending_faces.append(face)
+                queued = True
+                if len(pending_faces) >= EMBEDDING_MAX_BATCH_SIZE:
+                    flush()
+
+            except Exception as e:
+                print(f"⚠️ Error processing {person_id}: {e}")
+            finally:
+                if progress:
+                    progress(processed=1, failures=int(not queued))
+
+        flush()
+
+    return dict(face_data)
+
+
+def process_faces_from_urls(face_data_list, output_pkl, detector_backend=None, workers=None, progress=None):
+    print("🔍 Starting embedding process from URLs...\n")
+    face_data = embed_faces_from_urls(face_data_list, detector_backend, workers, progress)
 
     os.makedirs(os.path.dirname(output_pkl), exist_ok=True)
 
     try:
-        with open(output_pkl, 'wb') as f:
-            pickle.dump(averaged_data, f)
-            print(f"\n✅ Embeddings saved to: {output_pkl}")
+        # Up to GALLERY_PROTOTYPES prototypes per person plus a calibrated threshold;
+        # a legacy averaged pickle when output_pkl ends in .pkl
+        save_prototype_gallery(output_pkl, face_data)
+        print(f"\n✅ Embeddings saved to: {output_pkl}")
     except Exception as e:
         print(f"❌ Error saving embeddings: {e}")
+
+    # Per-image embeddings, kept so the gallery can be edited incrementally
+    return face_data
@@ -0,0 +1,243 @@
+import os
+import pickle
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+from ann_index import publish_ann_index
+from embeddings import embed_faces_from_urls
+from gallery_cache import invalidate_gallery, gallery_key
+from gallery_format import (GALLERY_SUFFIX, LEGACY_GALLERY_SUFFIX, dumps_gallery, is_gallery_bytes, loads_any,
+                            loads_gallery)
+from prototypes import dumps_prototype_gallery
+from recognize import EmbeddingGallery
+from utils.s3_utils import (upload_bytes_to_s3, download_bytes_from_s3, head_s3_object, put_bytes_if_match,
+                            is_not_found_error, is_precondition_failed)
+
+# Galleries trained before per-image embeddings were kept only have one
+# averaged vector per person; it is carried over under this image key.
+LEGACY_IMAGE_KEY = "__legacy_average__"
+
+# Read-modify-write attempts for an edit that keeps losing to concurrent edits
+ENROLLMENT_WRITE_ATTEMPTS = int(os.environ.get("ENROLLMENT_WRITE_ATTEMPTS", 8))
+
+_gallery_locks = {}
+_gallery_locks_lock = threading.Lock()
+
+
+class ConcurrentEditError(RuntimeError):
+    pass
+
+
+def enrollment_key(gallery_name):
+    return f"{gallery_name}.enrollment{GALLERY_SUFFIX}"
+
+
+def _gallery_lock(bucket_name, gallery_name):
+    # Serializes edits to one gallery within this process, which saves retries;
+    # edits from other processes are caught by the conditional enrollment write
+    with _gallery_locks_lock:
+        return _gallery_locks.setdefault((bucket_name, gallery_name), threading.Lock())
+
+
+def _download_first(bucket_name, s3_keys):
+    """(body, meta, s3_key) of the first of `s3_keys` that exists, or (None, None, None)."""
+    for s3_key in s3_keys:
+        try:
+            body, meta = download_bytes_from_s3(bucket_name, s3_key)
+            return body, meta, s3_key
+        except ClientError as e:
+            if not is_not_found_error(e):
+                raise
+    return None, None, None
+
+
+def _load_enrollment_versioned(bucket_name, gallery_name):
+    """
+    Per-image embeddings plus the ETag of <name>.enrollment.fgal they were read
+    from; the ETag is None when that object does not exist yet (the images then
+    come from a legacy enrollment pickle or the published gallery).
+    """
+    body, meta, s3_key = _download_first(bucket_name, [enrollment_key(gallery_name),
+                                                       f"{gallery_name}.enrollment{LEGACY_GALLERY_SUFFIX}"])
+    if body is not None:
+        etag = meta['ETag'] if s3_key == enrollment_key(gallery_name) else None
+        if not is_gallery_bytes(body):
+            return pickle.loads(body)["images"], etag
+        ids, matrix, row_keys, _, _ = loads_gallery(body)
+        images = {}
+        for person_id, image_key, embedding in zip(ids, row_keys, matrix):
+            images.setdefault(person_id, {})[image_key] = np.array(embedding)
+        return images, etag
+
+    body, _, _ = _download_first(bucket_name, [gallery_key(gallery_name), f"{gallery_name}{LEGACY_GALLERY_SUFFIX}"])
+    if body is None:
+        return {}, None
+    ids, matrix, _, _, _ = loads_any(body)
+    images = {}
+    for person_id, embedding in zip(ids, matrix):
+        # Prototype galleries have several rows per person
+        person_images = images.setdefault(person_id, {})
+        image_key = LEGACY_IMAGE_KEY if not person_images else f"{LEGACY_IMAGE_KEY}{len(person_images)}"
+        person_images[image_key] = np.array(embedding)
+    return images, None
+
+
+def load_enrollment(bucket_name, gallery_name):
+    """Per-image embeddings {person_id: {image_key: embedding}} behind a published gallery."""
+    return _load_enrollment_versioned(bucket_name, gallery_name)[0]
+
+
+def _dumps_enrollment(images):
+    # One float32 row per enrollment image; ids repeat per person and row_keys name the image
+    rows = [(person_id, image_key, embedding)
+            for person_id, person_images in images.items()
+            for image_key, embedding in person_images.items()]
+    ids = [person_id for person_id, _, _ in rows]
+    row_keys = [image_key for _, image_key, _ in rows]
+    matrix = np.stack([embedding for _, _, embedding in rows]) if rows else np.empty((0, 0), dtype=np.float32)
+    return dumps_gallery(ids, matrix, dtype="float32", row_keys=row_keys)
+
+
+def save_enrollment(bucket_name, gallery_name, images):
+    """Unconditionally replaces the stored per-image embeddings (full retraining)."""
+    return upload_bytes_to_s3(_dumps_enrollment(images), bucket_name, enrollment_key(gallery_name))
+
+
+def _publish_gallery(bucket_name, gallery_name, images):
+    body = dumps_prototype_gallery(images)
+    s3_url = upload_bytes_to_s3(body, bucket_name, gallery_key(gallery_name))
+    # Built from the rows the serving EmbeddingGallery will hold, so the fingerprints agree
+    gallery = EmbeddingGallery.from_gallery_data(loads_gallery(body))
+    publish_ann_index(bucket_name, gallery_name, gallery.ids, gallery.matrix)
+    invalidate_gallery(bucket_name, gallery_name)
+    return s3_url
+
+
+def _enrollment_etag(bucket_name, gallery_name):
+    try:
+        return head_s3_object(bucket_name, enrollment_key(gallery_name))['ETag']
+    except ClientError as e:
+        if is_not_found_error(e):
+            return None
+        raise
+
+
+def _edit_enrollment(bucket_name, gallery_name, edit):
+    """
+    Applies `edit(images)` (which changes images in place and returns a summary)
+    as an optimistic read-modify-write of the enrollment: the write only succeeds
+    if nobody changed the enrollment since it was read, otherwise the edit is
+    re-applied to the fresh copy. The gallery is then republished until it was
+    built from the latest enrollment, so a slower publisher of an older version
+    cannot leave it stale.
+    :return: (images, summary, gallery S3 URL).
+    :raises ConcurrentEditError: If the write lost ENROLLMENT_WRITE_ATTEMPTS times in a row.
+    """
+    with _gallery_lock(bucket_name, gallery_name):
+        for attempt in range(ENROLLMENT_WRITE_ATTEMPTS):
+            images, etag = _load_enrollment_versioned(bucket_name, gallery_name)
+            summary = edit(images)
+            try:
+                etag = put_bytes_if_match(_dumps_enrollment(images), bucket_name, enrollment_key(gallery_name), etag)
+                break
+            except ClientError as e:
+                if not is_precondition_failed(e):
+                    raise
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        else:
+            raise ConcurrentEditError(f"Gallery {gallery_name} is being edited concurrently; try again")
+
+        for _ in range(ENROLLMENT_WRITE_ATTEMPTS):
+            s3_url = _publish_gallery(bucket_name, gallery_name, images)
+            latest = _enrollment_etag(bucket_name, gallery_name)
+            if latest == etag:
+                break
+            # A later edit landed; its publisher may have finished before this one
+            images, etag = _load_enrollment_versioned(bucket_name, gallery_name)
+        return images, summary, s3_url
+
+
+def add_faces(bucket_name, gallery_name, face_data_list, detector_backend=None, progress=None):
+    """
+    Embeds only the new [{"person_id", "imageUrl"}, ...] entries and merges them
+    into the published gallery; everyone else keeps their stored embeddings.
+    """
+    new_images = embed_faces_from_urls(face_data_list, detector_backend, progress=progress)
+
+    def edit(images):
+        for person_id, person_images in new_images.items():
+            images.setdefault(person_id, {}).update(person_images)
+
+    images, _, s3_url = _edit_enrollment(bucket_name, gallery_name, edit)
+
+    return {
+        "message": "Gallery updated successfully",
+        "embeddingPath": s3_url,
+        "peopleUpdated": sorted(new_images),
+        "imagesAdded": sum(len(person_images) for person_images in new_images.values()),
+        "peopleCount": len(images),
+    }
+
+
+def _file_name(image_url):
+    return os.path.basename(urlparse(image_url).path)
+
+
+def _match_image_urls(images, image_urls):
+    """
+    {person_id: [image_key, ...]} to remove for `image_urls`, plus the URLs that
+    matched nothing. Images added through add_faces are keyed by URL, but
+    galleries trained from a StudentData folder key them by file name, so a URL
+    also matches a file-name key when exactly one person has that file name.
+    """
+    matches, unmatched = {}, []
+    for image_url in image_urls:
+        owners = [person_id for person_id, person_images in images.items() if image_url in person_images]
+        key = image_url
+        if not owners:
+            key = _file_name(image_url)
+            owners = [person_id for person_id, person_images in images.items() if key in person_images]
+            if len(owners) > 1:  # the same file name under several people is ambiguous
+                owners = []
+        if not owners:
+            unmatched.append(image_url)
+        for person_id in owners:
+            matches.setdefault(person_id, []).append(key)
+    return matches, unmatched
+
+
+def remove_faces(bucket_name, gallery_name, person_ids=(), image_urls=()):
+    """
+    Drops whole people and/or individual enrollment images and republishes the
+    gallery. Image URLs that match no stored image (see _match_image_urls) are
+    returned under "imagesNotFound" instead of being ignored.
+    """
+    def edit(images):
+        removed_people = [person_id for person_id in person_ids if images.pop(person_id, None) is not None]
+        matches, unmatched = _match_image_urls(images, image_urls)
+        removed_images = 0
+        for person_id, image_keys in matches.items():
+            for image_key in set(image_keys):
+                del images[person_id][image_key]
+                removed_images += 1
+            if not images[person_id]:
+                # A person whose last image was removed leaves the gallery
+                del images[person_id]
+                removed_people.append(person_id)
+        return removed_people, removed_images, unmatched
+
+    images, (removed_people, removed_images, unmatched), s3_url = _edit_enrollment(bucket_name, gallery_name, edit)
+
+    return {
+        "message": "Gallery updated successfully",
+        "embeddingPath": s3_url,
+        "peopleRemoved": removed_people,
+        "imagesRemoved": removed_images,
+        "imagesNotFound": unmatched,
+        "peopleCount": len(images),
+    }
@@ -0,0 +1,328 @@
+"""
+Cache of detection and embedding results keyed by image content.
+
+Keys are the SHA-1 of the encoded image bytes (or of a URL plus its ETag, so a
+cached image is revalidated with a conditional GET instead of downloaded), salted with a pipeline version
+that changes whenever a setting affecting boxes or embeddings changes.
+Entries hold the located boxes, their keypoints and, once computed, the
+FaceNet embeddings of the kept crops; re-classifying an image against a new
+gallery then only costs the matrix match.
+
+The memory tier is an LRU bounded by FACE_CACHE_MAX_BYTES. Setting
+FACE_CACHE_DIR adds a disk tier of .npz files shared by the workers on a
+host, trimmed oldest-first to FACE_CACHE_DISK_MAX_BYTES.
+"""
+import os
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from embeddings import embed_aligned_faces
+from face_utils import (locate_faces, crop_faces, DETECT_MAX_EDGE, DETECT_TILE_SIZE, DETECT_TILE_OVERLAP,
+                        DETECT_MERGE_IOU, FACE_SHARPEN)
+from metrics import increment
+from model_registry import YOLO_MODEL_PATH
+from utils.image_utils import decode_for_detection, IMAGE_DECODE_MAX_EDGE
+from utils.s3_utils import download_url_if_changed
+
+FACE_CACHE_ENABLED = os.environ.get("FACE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Memory tier size; an analysis stored under several keys (URL and content) counts once
+FACE_CACHE_MAX_BYTES = int(os.environ.get("FACE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# Empty disables the disk tier
+FACE_CACHE_DIR = os.environ.get("FACE_CACHE_DIR", "")
+FACE_CACHE_DISK_MAX_BYTES = int(os.environ.get("FACE_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024))
+# Bump to drop every cached result, e.g. after swapping model weights in place
+FACE_CACHE_VERSION = os.environ.get("FACE_CACHE_VERSION", "1")
+# URLs whose last seen ETag is remembered for conditional GETs
+FACE_CACHE_URL_ETAGS = int(os.environ.get("FACE_CACHE_URL_ETAGS", 10000))
+
+PIPELINE_VERSION = hashlib.sha1(repr((
+    FACE_CACHE_VERSION, YOLO_MODEL_PATH, IMAGE_DECODE_MAX_EDGE, DETECT_MAX_EDGE, DETECT_TILE_SIZE,
+    DETECT_TILE_OVERLAP, DETECT_MERGE_IOU, FACE_SHARPEN,
+)).encode("utf-8")).hexdigest()[:12]
+
+
+class FaceAnalysis:
+    """Located boxes (N, 4), keypoints (N, K, 2) or None, and embeddings of the kept crops or None."""
+
+    def __init__(self, boxes, points=None, embeddings=None):
+        self.boxes = boxes
+        self.points = points
+        self.embeddings = embeddings
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.boxes, self.points, self.embeddings) if a is not None)
+
+    def dumps(self):
+        out = io.BytesIO()
+        arrays = {"boxes": self.boxes}
+        if self.points is not None:
+            arrays["points"] = self.points
+        if self.embeddings is not None:
+            arrays["embeddings"] = self.embeddings
+        np.savez(out, **arrays)
+        return out.getvalue()
+
+    @classmethod
+    def loads(cls, body):
+        with np.load(io.BytesIO(body), allow_pickle=False) as data:
+            return cls(data["boxes"], data["points"] if "points" in data else None,
+                       data["embeddings"] if "embeddings" in data else None)
+
+
+def content_key(data):
+    return hashlib.sha1(PIPELINE_VERSION.encode("utf-8") + bytes(data)).hexdigest()
+
+
+def etag_key(url, etag):
+    return hashlib.sha1(f"{PIPELINE_VERSION}\0{url}\0{etag}".encode("utf-8")).hexdigest()
+
+
+class FaceResultCache:
+    def __init__(self, max_bytes=FACE_CACHE_MAX_BYTES, cache_dir=FACE_CACHE_DIR, disk_max_bytes=FACE_CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        # id(analysis) -> number of keys holding it; one analysis is often stored under
+        # both its URL and its content key, and its bytes count once
+        self._refs = {}
+        self._bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            analysis = self._entries.get(key)
+            if analysis is not None:
+                self._entries.move_to_end(key)
+                return analysis
+        analysis = self._read_disk(key)
+        if analysis is not None:
+            self._store(key, analysis)
+        return analysis
+
+    def put(self, key, analysis):
+        self._store(key, analysis)
+        self._write_disk(key, analysis)
+
+    def clear(self):
+        """Empties the memory tier; the disk tier is left to its own eviction."""
+        with self._lock:
+            self._entries.clear()
+            self._refs.clear()
+            self._bytes = 0
+
+    def _store(self, key, analysis):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._release(old)
+            self._entries[key] = analysis
+            if self._refs.get(id(analysis), 0) == 0:
+                self._bytes += analysis.nbytes
+            self._refs[id(analysis)] = self._refs.get(id(analysis), 0) + 1
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._release(evicted)
+
+    def _release(self, analysis):
+        # Called with self._lock held
+        count = self._refs.pop(id(analysis)) - 1
+        if count:
+            self._refs[id(analysis)] = count
+        else:
+            self._bytes -= analysis.nbytes
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npz")
+
+    def _read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                body = f.read()
+            os.utime(path)  # recently used files are evicted last
+            return FaceAnalysis.loads(body)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ Ignoring unreadable face cache entry {path}: {e}")
+            return None
+
+    def _write_disk(self, key, analysis):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        body = analysis.dumps()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+            with open(tmp_path, "wb") as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ Could not write face cache entry {path}: {e}")
+            return
+        with self._disk_lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, _, size in self._disk_files())
+            else:
+                self._disk_bytes += len(body)
+            if self._disk_bytes > self.disk_max_bytes:
+                self._trim_disk()
+
+    def _disk_files(self):
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".npz"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_mtime, stat.st_size
+
+    def _trim_disk(self):
+        # Other workers write to the same directory, so rescan instead of trusting the running total
+        files = sorted(self._disk_files(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in files)
+        target = int(self.disk_max_bytes * 0.9)
+        for path, _, size in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._disk_bytes = total
+
+
+face_cache = FaceResultCache()
+
+
+def _as_keys(keys):
+    if not FACE_CACHE_ENABLED or not keys:
+        return ()
+    return (keys,) if isinstance(keys, str) else tuple(k for k in keys if k)
+
+
+def _lookup(keys):
+    if not keys:
+        return None
+    for key in keys:
+        analysis = face_cache.get(key)
+        if analysis is not None:
+            increment("faceapp_face_cache_lookups_total", result="hit")
+            return analysis
+    increment("faceapp_face_cache_lookups_total", result="miss")
+    return None
+
+
+def locate_faces_cached(image, keys=None, preview=None):
+    """locate_faces, reusing the boxes stored under `keys` when there are any."""
+    keys = _as_keys(keys)
+    analysis = _lookup(keys)
+    if analysis is not None:
+        return analysis.boxes, analysis.points
+    boxes, points = locate_faces(image, preview)
+    for key in keys:
+        face_cache.put(key, FaceAnalysis(boxes, points))
+    return boxes, points
+
+
+def analyze_image(image, keys=None, cached=None, preview=None):
+    """
+    Boxes and FaceNet embeddings for every face in `image`, served from the
+    cache when one of `keys` (a key or a list of them) was analyzed before;
+    the result is stored under all of them. `cached` is an analysis already
+    taken from the cache (see fetch_image_for_analysis); `image` may then be None.
+    `preview` is an optional reduced decode of `image` used only for detection.
+    """
+    if cached is not None and cached.embeddings is not None:
+        increment("faceapp_face_cache_lookups_total", result="hit")
+        return cached
+    keys = _as_keys(keys)
+    analysis = _lookup(keys)
+    if analysis is not None and analysis.embeddings is not None:
+        return analysis
+    if analysis is None:
+        boxes, points = locate_faces(image, preview)
+    else:
+        # Detected earlier (e.g. by the selfie upload route); only embed
+        boxes, points = analysis.boxes, analysis.points
+    faces, landmarks = crop_faces(image, boxes, points, rgb=True)
+    analysis = FaceAnalysis(boxes, points, embed_aligned_faces(faces, landmarks, is_rgb=True))
+    for key in keys:
+        face_cache.put(key, analysis)
+    return analysis
+
+
+_url_etags = OrderedDict()
+_url_etags_lock = threading.Lock()
+
+
+def _known_etag(image_url):
+    with _url_etags_lock:
+        etag = _url_etags.get(image_url)
+        if etag is not None:
+            _url_etags.move_to_end(image_url)
+        return etag
+
+
+def _remember_etag(image_url, etag):
+    with _url_etags_lock:
+        _url_etags[image_url] = etag
+        _url_etags.move_to_end(image_url)
+        while len(_url_etags) > FACE_CACHE_URL_ETAGS:
+            _url_etags.popitem(last=False)
+
+
+def fetch_image_for_analysis(image_url):
+    """
+    Prefetch step for analyze_image: returns (keys, image, cached, preview). When
+    the URL's ETag or the downloaded content is already cached, `cached` is that
+    FaceAnalysis and image is None; pass all of them on to analyze_image, so an
+    entry evicted in the meantime is not needed again.
+    A URL seen before is fetched with a conditional GET on its last ETag, and
+    a first-time URL with a plain GET; neither needs a separate HEAD.
+    :raises requests.exceptions.RequestException: If the image cannot be downloaded.
+    :raises ValueError: If the image cannot be decoded.
+    """
+    known_etag, cached = None, None
+    if FACE_CACHE_ENABLED:
+        known_etag = _known_etag(image_url)
+        if known_etag:
+            cached = face_cache.get(etag_key(image_url, known_etag))
+            if cached is None or cached.embeddings is None:
+                # Nothing to reuse on a 304, so ask for the body
+                known_etag, cached = None, None
+
+    data, etag = download_url_if_changed(image_url, known_etag)
+    if data is None:  # 304 Not Modified
+        return [etag_key(image_url, known_etag)], None, cached, None
+
+    url_key = None
+    if FACE_CACHE_ENABLED and etag:
+        url_key = etag_key(image_url, etag)
+        _remember_etag(image_url, etag)
+    keys = [url_key, content_key(data)]
+    if FACE_CACHE_ENABLED:
+        # The same image may be cached under another URL or an older ETag
+        cached = face_cache.get(keys[1])
+        if cached is not None and cached.embeddings is not None:
+            if url_key:
+                face_cache.put(url_key, cached)
+            return keys, None, cached, None
+    image, preview = decode_for_detection(data)
+    if image is None:
+        raise ValueError(f"Could not decode image from URL: {image_url}")
+    return keys, image, None, preview
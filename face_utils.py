@@ -1,37 +1,184 @@
+import os
 import numpy as np
 import cv2
-from keras_facenet import FaceNet
-from ultralytics import YOLO
-from embeddings import get_face_embedding
-from recognize import recognize_face
-import os
-import uuid
-from flask import url_for
-
-facenet_model = FaceNet()
-YOLO_MODEL_PATH = "models\yolov8n-face-lindevs.pt"  # Path to your YOLO model
-yolo_model = YOLO(YOLO_MODEL_PATH)
+from model_registry import get_model
+from inference_server import remote_inference_enabled, get_inference_client
+from batching import MicroBatcher, MICROBATCH_ENABLED, MICROBATCH_MAX_DETECT_BATCH
+from utils.image_utils import resize_to_max_edge, tile_windows, merge_boxes
+from metrics import timed
 
 # UNKNOWN_DIR = "Unknown_Faces"
 # os.makedirs(UNKNOWN_DIR, exist_ok=True)
 
-def detect_and_crop_faces(image):
-    results = yolo_model(image)
-    boxes = results[0].boxes.xyxy.cpu().numpy().astype(int)
-    faces = []
-    for box in boxes:
-        x1, y1, x2, y2 = box
-        margin_x = int((x2 - x1) * 0.2)
-        margin_y = int((y2 - y1) * 0.2)
-        sx = max(0, x1 - margin_x)
-        sy = max(0, y1 - margin_y)
-        ex = min(image.shape[1], x2 + margin_x)
-        ey = min(image.shape[0], y2 + margin_y)
-        face = image[sy:ey, sx:ex]
-        if face.size == 0:
-            continue
-        face = cv2.resize(face, (160, 160), interpolation=cv2.INTER_CUBIC)
-        kernel = np.array([[0, -1, 0], [-1, 5,-1], [0, -1, 0]])
-        face = cv2.filter2D(face, -1, kernel)
-        faces.append(face)
+# FaceNet input size and the context kept around each YOLO box
+FACE_SIZE = 160
+FACE_CROP_MARGIN = 0.2
+# Unsharp the resized crops (on by default, as before)
+FACE_SHARPEN = os.environ.get("FACE_SHARPEN", "true").lower() in ("1", "true", "yes")
+_SHARPEN_KERNEL = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]], dtype=np.float32)
+
+# Detection runs on a copy downscaled to this long edge (0 = as uploaded);
+# boxes are mapped back and crops are cut from the full-resolution image.
+DETECT_MAX_EDGE = int(os.environ.get("DETECT_MAX_EDGE", 1280))
+# Images whose long edge exceeds this are also searched in overlapping tiles of
+# this size, so small faces in large group photos survive YOLO's letterbox.
+# 0 disables tiling.
+DETECT_TILE_SIZE = int(os.environ.get("DETECT_TILE_SIZE", 0))
+DETECT_TILE_OVERLAP = float(os.environ.get("DETECT_TILE_OVERLAP", 0.2))
+DETECT_MERGE_IOU = float(os.environ.get("DETECT_MERGE_IOU", 0.5))
+
+def _parse_result(result):
+    boxes = result.boxes.xyxy.cpu().numpy().astype(int)
+    # Face-pose YOLO weights also return 5 facial keypoints per box; plain
+    # detection weights do not, in which case no landmarks are reported.
+    keypoints = result.keypoints
+    points = keypoints.xy.cpu().numpy() if keypoints is not None else None
+    return boxes, points
+
+
+# One YOLO forward pass over images from several concurrent requests
+def _detect_faces_batch(images):
+    return [_parse_result(result) for result in get_model("yolo")(images)]
+
+
+_detect_batcher = MicroBatcher(_detect_faces_batch, MICROBATCH_MAX_DETECT_BATCH, name="yolo-microbatch")
+
+
+# YOLO boxes as an (N, 4) int array of x1, y1, x2, y2, plus (N, K, 2)
+# keypoints or None. Runs on the inference server when one is configured,
+# and is coalesced with concurrent requests when MICROBATCH_ENABLED is set.
+@timed("yolo")
+def detect_faces(image):
+    if remote_inference_enabled():
+        return get_inference_client().detect(image)
+    if MICROBATCH_ENABLED:
+        return _detect_batcher.submit(image)
+    return _parse_result(get_model("yolo")(image)[0])
+
+
+@timed("yolo")
+def detect_faces_many(images):
+    """detect_faces for several images at once, e.g. the tiles of one photo."""
+    if remote_inference_enabled():
+        client = get_inference_client()
+        return [client.detect(image) for image in images]
+    if MICROBATCH_ENABLED:
+        # Queued together, so the tiles share batches instead of each waiting out MICROBATCH_MAX_WAIT_MS
+        return _detect_batcher.submit_many(images)
+    results = []
+    for start in range(0, len(images), MICROBATCH_MAX_DETECT_BATCH):
+        results.extend(_detect_faces_batch(images[start:start + MICROBATCH_MAX_DETECT_BATCH]))
+    return results
+
+
+def _downscaled(image, max_edge, preview=None):
+    # `preview` is a reduced decode of `image`, used instead of resizing `image`
+    return resize_to_max_edge(image if preview is None else preview, max_edge)[0]
+
+
+def _map_back(image, small, boxes, points):
+    scale = np.array([small.shape[1] / image.shape[1], small.shape[0] / image.shape[0]])
+    if np.any(scale != 1.0):
+        boxes = np.round(boxes / np.tile(scale, 2)).astype(int)
+        points = points / scale if points is not None else None
+    return boxes, points
+
+
+def _detect_scaled(image, max_edge, preview=None):
+    small = _downscaled(image, max_edge, preview)
+    return _map_back(image, small, *detect_faces(small))
+
+
+def _detect_tiled(image, preview=None):
+    height, width = image.shape[:2]
+    windows = tile_windows(width, height, DETECT_TILE_SIZE, DETECT_TILE_OVERLAP)
+    # A downscaled whole-image pass finds faces larger than a tile; it is detected along with the tiles
+    small = _downscaled(image, DETECT_MAX_EDGE, preview)
+    results = detect_faces_many([small] + [image[y1:y2, x1:x2] for x1, y1, x2, y2 in windows])
+
+    all_boxes, all_points = [], []
+    boxes, points = _map_back(image, small, *results[0])
+    if len(boxes):
+        all_boxes.append(boxes)
+        all_points.append(points)
+    for (x1, y1, _, _), (boxes, points) in zip(windows, results[1:]):
+        if len(boxes):
+            all_boxes.append(boxes + (x1, y1, x1, y1))
+            all_points.append(points + (x1, y1) if points is not None else None)
+    if not all_boxes:
+        return np.empty((0, 4), dtype=int), None
+
+    boxes = np.concatenate(all_boxes).astype(int)
+    keep = merge_boxes(boxes, DETECT_MERGE_IOU)
+    points = None
+    if all(p is not None for p in all_points):
+        points = np.concatenate(all_points)[keep]
+    return boxes[keep], points
+
+
+def locate_faces(image, preview=None):
+    """
+    detect_faces under the downscaling/tiling policy; coordinates refer to `image`.
+    `preview` is an optional reduced decode of `image` (see image_utils.decode_for_detection)
+    used for the whole-image pass instead of resizing `image`; tiles always come from `image`.
+    """
+    if DETECT_TILE_SIZE and max(image.shape[:2]) > DETECT_TILE_SIZE:
+        return _detect_tiled(image, preview)
+    return _detect_scaled(image, DETECT_MAX_EDGE, preview)
+
+
+@timed("crop")
+def crop_faces(image, boxes, points=None, rgb=False, sharpen=None):
+    """
+    Crops every box (plus FACE_CROP_MARGIN) into one preallocated
+    (N, FACE_SIZE, FACE_SIZE, 3) uint8 batch, BGR or RGB, and returns it with
+    per-face keypoints mapped into crop coordinates (or None). Empty boxes are
+    dropped.
+    """
+    sharpen = FACE_SHARPEN if sharpen is None else sharpen
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    height, width = image.shape[:2]
+
+    # Margins and clipping for all boxes at once
+    margins = ((boxes[:, 2:] - boxes[:, :2]) * FACE_CROP_MARGIN).astype(np.int64)
+    starts = np.maximum(boxes[:, :2] - margins, 0)
+    ends = np.minimum(boxes[:, 2:] + margins, (width, height))
+    keep = np.flatnonzero(np.all(ends > starts, axis=1))
+
+    batch = np.empty((len(keep), FACE_SIZE, FACE_SIZE, 3), dtype=np.uint8)
+    for out, i in enumerate(keep):
+        (sx, sy), (ex, ey) = starts[i], ends[i]
+        cv2.resize(image[sy:ey, sx:ex], (FACE_SIZE, FACE_SIZE), dst=batch[out], interpolation=cv2.INTER_CUBIC)
+        if sharpen:
+            cv2.filter2D(batch[out], -1, _SHARPEN_KERNEL, dst=batch[out])
+    if rgb and len(batch):
+        # One conversion over the whole batch viewed as a single tall image
+        flat = batch.reshape(-1, FACE_SIZE, 3)
+        cv2.cvtColor(flat, cv2.COLOR_BGR2RGB, dst=flat)
+
+    landmarks = [None] * len(keep)
+    if points is not None:
+        scales = FACE_SIZE / (ends[keep] - starts[keep]).astype(np.float64)
+        for out, i in enumerate(keep):
+            if len(points[i]) >= 2:
+                landmarks[out] = (points[i] - starts[i]) * scales[out]
+    return batch, landmarks
+
+
+def detect_and_crop_faces(image, return_landmarks=False, sharpen=None):
+    """BGR 160x160 crops of every detected face, as a list (used for uploads and training)."""
+    boxes, points = locate_faces(image)
+    batch, landmarks = crop_faces(image, boxes, points, sharpen=sharpen)
+    faces = list(batch)
+    if return_landmarks:
+        return faces, landmarks
     return faces
+
+
+def detect_face_batch(image, sharpen=None):
+    """
+    Detected faces as an (N, 160, 160, 3) RGB batch ready for FaceNet, plus
+    per-face landmarks; pass both to embed_aligned_faces(..., is_rgb=True).
+    """
+    boxes, points = locate_faces(image)
+    return crop_faces(image, boxes, points, rgb=True, sharpen=sharpen)
@@ -0,0 +1,197 @@
+import os
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from ann_index import ANN_MIN_GALLERY_SIZE, ann_key, loads_index
+from gallery_format import GALLERY_SUFFIX, LEGACY_GALLERY_SUFFIX, is_gallery_bytes, loads_any, read_gallery
+from metrics import timed
+from recognize import EmbeddingGallery
+from utils.s3_utils import head_s3_object, download_bytes_from_s3, is_not_found_error
+
+# Total size of the galleries kept in memory per process
+GALLERY_CACHE_MAX_BYTES = int(os.environ.get("GALLERY_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Within this window a cached gallery is served without asking S3 whether it changed.
+# invalidate_gallery only reaches the local process, so other workers can serve a
+# republished gallery's old version for this long; 0 sends a HEAD on every request.
+GALLERY_CACHE_REVALIDATE_SECONDS = float(os.environ.get("GALLERY_CACHE_REVALIDATE_SECONDS", 0))
+# .fgal galleries are written here and memory-mapped, so workers on one host
+# share their pages through the OS page cache. Empty disables the disk copy.
+GALLERY_CACHE_DIR = os.environ.get("GALLERY_CACHE_DIR", "/tmp/gallery_cache")
+
+
+class GalleryNotFoundError(LookupError):
+    pass
+
+
+class _Entry:
+    def __init__(self, gallery, s3_key, etag, last_modified, checked_at):
+        self.gallery = gallery
+        self.s3_key = s3_key
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked_at = checked_at
+        self.nbytes = gallery.nbytes
+
+
+def gallery_key(gallery_name):
+    return f"{gallery_name}{GALLERY_SUFFIX}"
+
+
+def load_gallery_bytes(body, bucket_name=None, s3_key=None, etag=None):
+    """EmbeddingGallery from .fgal or legacy .pkl bytes; .fgal is memory-mapped via GALLERY_CACHE_DIR."""
+    if GALLERY_CACHE_DIR and s3_key and is_gallery_bytes(body):
+        return EmbeddingGallery.from_gallery_data(read_gallery(_spill(body, bucket_name, s3_key, etag)))
+    return EmbeddingGallery.from_gallery_data(loads_any(body))
+
+
+def _spill(body, bucket_name, s3_key, etag):
+    # One file per object version; older versions of the same object are removed
+    os.makedirs(GALLERY_CACHE_DIR, exist_ok=True)
+    prefix = hashlib.sha1(f"{bucket_name}/{s3_key}".encode("utf-8")).hexdigest()
+    version = hashlib.sha1(str(etag).encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(GALLERY_CACHE_DIR, f"{prefix}-{version}{GALLERY_SUFFIX}")
+    if not os.path.exists(path):
+        tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        for name in os.listdir(GALLERY_CACHE_DIR):
+            if name.startswith(f"{prefix}-") and name.endswith(GALLERY_SUFFIX) and name != os.path.basename(path):
+                try:
+                    os.remove(os.path.join(GALLERY_CACHE_DIR, name))
+                except OSError:
+                    pass
+    return path
+
+
+class GalleryCache:
+    """
+    Process-wide LRU cache of EmbeddingGallery objects keyed by (bucket, gallery name).
+    A gallery name is the S3 key without extension; <name>.fgal is preferred and
+    <name>.pkl is read for galleries published before the binary format.
+    Entries are revalidated against the S3 object's ETag/LastModified, so a
+    gallery is only downloaded and deserialized again after it is republished.
+    """
+
+    def __init__(self, max_bytes=GALLERY_CACHE_MAX_BYTES, revalidate_seconds=GALLERY_CACHE_REVALIDATE_SECONDS):
+        self.max_bytes = max_bytes
+        self.revalidate_seconds = revalidate_seconds
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def get(self, bucket_name, gallery_name):
+        cache_key = (bucket_name, gallery_name)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(cache_key, threading.Lock())
+
+        try:
+            return self._get(cache_key, key_lock, bucket_name, gallery_name)
+        except GalleryNotFoundError:
+            # Drops the key's lock too, now that it is released
+            self.invalidate(bucket_name, gallery_name)
+            raise
+
+    def _get(self, cache_key, key_lock, bucket_name, gallery_name):
+        # One loader per key; concurrent requests for the same gallery wait for it
+        with key_lock:
+            entry = self._lookup(cache_key)
+            now = time.monotonic()
+            if entry is not None:
+                if now - entry.checked_at < self.revalidate_seconds:
+                    return entry.gallery
+                # A legacy .pkl entry is stale as soon as a .fgal is published next to it,
+                # even though the .pkl itself never changes
+                superseded = (entry.s3_key != gallery_key(gallery_name)
+                              and self._head(bucket_name, gallery_key(gallery_name)) is not None)
+                meta = None if superseded else self._head(bucket_name, entry.s3_key)
+                if meta is not None and meta['ETag'] == entry.etag and meta['LastModified'] == entry.last_modified:
+                    entry.checked_at = now
+                    return entry.gallery
+
+            s3_key, body, meta = self._download(bucket_name, gallery_name)
+            gallery = load_gallery_bytes(body, bucket_name, s3_key, meta['ETag'])
+            if len(gallery) >= ANN_MIN_GALLERY_SIZE:
+                self._attach_index(gallery, bucket_name, gallery_name)
+            self._store(cache_key, _Entry(gallery, s3_key, meta['ETag'], meta['LastModified'], now))
+            return gallery
+
+    def invalidate(self, bucket_name, gallery_name):
+        with self._lock:
+            entry = self._entries.pop((bucket_name, gallery_name), None)
+            if entry is not None:
+                self._bytes -= entry.nbytes
+            self._drop_key_lock((bucket_name, gallery_name))
+
+    def _head(self, bucket_name, s3_key):
+        try:
+            return head_s3_object(bucket_name, s3_key)
+        except ClientError as e:
+            if is_not_found_error(e):
+                return None
+            raise
+
+    def _download(self, bucket_name, gallery_name):
+        for s3_key in (gallery_key(gallery_name), f"{gallery_name}{LEGACY_GALLERY_SUFFIX}"):
+            try:
+                body, meta = download_bytes_from_s3(bucket_name, s3_key)
+                return s3_key, body, meta
+            except ClientError as e:
+                if not is_not_found_error(e):
+                    raise
+        raise GalleryNotFoundError(f"Gallery s3://{bucket_name}/{gallery_name} not found")
+
+    def _attach_index(self, gallery, bucket_name, gallery_name):
+        # A missing or stale index just means exact search
+        try:
+            body, _ = download_bytes_from_s3(bucket_name, ann_key(gallery_name))
+        except ClientError as e:
+            if is_not_found_error(e):
+                return
+            raise
+        if not gallery.attach_index(loads_index(body)):
+            print(f"⚠️ Ignoring stale ANN index for {gallery_name}")
+
+    def _lookup(self, cache_key):
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                self._entries.move_to_end(cache_key)
+            return entry
+
+    def _store(self, cache_key, entry):
+        with self._lock:
+            old = self._entries.pop(cache_key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[cache_key] = entry
+            self._bytes += entry.nbytes
+            # Evict least recently used galleries, but always keep the newest one
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self._drop_key_lock(evicted_key)
+
+    def _drop_key_lock(self, cache_key):
+        # Called with self._lock held. A lock that is in use stays; dropping one a
+        # thread is about to take at worst lets two threads load the same gallery.
+        key_lock = self._key_locks.get(cache_key)
+        if key_lock is not None and not key_lock.locked():
+            del self._key_locks[cache_key]
+
+
+gallery_cache = GalleryCache()
+
+
+@timed("gallery_load")
+def get_gallery(bucket_name, gallery_name):
+    return gallery_cache.get(bucket_name, gallery_name)
+
+
+def invalidate_gallery(bucket_name, gallery_name):
+    gallery_cache.invalidate(bucket_name, gallery_name)
@@ -0,0 +1,259 @@
+"""
+Binary gallery format (.fgal) replacing pickled {person_id: np.ndarray} dicts.
+
+Layout (little-endian):
+    magic       4 bytes   b"FGAL"
+    version     uint16
+    header_len  uint32
+    header      UTF-8 JSON: dtype, count, dim, ids (the ID table), row_keys,
+                meta, scales_offset, data_offset
+    padding     up to a 64-byte boundary
+    scales      float32[count]          (int8 galleries only)
+    matrix      dtype[count, dim]       (contiguous, row i belongs to ids[i])
+
+float32 galleries are read zero-copy through np.memmap (or np.frombuffer for
+in-memory bytes); float16 and int8 galleries are widened to float32 on load.
+Unlike pickle, reading a gallery never executes code from the bucket.
+"""
+import argparse
+import io
+import json
+import os
+import pickle
+import struct
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+MAGIC = b"FGAL"
+FORMAT_VERSION = 1
+GALLERY_SUFFIX = ".fgal"
+LEGACY_GALLERY_SUFFIX = ".pkl"
+_ALIGNMENT = 64
+_PREAMBLE = struct.Struct("<4sHI")
+_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+# Storage precision for newly written galleries
+GALLERY_STORAGE_DTYPE = os.environ.get("GALLERY_STORAGE_DTYPE", "float32")
+
+GalleryData = namedtuple("GalleryData", ["ids", "matrix", "row_keys", "meta", "dtype"])
+
+
+class GalleryFormatError(ValueError):
+    pass
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _quantize_int8(matrix):
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def dumps_gallery(ids, matrix, dtype=None, row_keys=None, meta=None):
+    """Serializes an (N, D) embedding matrix and its aligned ids to .fgal bytes."""
+    dtype = dtype or GALLERY_STORAGE_DTYPE
+    if dtype not in _DTYPES:
+        raise GalleryFormatError(f"Unsupported gallery dtype: {dtype}")
+    ids = list(ids)
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim != 2:
+        matrix = matrix.reshape(len(ids), -1)
+    if row_keys is not None and len(row_keys) != len(ids):
+        raise GalleryFormatError("row_keys must have one entry per row")
+
+    scales = None
+    if dtype == "int8":
+        data, scales = _quantize_int8(matrix)
+    else:
+        data = matrix.astype(_DTYPES[dtype])
+
+    header = {
+        "dtype": dtype,
+        "count": len(ids),
+        "dim": int(matrix.shape[1]),
+        "ids": ids,
+        "row_keys": list(row_keys) if row_keys is not None else None,
+        "meta": meta or {},
+    }
+    # Offsets depend on the header length, which depends on the offsets;
+    # reserve room for them and settle on a fixed point.
+    header["scales_offset"] = header["data_offset"] = 0
+    while True:
+        encoded = json.dumps(header).encode("utf-8")
+        scales_offset = _align(_PREAMBLE.size + len(encoded))
+        data_offset = _align(scales_offset + scales.nbytes) if scales is not None else scales_offset
+        wanted = (scales_offset if scales is not None else None, data_offset)
+        if (header["scales_offset"], header["data_offset"]) == wanted:
+            break
+        header["scales_offset"], header["data_offset"] = wanted
+
+    out = io.BytesIO()
+    out.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+    out.write(encoded)
+    if scales is not None:
+        out.write(b"\0" * (scales_offset - out.tell()))
+        out.write(scales.tobytes())
+    out.write(b"\0" * (data_offset - out.tell()))
+    out.write(np.ascontiguousarray(data).tobytes())
+    return out.getvalue()
+
+
+def write_file_atomic(path, body):
+    """Writes `body` next to `path` and renames it into place, so a crash or full disk never leaves a truncated file."""
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_gallery(path, ids, matrix, dtype=None, row_keys=None, meta=None):
+    write_file_atomic(path, dumps_gallery(ids, matrix, dtype, row_keys, meta))
+
+
+def _read_header(buffer):
+    if len(buffer) < _PREAMBLE.size:
+        raise GalleryFormatError("Truncated gallery file")
+    magic, version, header_len = _PREAMBLE.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise GalleryFormatError("Not a gallery file")
+    if version > FORMAT_VERSION:
+        raise GalleryFormatError(f"Gallery format version {version} is newer than supported ({FORMAT_VERSION})")
+    return json.loads(bytes(buffer[_PREAMBLE.size:_PREAMBLE.size + header_len]).decode("utf-8"))
+
+
+def _to_float32(header, data, scales):
+    if header["dtype"] == "float32":
+        return data
+    if header["dtype"] == "int8":
+        return data.astype(np.float32) * scales[:, None]
+    return data.astype(np.float32)
+
+
+def _gallery_data(header, matrix):
+    return GalleryData(header["ids"], matrix, header.get("row_keys"), header.get("meta") or {}, header["dtype"])
+
+
+def loads_gallery(body):
+    """Reads .fgal bytes; float32 matrices are a zero-copy view of `body`."""
+    header = _read_header(body)
+    count, dim = header["count"], header["dim"]
+    dtype = _DTYPES[header["dtype"]]
+    scales = None
+    if header["dtype"] == "int8":
+        scales = np.frombuffer(body, dtype="<f4", count=count, offset=header["scales_offset"])
+    data = np.frombuffer(body, dtype=np.dtype(dtype).newbyteorder("<"), count=count * dim,
+                         offset=header["data_offset"]).reshape(count, dim)
+    return _gallery_data(header, _to_float32(header, data, scales))
+
+
+def read_gallery(path, mmap=True):
+    """Reads a .fgal file; with mmap=True float32 matrices are mapped, not loaded."""
+    if not mmap:
+        with open(path, "rb") as f:
+            return loads_gallery(f.read())
+
+    with open(path, "rb") as f:
+        preamble = f.read(_PREAMBLE.size)
+        header_len = _PREAMBLE.unpack(preamble)[2] if len(preamble) == _PREAMBLE.size else 0
+        header = _read_header(preamble + f.read(header_len))
+    count, dim = header["count"], header["dim"]
+    if count == 0:
+        return _gallery_data(header, np.empty((0, dim), dtype=np.float32))
+
+    scales = None
+    if header["dtype"] == "int8":
+        scales = np.memmap(path, dtype="<f4", mode="r", offset=header["scales_offset"], shape=(count,))
+    data = np.memmap(path, dtype=np.dtype(_DTYPES[header["dtype"]]).newbyteorder("<"), mode="r",
+                     offset=header["data_offset"], shape=(count, dim))
+    return _gallery_data(header, _to_float32(header, data, scales))
+
+
+def is_gallery_bytes(body):
+    return bytes(body[:len(MAGIC)]) == MAGIC
+
+
+def _dict_rows(known_embeddings):
+    ids = list(known_embeddings.keys())
+    if not ids:
+        return ids, np.empty((0, 0), dtype=np.float32)
+    return ids, np.stack([np.asarray(known_embeddings[i], dtype=np.float32).ravel() for i in ids])
+
+
+def dumps_known_embeddings(known_embeddings, dtype=None):
+    """.fgal bytes for a {person_id: embedding} dict, rows L2-normalized for matching."""
+    ids, matrix = _dict_rows(known_embeddings)
+    if matrix.size:
+        matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return dumps_gallery(ids, matrix, dtype=dtype, meta={"normalized": True})
+
+
+def save_known_embeddings(path, known_embeddings, dtype=None):
+    """Writes a {person_id: embedding} dict as .fgal, or as a legacy pickle for .pkl paths."""
+    if path.endswith(LEGACY_GALLERY_SUFFIX):
+        body = pickle.dumps(known_embeddings)
+    else:
+        body = dumps_known_embeddings(known_embeddings, dtype)
+    write_file_atomic(path, body)
+
+
+def loads_legacy_pickle(body):
+    """Reads a legacy pickled {person_id: embedding} dict. Only use on trusted artifacts."""
+    ids, matrix = _dict_rows(pickle.loads(body))
+    return GalleryData(ids, matrix, None, {}, "float32")
+
+
+def loads_any(body):
+    """Reads either format, so galleries published before .fgal keep working."""
+    if is_gallery_bytes(body):
+        return loads_gallery(body)
+    return loads_legacy_pickle(body)
+
+
+def convert_pickle_bytes(body, dtype=None):
+    return dumps_known_embeddings(pickle.loads(body), dtype)
+
+
+def convert_file(src_path, dst_path=None, dtype=None):
+    dst_path = dst_path or os.path.splitext(src_path)[0] + GALLERY_SUFFIX
+    with open(src_path, "rb") as f:
+        body = convert_pickle_bytes(f.read(), dtype)
+    write_file_atomic(dst_path, body)
+    return dst_path
+
+
+def convert_s3_object(bucket_name, s3_key, dtype=None):
+    """Converts s3://bucket/<name>.pkl in place to s3://bucket/<name>.fgal."""
+    from utils.s3_utils import download_bytes_from_s3, upload_bytes_to_s3
+
+    body, _ = download_bytes_from_s3(bucket_name, s3_key)
+    dst_key = os.path.splitext(s3_key)[0] + GALLERY_SUFFIX
+    return upload_bytes_to_s3(convert_pickle_bytes(body, dtype), bucket_name, dst_key)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert pickled galleries to the .fgal format.")
+    parser.add_argument("paths", nargs="+", help="Local .pkl files, or S3 keys with --bucket")
+    parser.add_argument("--bucket", help="Convert S3 objects in this bucket instead of local files")
+    parser.add_argument("--dtype", choices=sorted(_DTYPES), default=None)
+    args = parser.parse_args(argv)
+
+    for path in args.paths:
+        if args.bucket:
+            print(f"✅ {path} -> {convert_s3_object(args.bucket, path, args.dtype)}")
+        else:
+            print(f"✅ {path} -> {convert_file(path, dtype=args.dtype)}")
+
+
+if __name__ == "__main__":
+    main()
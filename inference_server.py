@@ -0,0 +1,318 @@
+"""
+Dedicated inference process pool shared by all web workers on a host.
+
+Run it next to gunicorn:
+
+    INFERENCE_SERVER_ADDRESS=/tmp/faceapp-inference.sock INFERENCE_SERVER_AUTHKEY=<secret> python inference_server.py
+
+and start the web workers with the same INFERENCE_SERVER_ADDRESS and
+INFERENCE_SERVER_AUTHKEY. The connection unpickles what it receives, so the
+key is required and must be kept secret, especially with a TCP address. Web workers
+then load no models: face_utils.detect_faces and embeddings.embed_faces send
+their pixels to this server through shared-memory buffers, and only a small
+request tuple crosses the socket. A fixed pool of INFERENCE_WORKERS processes
+holds the models, each with its TensorFlow/Torch thread pools pinned to
+INFERENCE_INTRA_OP_THREADS so the CPU is not oversubscribed.
+"""
+import os
+import queue
+import threading
+import time
+import multiprocessing as mp
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+# Unix socket path, or host:port for TCP. Empty means models run in-process.
+INFERENCE_SERVER_ADDRESS = os.environ.get("INFERENCE_SERVER_ADDRESS", "")
+# Shared secret for the connection; there is deliberately no default
+INFERENCE_SERVER_AUTHKEY = os.environ.get("INFERENCE_SERVER_AUTHKEY", "")
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+INFERENCE_INTRA_OP_THREADS = int(os.environ.get("INFERENCE_INTRA_OP_THREADS", 2))
+# A request not answered by the pool within this many seconds fails; clients
+# wait a little longer so the server's error normally reaches them first
+INFERENCE_TIMEOUT_SECONDS = float(os.environ.get("INFERENCE_TIMEOUT_SECONDS", 30))
+_CLIENT_TIMEOUT_GRACE_SECONDS = 5
+
+EMBEDDING_DIM = 512
+
+# Set inside pool processes so they run models locally instead of calling themselves
+_in_inference_worker = False
+
+
+class InferenceError(RuntimeError):
+    pass
+
+
+def _parse_address(address):
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return (host or "127.0.0.1", int(port))
+    return address
+
+
+def _authkey():
+    if not INFERENCE_SERVER_AUTHKEY:
+        raise InferenceError("INFERENCE_SERVER_AUTHKEY must be set to use the inference server")
+    return INFERENCE_SERVER_AUTHKEY.encode("utf-8")
+
+
+def remote_inference_enabled():
+    return bool(INFERENCE_SERVER_ADDRESS) and not _in_inference_worker
+
+
+def _attach(name):
+    # The creator (the web worker) owns and unlinks the block; don't let this
+    # process's resource tracker unlink it too.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+# ---------------------------------------------------------------- pool side
+
+def _pin_threads(threads):
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except (ImportError, RuntimeError):
+        pass
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+
+def _run_task(op, array, out, kwargs):
+    if op == "embed":
+        from embeddings import embed_faces
+        out[:] = embed_faces(array, **kwargs)
+        return None
+    if op == "detect":
+        from face_utils import detect_faces
+        return detect_faces(array)
+    raise InferenceError(f"Unknown inference op: {op}")
+
+
+def _worker_main(tasks, results, threads, warm_up):
+    # Models run in this process; it must never forward requests to itself.
+    # (Under spawn this file may be loaded as __mp_main__, so flag the real module.)
+    os.environ["INFERENCE_SERVER_ADDRESS"] = ""
+    import inference_server
+    inference_server._in_inference_worker = True
+    _pin_threads(threads)
+
+    from model_registry import warm_up as warm_up_models
+    warm_up_models(warm_up)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        request_id, op, in_name, shape, dtype, out_name, out_shape, kwargs = task
+        blocks = []
+        try:
+            block = _attach(in_name)
+            blocks.append(block)
+            array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            out = None
+            if out_name:
+                out_block = _attach(out_name)
+                blocks.append(out_block)
+                out = np.ndarray(out_shape, dtype=np.float32, buffer=out_block.buf)
+            payload = _run_task(op, array, out, kwargs)
+            del array, out
+            results.put((request_id, True, payload))
+        except Exception as e:
+            results.put((request_id, False, f"{type(e).__name__}: {e}"))
+        finally:
+            for block in blocks:
+                block.close()
+
+
+class InferenceServer:
+    """Listens for web-worker connections and fans requests out to the process pool."""
+
+    def __init__(self, address=None, workers=INFERENCE_WORKERS, threads=INFERENCE_INTRA_OP_THREADS,
+                 warm_up=("yolo", "facenet")):
+        self.address = _parse_address(address or INFERENCE_SERVER_ADDRESS or "/tmp/faceapp-inference.sock")
+        self.workers = workers
+        self.threads = threads
+        self.warm_up = list(warm_up)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.next_id = 0
+        self.processes = []
+
+    def _start_pool(self):
+        # Fresh queues every time: a worker killed inside get() or put() leaves
+        # the queue's lock held, and no other worker could use it again
+        ctx = mp.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.processes = [
+            ctx.Process(target=_worker_main, args=(self.tasks, self.results, self.threads, self.warm_up), daemon=True)
+            for _ in range(self.workers)
+        ]
+        for process in self.processes:
+            process.start()
+
+    def serve_forever(self):
+        authkey = _authkey()
+        self._start_pool()
+        threading.Thread(target=self._dispatch_results, daemon=True).start()
+        threading.Thread(target=self._watch_workers, daemon=True).start()
+
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+        with Listener(self.address, authkey=authkey) as listener:
+            print(f"✅ Inference server listening on {self.address} with {len(self.processes)} workers")
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def _dispatch_results(self):
+        while True:
+            try:
+                # Re-read self.results each time; the pool may have been restarted
+                request_id, ok, payload = self.results.get(timeout=1)
+            except queue.Empty:
+                continue
+            with self.pending_lock:
+                future = self.pending.pop(request_id, None)
+            if future is not None:
+                future.set_result((ok, payload))
+
+    def _watch_workers(self):
+        # A dead worker (e.g. OOM-killed) breaks the pool: its task is lost and it
+        # may have died holding a queue lock. Restart the pool and fail the
+        # requests in flight instead of leaving them to time out.
+        while True:
+            time.sleep(1)
+            dead = [process for process in self.processes if not process.is_alive()]
+            if not dead:
+                continue
+            print(f"⚠️ Inference worker {dead[0].pid} exited with code {dead[0].exitcode}; restarting the pool")
+            for process in self.processes:
+                process.terminate()
+            for process in self.processes:
+                process.join()
+            with self.pending_lock:
+                failed, self.pending = self.pending, {}
+            for future in failed.values():
+                future.set_result((False, "Inference worker died; the pool was restarted"))
+            self._start_pool()
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    op, in_name, shape, dtype, out_name, out_shape, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                future = Future()
+                with self.pending_lock:
+                    self.next_id += 1
+                    request_id = self.next_id
+                    self.pending[request_id] = future
+                self.tasks.put((request_id, op, in_name, shape, dtype, out_name, out_shape, kwargs))
+                try:
+                    response = future.result(timeout=INFERENCE_TIMEOUT_SECONDS)
+                except FutureTimeoutError:
+                    with self.pending_lock:
+                        self.pending.pop(request_id, None)
+                    response = (False, f"Inference timed out after {INFERENCE_TIMEOUT_SECONDS:.0f}s")
+                try:
+                    conn.send(response)
+                except OSError:  # the client gave up and closed the connection
+                    return
+
+
+# ---------------------------------------------------------------- web-worker side
+
+class InferenceClient:
+    """One socket per thread to the inference server; arrays travel through shared memory."""
+
+    def __init__(self, address=None):
+        self.address = _parse_address(address or INFERENCE_SERVER_ADDRESS)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = Client(self.address, authkey=_authkey())
+            self._local.conn = conn
+        return conn
+
+    def _drop_connection(self):
+        conn, self._local.conn = getattr(self._local, "conn", None), None
+        if conn is not None:
+            conn.close()
+
+    def _call(self, op, array, out_shape=None, **kwargs):
+        array = np.ascontiguousarray(array)
+        in_block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        out_block = None
+        try:
+            np.ndarray(array.shape, dtype=array.dtype, buffer=in_block.buf)[...] = array
+            out_name = None
+            if out_shape is not None:
+                out_block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(out_shape)) * 4, 1))
+                out_name = out_block.name
+            conn = self._connection()
+            try:
+                conn.send((op, in_block.name, array.shape, array.dtype.str, out_name, out_shape, kwargs))
+                if not conn.poll(INFERENCE_TIMEOUT_SECONDS + _CLIENT_TIMEOUT_GRACE_SECONDS):
+                    # A late reply would be read as the next call's; start over with a new connection
+                    self._drop_connection()
+                    raise InferenceError("Inference server did not respond in time")
+                ok, payload = conn.recv()
+            except (EOFError, OSError):
+                # Server restarted; reconnect on the next call
+                self._drop_connection()
+                raise
+            if not ok:
+                raise InferenceError(payload)
+            if out_block is not None:
+                return np.ndarray(out_shape, dtype=np.float32, buffer=out_block.buf).copy()
+            return payload
+        finally:
+            for block in (in_block, out_block):
+                if block is not None:
+                    block.close()
+                    block.unlink()
+
+    def embed(self, faces_rgb, max_batch_size=None):
+        faces_rgb = np.asarray(faces_rgb, dtype=np.uint8)
+        return self._call("embed", faces_rgb, out_shape=(len(faces_rgb), EMBEDDING_DIM), max_batch_size=max_batch_size)
+
+    def detect(self, image):
+        return self._call("detect", image)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_inference_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = InferenceClient()
+    return _client
+
+
+if __name__ == "__main__":
+    InferenceServer().serve_forever()
@@ -0,0 +1,27 @@
+from flask import Blueprint, request, jsonify, url_for
+from training_jobs import get_training_job
+
+jobs_bp = Blueprint("jobs", __name__)
+
+
+def is_async_request(data=None):
+    """Training routes run as background jobs when called with ?async=true or {"async": true}."""
+    if request.args.get("async", "").lower() in ("1", "true", "yes"):
+        return True
+    return bool(data and data.get("async") is True)
+
+
+def job_accepted_response(job_id):
+    return jsonify({
+        "message": "Training job queued",
+        "jobId": job_id,
+        "statusUrl": url_for("jobs.training_job_status", job_id=job_id),
+    }), 202
+
+
+@jobs_bp.route("/api/training-jobs/<job_id>", methods=["GET"])
+def training_job_status(job_id):
+    job = get_training_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
@@ -1,17 +1,27 @@
 # memorysnap_bp.py
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 import os
+import json
 import uuid
-import pickle
 import requests # Still needed for downloading images/files from URLs (used by s3_utils)
 
 # Import the new S3 utility functions
-from utils.s3_utils import upload_image_array_to_s3, upload_file_to_s3, download_image_from_s3_url, download_file_from_s3
+from utils.s3_utils import upload_image_arrays_to_s3, upload_file_to_s3, download_bytes_from_url
+from utils.image_utils import decode_for_detection
+from utils.image_pipeline import prefetch_images
+from gallery_cache import get_gallery, invalidate_gallery, gallery_key, GalleryNotFoundError
+from gallery_format import GALLERY_SUFFIX, read_gallery
+from ann_index import publish_ann_index
+from training_jobs import submit_training_job
+from enrollment import add_faces, remove_faces, save_enrollment
+from jobs_routes import is_async_request, job_accepted_response
+from metrics import timed
 
 # Assuming these are adapted to handle direct image data (NumPy arrays) or URLs
-from embeddings import process_images, get_face_embedding, process_faces_from_urls
-from recognize import recognize_face
-from face_utils import detect_and_crop_faces # Ensure this returns NumPy arrays, not local paths
+from embeddings import process_faces_from_urls
+from recognize import assign_faces, EmbeddingGallery
+from face_utils import crop_faces # Returns NumPy arrays, not local paths
+from face_cache import analyze_image, fetch_image_for_analysis, locate_faces_cached, content_key
 
 memorysnap_bp = Blueprint("memorysnap", __name__)
 
@@ -24,6 +34,36 @@ if not all([S3_BUCKET_CROPPED_FACES, S3_BUCKET_EMBEDDINGS]):
     raise EnvironmentError("S3_BUCKET_NAME_FOR_CROPPED_FACES and S3_BUCKET_NAME_FOR_EMBEDDINGS must be set in environment variables.")
 
 
+def _train_trip_gallery(trip_id, faces_urls, detector_backend=None, progress=None):
+    # Temporary local path to save the generated gallery file before uploading to S3;
+    # unique per run so concurrent jobs for one trip don't share a file
+    local_gallery_path = f"/tmp/embeddings/{trip_id}-{uuid.uuid4()}{GALLERY_SUFFIX}"
+    os.makedirs(os.path.dirname(local_gallery_path), exist_ok=True)
+
+    try:
+        # `process_faces_from_urls` downloads faces from `faces_urls` and then
+        # processes them to create the embedding file locally.
+        images = process_faces_from_urls(faces_urls, local_gallery_path, detector_backend=detector_backend, progress=progress)
+
+        # Upload the generated .fgal file to S3
+        s3_embedding_url = upload_file_to_s3(local_gallery_path, S3_BUCKET_EMBEDDINGS, gallery_key(trip_id))
+        # Large galleries also get an ANN index stored next to them
+        gallery = EmbeddingGallery.from_gallery_data(read_gallery(local_gallery_path, mmap=False))
+        publish_ann_index(S3_BUCKET_EMBEDDINGS, trip_id, gallery.ids, gallery.matrix)
+        # Keep per-image embeddings next to the gallery for incremental edits
+        save_enrollment(S3_BUCKET_EMBEDDINGS, trip_id, images)
+        invalidate_gallery(S3_BUCKET_EMBEDDINGS, trip_id)
+    finally:
+        # Clean up the local temporary file, also when a step above failed
+        if os.path.exists(local_gallery_path):
+            os.remove(local_gallery_path)
+
+    return {
+        "message": f"Model trained successfully for trip {trip_id}",
+        "embeddingPath": s3_embedding_url # Return the S3 URL of the gallery file
+    }
+
+
 @memorysnap_bp.route("/train-embeddings", methods=["POST"])
 def train_embeddings_from_faces():
     data = request.get_json()
@@ -33,30 +73,59 @@ def train_embeddings_from_faces():
     if not trip_id or not faces_urls:
         return jsonify({"error": "Missing tripId or faces (S3 URLs)"}), 400
 
-    # Temporary local path to save the generated .pkl file before uploading to S3
-    local_pkl_path = f"/tmp/embeddings/{trip_id}.pkl"
-    os.makedirs(os.path.dirname(local_pkl_path), exist_ok=True)
+    # `detectorBackend` ("yolo" or "mtcnn") overrides FACE_DETECTOR_BACKEND for this trip.
+    detector_backend = data.get("detectorBackend")
+
+    if is_async_request(data):
+        job_id = submit_training_job(
+            "memorysnap", len(faces_urls),
+            lambda progress: _train_trip_gallery(trip_id, faces_urls, detector_backend, progress),
+        )
+        return job_accepted_response(job_id)
 
     try:
-        # `process_faces_from_urls` must now download faces from `faces_urls`
-        # and then process them to create the embedding file locally.
-        # Ensure process_faces_from_urls uses `download_image_from_s3_url` internally
-        # or expects URLs and handles downloading itself.
-        process_faces_from_urls(faces_urls, local_pkl_path)
+        return jsonify(_train_trip_gallery(trip_id, faces_urls, detector_backend)), 200
+    except Exception as e:
+        print(f"Error in /train-embeddings: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
-        # Upload the generated .pkl file to S3
-        s3_embedding_key = f"{trip_id}.pkl"
-        s3_embedding_url = upload_file_to_s3(local_pkl_path, S3_BUCKET_EMBEDDINGS, s3_embedding_key)
 
-        # Clean up the local temporary file
-        os.remove(local_pkl_path)
+@memorysnap_bp.route("/train-embeddings/<trip_id>/faces", methods=["POST"])
+def add_trip_faces(trip_id):
+    data = request.get_json()
+    faces_urls = data.get("faces") # [{"person_id": ..., "imageUrl": ...}] to add to the trip gallery
 
-        return jsonify({
-            "message": f"Model trained successfully for trip {trip_id}",
-            "embeddingPath": s3_embedding_url # Return the S3 URL of the .pkl file
-        }), 200
+    if not faces_urls:
+        return jsonify({"error": "Missing faces (S3 URLs)"}), 400
+
+    detector_backend = data.get("detectorBackend")
+
+    def train(progress=None):
+        return add_faces(S3_BUCKET_EMBEDDINGS, trip_id, faces_urls, detector_backend, progress)
+
+    if is_async_request(data):
+        return job_accepted_response(submit_training_job("memorysnap-add", len(faces_urls), train))
+
+    try:
+        return jsonify(train()), 200
     except Exception as e:
-        print(f"Error in /train-embeddings: {str(e)}")
+        print(f"Error in POST /train-embeddings/{trip_id}/faces: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+@memorysnap_bp.route("/train-embeddings/<trip_id>/faces", methods=["DELETE"])
+def remove_trip_faces(trip_id):
+    data = request.get_json()
+    person_ids = data.get("personIds") or []
+    image_urls = data.get("imageUrls") or []
+
+    if not person_ids and not image_urls:
+        return jsonify({"error": "personIds or imageUrls is required"}), 400
+
+    try:
+        return jsonify(remove_faces(S3_BUCKET_EMBEDDINGS, trip_id, person_ids, image_urls)), 200
+    except Exception as e:
+        print(f"Error in DELETE /train-embeddings/{trip_id}/faces: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 
@@ -70,23 +139,30 @@ def recognize_memorysnap():
             return jsonify({"error": "No imageUrl provided"}), 400
 
         # Download the image from the S3 URL using s3_utils
-        img = download_image_from_s3_url(image_url)
+        image_bytes = download_bytes_from_url(image_url)
+        img, preview = decode_for_detection(image_bytes)
+        if img is None:
+            raise ValueError(f"Could not decode image from URL: {image_url}")
 
-        faces_cropped_images = detect_and_crop_faces(img) # This should return NumPy arrays of cropped faces
+        # A selfie posted again reuses its cached boxes instead of running YOLO
+        boxes, points = locate_faces_cached(img, content_key(image_bytes), preview)
+        faces_cropped_images = list(crop_faces(img, boxes, points)[0]) # BGR NumPy arrays of cropped faces
 
-        response_faces = []
-        for face_img_array in faces_cropped_images:
-            # Generate a unique key for the S3 object
-            uid = str(uuid.uuid4())
-            s3_key = f"{trip_id}/{uid}.jpg" # Example S3 path for cropped faces
+        # Generate a unique key for each S3 object
+        uids = [str(uuid.uuid4()) for _ in faces_cropped_images]
+        s3_keys = [f"{trip_id}/{uid}.jpg" for uid in uids] # Example S3 path for cropped faces
 
-            # Upload the cropped face directly to S3 using s3_utils
-            s3_cropped_face_url = upload_image_array_to_s3(face_img_array, S3_BUCKET_CROPPED_FACES, s3_key)
+        # Upload all cropped faces concurrently (or in the background, see S3_UPLOAD_BACKGROUND)
+        with timed("upload"):
+            s3_cropped_face_urls = upload_image_arrays_to_s3(faces_cropped_images, S3_BUCKET_CROPPED_FACES, s3_keys)
 
-            response_faces.append({
+        response_faces = [
+            {
                 "id": uid,
                 "imageUrl": s3_cropped_face_url # Return the S3 URL of the cropped face
-            })
+            }
+            for uid, s3_cropped_face_url in zip(uids, s3_cropped_face_urls)
+        ]
 
         return jsonify({
             "faces": response_faces,
@@ -101,68 +177,70 @@ def recognize_memorysnap():
         return jsonify({"error": str(e)}), 500
 
 
+def _wants_stream(data):
+    """NDJSON output with ?stream=true, {"stream": true} or Accept: application/x-ndjson."""
+    if request.args.get("stream", "").lower() in ("1", "true", "yes"):
+        return True
+    if request.accept_mimetypes.best == "application/x-ndjson":
+        return True
+    return bool(data and data.get("stream") is True)
+
+
+def _classify_images(image_urls, known_embeddings):
+    """Yields one result object per image, in input order."""
+    # Upcoming images download and decode in the background while the current one is processed
+    # (images analyzed before, by content or URL+ETag, are not downloaded again)
+    for image_url, pending_image in prefetch_images(image_urls, fetch=fetch_image_for_analysis):
+        try:
+            with timed("download_wait"):
+                cache_keys, image, cached, preview = pending_image.result()
+
+            # One batched FaceNet pass and one matrix match for every face in the image;
+            # the YOLO crops are embedded directly without a second MTCNN pass
+            analysis = analyze_image(image, cache_keys, cached, preview)
+            # Each person is assigned to at most one face per image
+            matches = assign_faces(analysis.embeddings, known_embeddings)
+            recognized_ids = [match.name for match in matches if match.name.lower() != "unknown"]
+
+            yield {
+                "imageUrl": image_url,
+                "recognized": recognized_ids,
+                "faces": [match._asdict() for match in matches]
+            }
+
+        except requests.exceptions.RequestException as req_err:
+            print(f"⚠️ Skipping image due to download error from {image_url}: {req_err}")
+            yield {"imageUrl": image_url, "error": "Failed to download"}
+        except Exception as e:
+            print(f"⚠️ Error processing image from {image_url}: {e}")
+            yield {"imageUrl": image_url, "error": f"Processing error: {str(e)}"}
+
+
 @memorysnap_bp.route("/classify-faces", methods=["POST"])
 def classify_faces_in_images():
     try:
         data = request.get_json()
         trip_id = data.get("tripId")
-        embedding_s3_url = data.get("embeddingPath") # Expecting S3 URL to the .pkl file
+        embedding_s3_url = data.get("embeddingPath") # Expecting S3 URL to the gallery file
         image_urls = data.get("imageUrls") # Expecting array of S3 URLs to images
         print("Images URLs from Node.js:", image_urls)
 
         if not trip_id or not embedding_s3_url or not image_urls:
             return jsonify({"error": "tripId, embeddingPath (S3 URL), and imageUrls are required"}), 400
 
-        # --- Download Embedding File from S3 ---
-        local_embedding_file = f"/tmp/embeddings/{trip_id}.pkl" # Use /tmp for temporary storage in Docker/Linux
-        os.makedirs(os.path.dirname(local_embedding_file), exist_ok=True)
-
-        download_file_from_s3(S3_BUCKET_EMBEDDINGS, f"{trip_id}.pkl", local_embedding_file)
-        # Assuming the s3_key for embeddings is "trip_embeddings/{trip_id}.pkl" as per train-embeddings
-
-        if not os.path.exists(local_embedding_file):
-            return jsonify({"error": f"Embedding file not found locally after download at {local_embedding_file}"}), 404
-
-        # Load embeddings for the trip
-        with open(local_embedding_file, 'rb') as f:
-            known_embeddings = pickle.load(f)
-
-        results = []
-
-        for image_url in image_urls:
-            try:
-                # Download image from S3 URL using s3_utils
-                image = download_image_from_s3_url(image_url)
-
-                faces = detect_and_crop_faces(image)
-                recognized_ids = []
-
-                for face in faces:
-                    embedding = get_face_embedding(face)
-                    if embedding is None:
-                        continue
-
-                    name = recognize_face(embedding, known_embeddings)
-                    if name.lower() != "unknown":
-                        recognized_ids.append(name)
-
-                results.append({
-                    "imageUrl": image_url,
-                    "recognized": recognized_ids
-                })
-
-            except requests.exceptions.RequestException as req_err:
-                print(f"⚠️ Skipping image due to download error from {image_url}: {req_err}")
-                results.append({"imageUrl": image_url, "error": "Failed to download"})
-            except Exception as e:
-                print(f"⚠️ Error processing image from {image_url}: {e}")
-                results.append({"imageUrl": image_url, "error": f"Processing error: {str(e)}"})
+        # --- Load the trip gallery (cached per process, revalidated against S3) ---
+        try:
+            known_embeddings = get_gallery(S3_BUCKET_EMBEDDINGS, trip_id)
+        except GalleryNotFoundError as e:
+            return jsonify({"error": str(e)}), 404
 
-        # Clean up downloaded embedding file (important for stateless containers)
-        if os.path.exists(local_embedding_file):
-            os.remove(local_embedding_file)
+        results = _classify_images(image_urls, known_embeddings)
+        if _wants_stream(data):
+            # One JSON line per image as soon as it is classified
+            lines = (json.dumps(result) + "\n" for result in results)
+            return Response(stream_with_context(lines), mimetype="application/x-ndjson")
 
-        return jsonify({"results": results}), 200
+        return jsonify({"results": list(results)}), 200
 
     except Exception as e:
         print(f"❌ Error in /classify-faces: {e}")
@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+# Path to the YOLOv8 face weights
+YOLO_MODEL_PATH = os.environ.get("YOLO_MODEL_PATH", os.path.join("models", "yolov8n-face-lindevs.pt"))
+
+
+def _load_mtcnn():
+    from mtcnn import MTCNN
+    return MTCNN()
+
+
+def _load_facenet():
+    from keras_facenet import FaceNet
+    return FaceNet()
+
+
+def _load_yolo():
+    from ultralytics import YOLO
+    return YOLO(YOLO_MODEL_PATH)
+
+
+_LOADERS = {
+    "mtcnn": _load_mtcnn,
+    "facenet": _load_facenet,
+    "yolo": _load_yolo,
+}
+
+_models = {}
+_stats = {}
+_locks = {name: threading.Lock() for name in _LOADERS}
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def register_model(name, loader):
+    """Registers (or replaces) the loader for `name`; the model is built on first use."""
+    _LOADERS[name] = loader
+    _locks.setdefault(name, threading.Lock())
+    _models.pop(name, None)
+    _stats.pop(name, None)
+
+
+def get_model(name):
+    """Returns the process-wide instance of `name`, loading it on first use."""
+    model = _models.get(name)
+    if model is not None:
+        return model
+
+    with _locks[name]:
+        if name not in _models:
+            rss_before = _rss_bytes()
+            start = time.perf_counter()
+            _models[name] = _LOADERS[name]()
+            load_seconds = time.perf_counter() - start
+            rss_after = _rss_bytes()
+            _stats[name] = {
+                "load_seconds": round(load_seconds, 3),
+                "rss_delta_bytes": rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+            }
+            print(f"✅ Loaded model '{name}' in {load_seconds:.2f}s")
+        return _models[name]
+
+
+def warm_up(names=None):
+    """Loads the given models (all registered ones by default) ahead of the first request."""
+    unknown = [name for name in names or () if name not in _LOADERS]
+    if unknown:
+        raise ValueError(f"Unknown model(s) {', '.join(unknown)}; registered models: {', '.join(_LOADERS)}")
+    for name in names or list(_LOADERS):
+        get_model(name)
+
+
+def model_stats():
+    return {
+        "models": {
+            name: {"loaded": name in _models, **_stats.get(name, {})}
+            for name in _LOADERS
+        },
+        "process_rss_bytes": _rss_bytes(),
+    }
@@ -0,0 +1,163 @@
+"""
+Multi-prototype galleries and per-gallery match thresholds.
+
+A person enrolled from varied photos (glasses on and off, different lighting,
+years apart) is poorly described by the mean of their embeddings. Training
+instead clusters each person's embeddings with spherical k-means into at most
+GALLERY_PROTOTYPES unit-length prototypes, written as consecutive .fgal rows
+that share the person's id; EmbeddingGallery scores a face against a person
+as the max over their prototypes. Matching cost is bounded by
+GALLERY_PROTOTYPES rows per person however many images were enrolled.
+
+The match threshold is calibrated at the same time: impostor scores (each
+enrollment image against everyone else's prototypes) set the threshold for a
+target false-accept rate, and genuine scores (each image against the person's
+other images) report the false-reject rate it implies. The threshold is
+stored in the gallery meta and used whenever a caller does not pass one.
+"""
+import os
+
+import numpy as np
+
+from ann_index import spherical_kmeans
+from gallery_format import LEGACY_GALLERY_SUFFIX, dumps_gallery, save_known_embeddings, write_file_atomic
+from recognize import MATCH_THRESHOLD
+
+# Upper bound on prototypes per person; 1 stores the plain mean as before
+GALLERY_PROTOTYPES = int(os.environ.get("GALLERY_PROTOTYPES", 3))
+# Enrollment images needed per prototype, so a single odd photo does not get its own row
+GALLERY_PROTOTYPE_MIN_IMAGES = int(os.environ.get("GALLERY_PROTOTYPE_MIN_IMAGES", 2))
+# Fraction of impostor scores allowed above the calibrated threshold
+GALLERY_TARGET_FAR = float(os.environ.get("GALLERY_TARGET_FAR", 0.001))
+# Calibrated thresholds are clamped to this range; by default calibration only ever
+# raises the threshold above MATCH_THRESHOLD, never loosens it
+GALLERY_THRESHOLD_MIN = float(os.environ.get("GALLERY_THRESHOLD_MIN", MATCH_THRESHOLD))
+GALLERY_THRESHOLD_MAX = float(os.environ.get("GALLERY_THRESHOLD_MAX", 0.7))
+# Galleries with fewer impostor scores than this keep the default threshold
+GALLERY_CALIBRATION_MIN_IMPOSTORS = int(os.environ.get("GALLERY_CALIBRATION_MIN_IMPOSTORS", 20))
+# Enrollment images sampled for calibration on large galleries
+GALLERY_CALIBRATION_SAMPLES = int(os.environ.get("GALLERY_CALIBRATION_SAMPLES", 5000))
+
+_CHUNK_ROWS = 256
+
+
+def _l2_normalize(matrix):
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
+# Collapse {person_id: {image_key: embedding}} into {person_id: mean embedding}
+def average_embeddings(per_image):
+    return {
+        person_id: np.mean(list(images.values()), axis=0)
+        for person_id, images in per_image.items() if images
+    }
+
+
+def person_prototypes(embeddings, k=None):
+    """
+    Clusters one person's embeddings into at most k unit-length prototypes.
+    :param embeddings: (n, D) array of that person's enrollment embeddings.
+    :return: (m, D) float32 array, 1 <= m <= k.
+    """
+    k = GALLERY_PROTOTYPES if k is None else k
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+    k = max(1, min(k, len(embeddings) // max(1, GALLERY_PROTOTYPE_MIN_IMAGES)))
+    if k == 1:
+        return _l2_normalize(embeddings.mean(axis=0, keepdims=True)).astype(np.float32)
+
+    normalized = _l2_normalize(embeddings)
+    centroids = spherical_kmeans(normalized, k, iterations=10, seed=0)
+    # Re-seeding can leave duplicate centroids; keep only those that own an image
+    assign = np.argmax(normalized @ centroids.T, axis=1)
+    return centroids[np.unique(assign)]
+
+
+def build_prototypes(per_image, k=None):
+    """
+    Prototype rows for a whole gallery.
+    :param per_image: {person_id: {image_key: embedding}}.
+    :return: (ids, matrix) with each person's rows consecutive.
+    """
+    ids, rows = [], []
+    for person_id, images in per_image.items():
+        if not images:
+            continue
+        prototypes = person_prototypes(np.stack([np.asarray(e, dtype=np.float32).ravel() for e in images.values()]), k)
+        ids.extend([person_id] * len(prototypes))
+        rows.append(prototypes)
+    if not rows:
+        return ids, np.empty((0, 0), dtype=np.float32)
+    return ids, np.concatenate(rows)
+
+
+def calibrate_threshold(per_image, ids, matrix, target_far=None, seed=0):
+    """
+    Picks the lowest threshold whose impostor false-accept rate is at most target_far.
+    :param per_image: {person_id: {image_key: embedding}} the prototypes were built from.
+    :param ids: Prototype row ids from build_prototypes.
+    :param matrix: Prototype rows from build_prototypes.
+    :return: (threshold or None when there is too little data, stats dict for the gallery meta).
+    """
+    target_far = GALLERY_TARGET_FAR if target_far is None else target_far
+    people = [person_id for person_id, images in per_image.items() if images]
+    owners = np.array([p for p in people for _ in per_image[p]], dtype=object)
+    if len(people) < 2 or not len(owners):
+        return None, {"impostors": 0, "genuine": 0}
+
+    samples = np.stack([np.asarray(e, dtype=np.float32).ravel() for p in people for e in per_image[p].values()])
+    samples = _l2_normalize(samples)
+    row_ids = np.empty(len(ids), dtype=object)
+    row_ids[:] = list(ids)
+
+    # Genuine: each image against the same person's other images (leave-one-out)
+    genuine = []
+    start = 0
+    for person_id in people:
+        n = len(per_image[person_id])
+        if n > 1:
+            block = samples[start:start + n]
+            similarity = block @ block.T
+            np.fill_diagonal(similarity, -np.inf)
+            genuine.append(similarity.max(axis=1))
+        start += n
+    genuine = np.concatenate(genuine) if genuine else np.empty(0, dtype=np.float32)
+
+    # Impostor: each image's best score against anyone else's prototypes
+    picked = np.arange(len(samples))
+    if len(picked) > GALLERY_CALIBRATION_SAMPLES:
+        picked = np.sort(np.random.default_rng(seed).choice(len(samples), GALLERY_CALIBRATION_SAMPLES, replace=False))
+    impostor = np.empty(len(picked), dtype=np.float32)
+    for begin in range(0, len(picked), _CHUNK_ROWS):
+        chunk = picked[begin:begin + _CHUNK_ROWS]
+        scores = samples[chunk] @ matrix.T
+        scores[owners[chunk][:, None] == row_ids[None, :]] = -np.inf
+        impostor[begin:begin + len(chunk)] = scores.max(axis=1)
+
+    stats = {"impostors": int(len(impostor)), "genuine": int(len(genuine))}
+    if len(impostor) < GALLERY_CALIBRATION_MIN_IMPOSTORS:
+        return None, stats
+
+    threshold = float(np.quantile(impostor, 1.0 - target_far, method="higher"))
+    threshold = float(np.clip(threshold, GALLERY_THRESHOLD_MIN, GALLERY_THRESHOLD_MAX))
+    stats["far"] = round(float(np.mean(impostor > threshold)), 6)
+    if len(genuine):
+        stats["frr"] = round(float(np.mean(genuine <= threshold)), 6)
+    return round(threshold, 4), stats
+
+
+def dumps_prototype_gallery(per_image, dtype=None, k=None):
+    """.fgal bytes with up to k prototypes per person and the calibrated threshold in the meta."""
+    ids, matrix = build_prototypes(per_image, k)
+    threshold, stats = calibrate_threshold(per_image, ids, matrix)
+    meta = {"normalized": True, "prototypes": GALLERY_PROTOTYPES if k is None else k, "calibration": stats}
+    if threshold is not None:
+        meta["threshold"] = threshold
+    return dumps_gallery(ids, matrix, dtype=dtype, meta=meta)
+
+
+def save_prototype_gallery(path, per_image, dtype=None):
+    """Writes a prototype gallery as .fgal; legacy .pkl paths get the averaged dict they always had."""
+    if path.endswith(LEGACY_GALLERY_SUFFIX):
+        save_known_embeddings(path, average_embeddings(per_image), dtype)
+        return
+    write_file_atomic(path, dumps_prototype_gallery(per_image, dtype))
@@ -1,21 +1,249 @@
-import pickle
+import os
+from collections import namedtuple
+
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy.optimize import linear_sum_assignment
+
+from ann_index import gallery_fingerprint
+from metrics import timed
+
+# Used when neither the caller nor the gallery meta gives a threshold
+MATCH_THRESHOLD = float(os.environ.get("MATCH_THRESHOLD", 0.4))
+
+# name is "unknown" when the face was not assigned; score is then its best score.
+# margin is score minus the best score of any other person: negative when the face's
+# top choice went to another face in the photo, None for one-person galleries.
+FaceMatch = namedtuple("FaceMatch", ["name", "score", "margin"])
+
+
+class EmbeddingGallery:
+    """
+    Known face embeddings packed into one L2-normalized float32 matrix.
+    Row i of `matrix` belongs to `ids[i]`, so a whole batch of query
+    embeddings can be scored with a single matrix multiply. A person may own
+    several consecutive rows (prototypes); they are scored as the max of them.
+    """
+
+    def __init__(self, ids, matrix, normalized=False, index=None, threshold=None):
+        self.ids = np.empty(len(ids), dtype=object)
+        self.ids[:] = list(ids)
+        matrix = np.asarray(matrix, dtype=np.float32)
+        matrix = matrix.reshape(len(self.ids), matrix.shape[-1] if matrix.ndim else 0)
+        # Rows that are already unit length (e.g. a memory-mapped .fgal gallery) are used as-is
+        self.matrix = np.ascontiguousarray(matrix) if normalized else _l2_normalize(matrix)
+        self._group_rows()
+        # Calibrated at training time; None means MATCH_THRESHOLD
+        self.threshold = threshold
+        # Optional ann_index.IVFIndex/HNSWIndex; match() searches it instead of scanning every row
+        self.index = None
+        if index is not None:
+            self.attach_index(index)
+
+    def _group_rows(self):
+        # `people` has one entry per person; `_starts` is the first row of each
+        # person's block, or None when every person has a single row.
+        self.people = self.ids
+        self._starts = None
+        self._max_rows = 1 if len(self.ids) else 0
+        if len(self.ids) < 2:
+            return
+        first_seen = {}
+        groups = np.array([first_seen.setdefault(i, len(first_seen)) for i in self.ids], dtype=np.int64)
+        if len(first_seen) == len(self.ids):
+            return
+        if np.any(np.diff(groups) < 0):
+            # Prototype galleries are written grouped; anything else is reordered once here
+            order = np.argsort(groups, kind="stable")
+            self.ids, self.matrix, groups = self.ids[order], np.ascontiguousarray(self.matrix[order]), groups[order]
+        self._starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        self.people = self.ids[self._starts]
+        self._max_rows = int(np.diff(np.r_[self._starts, len(self.ids)]).max())
+
+    @classmethod
+    def from_dict(cls, known_embeddings):
+        """{person_id: embedding} dict; an (m, D) value gives that person m prototypes."""
+        ids, rows = [], []
+        for person_id, embedding in known_embeddings.items():
+            embedding = np.asarray(embedding, dtype=np.float32)
+            embedding = embedding.reshape(-1, embedding.shape[-1]) if embedding.ndim > 1 else embedding.reshape(1, -1)
+            ids.extend([person_id] * len(embedding))
+            rows.append(embedding)
+        if not ids:
+            return cls([], np.empty((0, 0), dtype=np.float32))
+        return cls(ids, np.concatenate(rows))
+
+    @classmethod
+    def from_gallery_data(cls, data):
+        """Builds a gallery from gallery_format.GalleryData without copying float32 rows."""
+        normalized = bool(data.meta.get("normalized")) and data.dtype == "float32"
+        return cls(data.ids, data.matrix, normalized=normalized, threshold=data.meta.get("threshold"))
+
+    def attach_index(self, index):
+        """Uses `index` for matching if it was built for exactly these ids and rows."""
+        if index.fingerprint != gallery_fingerprint(self.ids, self.matrix):
+            return False
+        self.index = index
+        return True
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes + self.ids.nbytes
+
+    def resolve_threshold(self, threshold=None):
+        if threshold is not None:
+            return threshold
+        return MATCH_THRESHOLD if self.threshold is None else self.threshold
+
+    def scores(self, embeddings):
+        """Cosine similarity of every query row against every gallery row, shape (N, len(gallery))."""
+        queries = _l2_normalize(np.asarray(embeddings, dtype=np.float32).reshape(-1, self.matrix.shape[1]))
+        return queries @ self.matrix.T
+
+    def person_scores(self, embeddings):
+        """Best prototype score of every query row for every person, shape (N, len(people))."""
+        scores = self.scores(embeddings)
+        if self._starts is None:
+            return scores
+        return np.maximum.reduceat(scores, self._starts, axis=1)
 
-def recognize_face(embedding, known_embeddings, threshold=0.4):
+    def match(self, embeddings, top_k=1, exact=False):
+        """
+        Returns (ids, scores), each of shape (N, k), best match first.
+        k is min(top_k, number of people). With an attached ANN index the search
+        is approximate unless exact=True; missing neighbours have id None.
+        """
+        n = len(np.atleast_2d(embeddings))
+        k = min(top_k, len(self.people))
+        if k == 0 or n == 0:
+            return np.empty((n, 0), dtype=object), np.empty((n, 0), dtype=np.float32)
+
+        if self.index is not None and not exact:
+            return self._match_index(embeddings, n, k)
+
+        scores = self.person_scores(embeddings)
+        if k < scores.shape[1]:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        return self.people[top], np.take_along_axis(top_scores, order, axis=1)
+
+    def _match_index(self, embeddings, n, k):
+        queries = _l2_normalize(np.asarray(embeddings, dtype=np.float32).reshape(n, -1))
+        # Enough neighbours that k distinct people survive when each owns several rows
+        rows, row_scores = self.index.search(self.matrix, queries, min(k * self._max_rows, len(self.ids)))
+        row_ids = self.ids[np.maximum(rows, 0)]
+        row_ids[rows < 0] = None
+        if self._starts is None:
+            return row_ids, row_scores
+
+        ids = np.full((n, k), None, dtype=object)
+        top_scores = np.full((n, k), -np.inf, dtype=np.float32)
+        for q in range(n):
+            seen = set()
+            for person_id, score in zip(row_ids[q], row_scores[q]):
+                # Rows come best first, so a person's first row is their max
+                if person_id is None or person_id in seen:
+                    continue
+                ids[q, len(seen)], top_scores[q, len(seen)] = person_id, score
+                seen.add(person_id)
+                if len(seen) == k:
+                    break
+        return ids, top_scores
+
+
+def _l2_normalize(matrix):
+    if matrix.size == 0:
+        return np.ascontiguousarray(matrix)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.ascontiguousarray(matrix / np.maximum(norms, 1e-12))
+
+
+def as_gallery(known_embeddings):
+    if isinstance(known_embeddings, EmbeddingGallery):
+        return known_embeddings
+    return EmbeddingGallery.from_dict(known_embeddings)
+
+
+@timed("match")
+def recognize_faces(embeddings, known_embeddings, threshold=None):
+    """
+    Batch version of recognize_face: one name (or "unknown") per embedding row.
+    threshold=None uses the gallery's calibrated threshold, else MATCH_THRESHOLD.
+    """
+    gallery = as_gallery(known_embeddings)
+    threshold = gallery.resolve_threshold(threshold)
+    ids, scores = gallery.match(embeddings, top_k=1)
+    if ids.shape[1] == 0:
+        return ["unknown"] * len(ids)
+    return [i if s > threshold else "unknown" for i, s in zip(ids[:, 0], scores[:, 0])]
+
+
+def recognize_face(embedding, known_embeddings, threshold=None):
     if embedding is None:
         return "unknown"
 
     if known_embeddings is None:
         return "something went wrong, no known embeddings found"
 
-    similarities = {
-        person_id: cosine_similarity([embedding], [known])[0][0]
-        for person_id, known in known_embeddings.items()
-    }
+    return recognize_faces(np.asarray(embedding)[np.newaxis], known_embeddings, threshold)[0]
+
+
+@timed("match")
+def assign_faces(embeddings, known_embeddings, threshold=None):
+    """
+    Matches all faces of one photo together so each person is used at most once.
+    Pairs scoring above the threshold are assigned by maximizing the total score
+    above it (Hungarian algorithm); faces left over are "unknown".
+    :return: One FaceMatch per embedding row, in order.
+    """
+    gallery = as_gallery(known_embeddings)
+    threshold = gallery.resolve_threshold(threshold)
+    n = len(np.atleast_2d(embeddings)) if len(embeddings) else 0
+    if n == 0:
+        return []
+    # A face never needs a candidate beyond its top n (at most n - 1 are taken by
+    # other faces), plus one more for the runner-up margin
+    ids, scores = gallery.match(embeddings, top_k=n + 1)
+    if ids.shape[1] == 0:
+        return [FaceMatch("unknown", None, None)] * n
+
+    columns = {}
+    for person_id in ids.ravel():
+        if person_id is not None:
+            columns.setdefault(person_id, len(columns))
+    candidates = np.full((n, len(columns)), -np.inf, dtype=np.float32)
+    for i in range(n):
+        for person_id, score in zip(ids[i], scores[i]):
+            if person_id is not None:
+                candidates[i, columns[person_id]] = score
 
-    best_match = max(similarities.items(), key=lambda x: x[1], default=(None, -1))
+    # Pairs at or below the threshold cost nothing, the same as leaving the face unassigned
+    cost = np.where(candidates > threshold, threshold - candidates, 0.0)
+    assigned = {}
+    for row, column in zip(*linear_sum_assignment(cost)):
+        if cost[row, column] < 0:
+            assigned[row] = column
 
-    if best_match[1] > threshold:
-        return best_match[0]
-    return "unknown"
+    people = list(columns)
+    matches = []
+    for i in range(n):
+        column = assigned.get(i)
+        name = "unknown" if column is None else people[column]
+        # Best first; an unknown face reports its best match and the one after it
+        ranked = [(person_id, float(score)) for person_id, score in zip(ids[i], scores[i])
+                  if person_id is not None and np.isfinite(score)]
+        if column is not None:
+            score = float(candidates[i, column])
+            others = [other for person_id, other in ranked if person_id != name]
+        else:
+            score = ranked[0][1] if ranked else None
+            others = [other for _, other in ranked[1:]]
+        margin = round(score - others[0], 4) if score is not None and others else None
+        matches.append(FaceMatch(name, None if score is None else round(score, 4), margin))
+    return matches
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from recognize import EmbeddingGallery, FaceMatch, assign_faces, recognize_faces
+
+# Unit-length people along the axes, so a unit query's score for each person is its coordinate
+GALLERY = {
+    "alice": [1, 0, 0, 0],
+    "bob": [0, 1, 0, 0],
+    "carol": [0, 0, 1, 0],
+}
+
+
+def _faces(*rows):
+    return np.asarray(rows, dtype=np.float32)
+
+
+def test_each_person_is_assigned_at_most_once():
+    # Both faces look most like alice; face 1 is the better alice and face 0 makes a fine bob
+    faces = _faces([0.8, 0.6, 0, 0], [0.9, 0, 0.436, 0])
+
+    matches = assign_faces(faces, GALLERY, threshold=0.4)
+
+    assert [m.name for m in matches] == ["bob", "alice"]
+    assert recognize_faces(faces, GALLERY, threshold=0.4) == ["alice", "alice"]
+
+
+def test_margins_compare_against_the_best_other_person():
+    faces = _faces([0.8, 0.6, 0, 0], [0.9, 0, 0.436, 0])
+
+    face0, face1 = assign_faces(faces, GALLERY, threshold=0.4)
+
+    # Face 0 lost its top choice to face 1, so its margin is negative
+    assert face0 == FaceMatch("bob", 0.6, -0.2)
+    assert face1 == FaceMatch("alice", 0.9, 0.464)
+
+
+def test_face_left_without_a_person_is_unknown_with_its_best_score():
+    faces = _faces([0.8, 0, 0, 0.6], [0.7, 0, 0, 0.714])
+
+    face0, face1 = assign_faces(faces, GALLERY, threshold=0.4)
+
+    assert face0.name == "alice"
+    assert face1.name == "unknown"
+    assert face1.score == pytest.approx(0.7, abs=1e-3)
+
+
+def test_person_with_several_prototypes_is_still_assigned_once():
+    gallery = EmbeddingGallery.from_dict({
+        "alice": np.asarray([[1, 0, 0, 0], [0, 0, 0, 1]], dtype=np.float32),
+        "bob": [0, 1, 0, 0],
+    })
+    faces = _faces([1, 0, 0, 0], [0, 0, 0, 1])
+
+    names = [m.name for m in assign_faces(faces, gallery, threshold=0.4)]
+
+    assert sorted(names) == ["alice", "unknown"]
+
+
+def test_gallery_threshold_is_used_when_none_is_given():
+    gallery = EmbeddingGallery.from_dict(GALLERY)
+    gallery.threshold = 0.95
+
+    assert [m.name for m in assign_faces(_faces([0.9, 0, 0.436, 0]), gallery)] == ["unknown"]
+    assert [m.name for m in assign_faces(_faces([0.9, 0, 0.436, 0]), gallery, threshold=0.4)] == ["alice"]
+
+
+def test_one_person_gallery_has_no_margin():
+    assert assign_faces(_faces([1, 0, 0, 0]), {"alice": [1, 0, 0, 0]}) == [FaceMatch("alice", 1.0, None)]
+
+
+def test_empty_gallery_leaves_every_face_unknown():
+    matches = assign_faces(_faces([1, 0, 0, 0], [0, 1, 0, 0]), {})
+
+    assert matches == [FaceMatch("unknown", None, None)] * 2
+
+
+def test_no_faces_gives_no_matches():
+    assert assign_faces(np.empty((0, 4), dtype=np.float32), GALLERY) == []
+    assert assign_faces([], GALLERY) == []
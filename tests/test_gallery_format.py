@@ -0,0 +1,93 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+import gallery_format
+from gallery_format import (GalleryFormatError, loads_any, loads_gallery, read_gallery, save_known_embeddings,
+                            write_gallery)
+
+
+def _matrix(rows=5, dim=16, seed=0):
+    matrix = np.random.default_rng(seed).standard_normal((rows, dim)).astype(np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+@pytest.mark.parametrize("dtype, atol", [("float32", 0), ("float16", 1e-3), ("int8", 1e-2)])
+def test_round_trip(tmp_path, dtype, atol, mmap):
+    path = str(tmp_path / "class.fgal")
+    ids = ["alice", "bob", "bob", "carol", "dave"]
+    matrix = _matrix()
+    write_gallery(path, ids, matrix, dtype=dtype, row_keys=[f"k{i}" for i in range(5)], meta={"threshold": 0.5})
+
+    data = read_gallery(path, mmap=mmap)
+
+    assert data.ids == ids
+    assert data.row_keys == [f"k{i}" for i in range(5)]
+    assert data.meta == {"threshold": 0.5}
+    assert data.dtype == dtype
+    assert data.matrix.dtype == np.float32
+    np.testing.assert_allclose(data.matrix, matrix, atol=atol)
+
+
+def test_float32_read_is_zero_copy(tmp_path):
+    path = str(tmp_path / "class.fgal")
+    write_gallery(path, ["alice"], _matrix(1), dtype="float32")
+
+    assert isinstance(read_gallery(path).matrix, np.memmap)
+    with open(path, "rb") as f:
+        body = f.read()
+    assert not loads_gallery(body).matrix.flags.owndata
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_empty_gallery(tmp_path, mmap):
+    path = str(tmp_path / "empty.fgal")
+    write_gallery(path, [], np.empty((0, 0), dtype=np.float32))
+
+    data = read_gallery(path, mmap=mmap)
+
+    assert data.ids == []
+    assert data.matrix.shape[0] == 0
+
+
+def test_int8_zero_row_survives_quantization(tmp_path):
+    path = str(tmp_path / "class.fgal")
+    matrix = np.vstack([_matrix(1), np.zeros((1, 16), dtype=np.float32)])
+    write_gallery(path, ["alice", "bob"], matrix, dtype="int8")
+
+    np.testing.assert_allclose(read_gallery(path).matrix, matrix, atol=1e-2)
+
+
+def test_rejects_foreign_and_newer_files():
+    with pytest.raises(GalleryFormatError):
+        loads_gallery(b"not a gallery at all")
+    body = bytearray(gallery_format.dumps_gallery(["alice"], _matrix(1)))
+    body[4:6] = (gallery_format.FORMAT_VERSION + 1).to_bytes(2, "little")
+    with pytest.raises(GalleryFormatError):
+        loads_gallery(bytes(body))
+
+
+def test_loads_any_reads_legacy_pickles():
+    known = {"alice": _matrix(1)[0], "bob": _matrix(1, seed=1)[0]}
+
+    data = loads_any(pickle.dumps(known))
+
+    assert data.ids == ["alice", "bob"]
+    np.testing.assert_allclose(data.matrix, np.stack([known["alice"], known["bob"]]))
+
+
+def test_failed_write_keeps_the_previous_gallery(tmp_path, monkeypatch):
+    path = str(tmp_path / "class.fgal")
+    save_known_embeddings(path, {"alice": _matrix(1)[0]})
+
+    def fail(src, dst):
+        raise OSError("No space left on device")
+    monkeypatch.setattr(gallery_format.os, "replace", fail)
+    with pytest.raises(OSError):
+        save_known_embeddings(path, {"bob": _matrix(1, seed=1)[0]})
+
+    assert read_gallery(path).ids == ["alice"]
+    assert os.listdir(tmp_path) == ["class.fgal"]
@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+
+import prototypes
+from ann_index import IVFIndex
+from recognize import EmbeddingGallery
+
+
+def _unit(*values):
+    row = np.asarray(values, dtype=np.float32)
+    return row / np.linalg.norm(row)
+
+
+def _cluster(center, n, spread, seed):
+    rng = np.random.default_rng(seed)
+    rows = np.asarray(center, dtype=np.float32) + spread * rng.standard_normal((n, len(center))).astype(np.float32)
+    return {f"img{i}.jpg": row for i, row in enumerate(rows)}
+
+
+def test_from_dict_2d_value_gives_one_row_per_prototype():
+    gallery = EmbeddingGallery.from_dict({
+        "alice": np.stack([_unit(1, 0, 0, 0), _unit(0, 1, 0, 0)]),
+        "bob": _unit(0, 0, 1, 0),
+    })
+
+    assert len(gallery) == 3
+    assert list(gallery.ids) == ["alice", "alice", "bob"]
+    assert list(gallery.people) == ["alice", "bob"]
+    assert list(gallery._starts) == [0, 2]
+    assert gallery._max_rows == 2
+
+
+def test_single_row_people_are_not_grouped():
+    gallery = EmbeddingGallery.from_dict({"alice": _unit(1, 0, 0, 0), "bob": _unit(0, 1, 0, 0)})
+
+    assert gallery._starts is None
+    assert gallery._max_rows == 1
+    assert list(gallery.people) == ["alice", "bob"]
+
+
+def test_interleaved_rows_are_regrouped_with_their_vectors():
+    rows = np.stack([_unit(1, 0, 0, 0), _unit(0, 1, 0, 0), _unit(0, 0, 1, 0)])
+    gallery = EmbeddingGallery(["alice", "bob", "alice"], rows)
+
+    assert list(gallery.ids) == ["alice", "alice", "bob"]
+    assert list(gallery.people) == ["alice", "bob"]
+    np.testing.assert_allclose(gallery.matrix, rows[[0, 2, 1]])
+
+
+def test_person_scores_take_the_best_prototype():
+    gallery = EmbeddingGallery.from_dict({
+        "alice": np.stack([_unit(1, 0, 0, 0), _unit(0, 1, 0, 0)]),
+        "bob": _unit(0, 0, 1, 0),
+    })
+
+    scores = gallery.person_scores(np.stack([_unit(0, 1, 0, 0), _unit(0, 0, 1, 0)]))
+
+    np.testing.assert_allclose(scores, [[1, 0], [0, 1]], atol=1e-6)
+
+
+def test_ann_search_returns_each_person_once():
+    rng = np.random.default_rng(0)
+    known = {f"p{i}": rng.standard_normal((3, 8)).astype(np.float32) for i in range(10)}
+    gallery = EmbeddingGallery.from_dict(known)
+    queries = known["p3"] + 0.05 * rng.standard_normal((3, 8)).astype(np.float32)
+    exact_ids, exact_scores = gallery.match(queries, top_k=4)
+
+    # Two lists probed with the default nprobe is an exhaustive search
+    assert gallery.attach_index(IVFIndex.build(gallery.ids, gallery.matrix, nlist=2))
+    ids, scores = gallery.match(queries, top_k=4)
+
+    for row in ids:
+        assert len(set(row)) == len(row)
+    assert (ids[:, 0] == "p3").all()
+    assert (ids == exact_ids).all()
+    np.testing.assert_allclose(scores, exact_scores, atol=1e-6)
+
+
+def test_person_prototypes_are_capped_by_images():
+    embeddings = np.stack([_unit(1, 0, 0, 0), _unit(1, 0.1, 0, 0), _unit(0, 1, 0, 0)])
+
+    # Three images with two required per prototype leaves room for a single one
+    prototypes_ = prototypes.person_prototypes(embeddings, k=3)
+
+    assert prototypes_.shape == (1, 4)
+    np.testing.assert_allclose(np.linalg.norm(prototypes_, axis=1), 1, atol=1e-6)
+
+
+def _calibrate(per_image):
+    ids, matrix = prototypes.build_prototypes(per_image, k=1)
+    return prototypes.calibrate_threshold(per_image, ids, matrix)
+
+
+def test_calibrated_threshold_never_drops_below_the_minimum(monkeypatch):
+    monkeypatch.setattr(prototypes, "GALLERY_THRESHOLD_MIN", 0.4)
+    # Orthogonal people: impostor scores sit near 0, far below the floor
+    per_image = {
+        "alice": _cluster([1, 0, 0, 0], 12, 0.01, seed=1),
+        "bob": _cluster([0, 1, 0, 0], 12, 0.01, seed=2),
+    }
+
+    threshold, stats = _calibrate(per_image)
+
+    assert threshold == 0.4
+    assert stats["impostors"] == 24
+    assert stats["far"] == 0
+    assert stats["frr"] == 0
+
+
+def test_calibrated_threshold_is_capped_at_the_maximum(monkeypatch):
+    monkeypatch.setattr(prototypes, "GALLERY_THRESHOLD_MAX", 0.7)
+    # Near-identical people: impostors score close to 1
+    per_image = {
+        "alice": _cluster([1, 0, 0, 0], 12, 0.01, seed=1),
+        "bob": _cluster([1, 0.02, 0, 0], 12, 0.01, seed=2),
+    }
+
+    threshold, _ = _calibrate(per_image)
+
+    assert threshold == 0.7
+
+
+def test_too_few_impostors_keep_the_default_threshold(monkeypatch):
+    monkeypatch.setattr(prototypes, "GALLERY_CALIBRATION_MIN_IMPOSTORS", 20)
+    per_image = {
+        "alice": _cluster([1, 0, 0, 0], 3, 0.01, seed=1),
+        "bob": _cluster([0, 1, 0, 0], 3, 0.01, seed=2),
+    }
+
+    threshold, stats = _calibrate(per_image)
+
+    assert threshold is None
+    assert stats["impostors"] == 6
+
+
+@pytest.mark.parametrize("per_image", [{}, {"alice": _cluster([1, 0, 0, 0], 5, 0.01, seed=1)}])
+def test_calibration_needs_two_people(per_image):
+    assert _calibrate(per_image)[0] is None
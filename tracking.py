@@ -0,0 +1,221 @@
+"""
+Face tracking for video and burst-frame attendance.
+
+Faces are detected on sampled frames and linked into tracks by box IoU, which
+costs no model calls. Each track keeps only its TRACK_EMBED_FRAMES sharpest,
+largest crops; those are embedded in one batch once the clip is done, and the
+track's identity is a vote of their gallery matches. FaceNet work therefore
+grows with the number of people in the clip, not with its length.
+"""
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+from embeddings import embed_aligned_faces
+from face_utils import locate_faces, crop_faces
+from metrics import timed
+from recognize import as_gallery
+from utils.image_utils import decode_image
+
+# Detect on every Nth video frame; tracks bridge the skipped ones
+VIDEO_FRAME_STRIDE = int(os.environ.get("VIDEO_FRAME_STRIDE", 3))
+# Frames processed per clip after striding
+VIDEO_MAX_FRAMES = int(os.environ.get("VIDEO_MAX_FRAMES", 200))
+TRACK_IOU_THRESHOLD = float(os.environ.get("TRACK_IOU_THRESHOLD", 0.3))
+# Processed frames a track may go undetected before it is closed
+TRACK_MAX_MISSED = int(os.environ.get("TRACK_MAX_MISSED", 5))
+# Best crops per track that are embedded and vote
+TRACK_EMBED_FRAMES = int(os.environ.get("TRACK_EMBED_FRAMES", 3))
+# Tracks seen on fewer processed frames are treated as false detections
+TRACK_MIN_HITS = int(os.environ.get("TRACK_MIN_HITS", 2))
+
+
+def box_iou(a, b):
+    """Pairwise IoU of (N, 4) and (M, 4) x1, y1, x2, y2 boxes as an (N, M) matrix."""
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(1, -1, 4)
+    inter_w = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    inter_h = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = inter_w * inter_h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return inter / np.maximum(area_a + area_b - inter, 1e-9)
+
+
+def face_quality(image, box):
+    """Sharpness (variance of the Laplacian) of the face region, scaled down for faces smaller than FaceNet's input."""
+    x1, y1, x2, y2 = (int(v) for v in box)
+    region = image[max(0, y1):max(0, y2), max(0, x1):max(0, x2)]
+    if region.size == 0:
+        return 0.0
+    gray = cv2.cvtColor(cv2.resize(region, (64, 64), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    sharpness = cv2.Laplacian(gray, cv2.CV_32F).var()
+    return float(sharpness * min(1.0, min(x2 - x1, y2 - y1) / 160.0))
+
+
+class Track:
+    def __init__(self, track_id, box, frame_index):
+        self.track_id = track_id
+        self.box = box
+        self.first_frame = frame_index
+        self.last_frame = frame_index
+        self.hits = 0
+        self.missed = 0
+        # (quality, frame_index, RGB crop, landmarks), best first
+        self.candidates = []
+
+    def offer(self, quality, frame_index, image, box, points, keep):
+        """Keeps this detection's crop if it is among the track's `keep` best."""
+        if len(self.candidates) >= keep and quality <= self.candidates[-1][0]:
+            return
+        faces, landmarks = crop_faces(image, box[np.newaxis], points[np.newaxis] if points is not None else None, rgb=True)
+        if not len(faces):
+            return
+        self.candidates.append((quality, frame_index, faces[0], landmarks[0]))
+        self.candidates.sort(key=lambda candidate: -candidate[0])
+        del self.candidates[keep:]
+
+
+class FaceTracker:
+    def __init__(self, iou_threshold=TRACK_IOU_THRESHOLD, max_missed=TRACK_MAX_MISSED, embed_frames=TRACK_EMBED_FRAMES):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.embed_frames = embed_frames
+        self.active = []
+        self.finished = []
+        self.frames = 0
+        self._next_id = 0
+
+    @timed("track")
+    def update(self, image, frame_index=None):
+        """Detects faces in one frame and extends, opens or closes tracks."""
+        frame_index = self.frames if frame_index is None else frame_index
+        self.frames += 1
+        boxes, points = locate_faces(image)
+        boxes = np.asarray(boxes).reshape(-1, 4)
+
+        matched_tracks, matched_boxes = set(), set()
+        if self.active and len(boxes):
+            iou = box_iou([track.box for track in self.active], boxes)
+            # Greedy assignment, best overlap first
+            for t, b in zip(*np.unravel_index(np.argsort(-iou, axis=None), iou.shape)):
+                if iou[t, b] < self.iou_threshold:
+                    break
+                if t in matched_tracks or b in matched_boxes:
+                    continue
+                matched_tracks.add(t)
+                matched_boxes.add(b)
+                self._extend(self.active[t], image, frame_index, boxes[b], points[b] if points is not None else None)
+
+        still_active = []
+        for t, track in enumerate(self.active):
+            if t not in matched_tracks:
+                track.missed += 1
+            (still_active if track.missed <= self.max_missed else self.finished).append(track)
+        self.active = still_active
+
+        for b in range(len(boxes)):
+            if b not in matched_boxes:
+                track = Track(self._next_id, boxes[b], frame_index)
+                self._next_id += 1
+                self.active.append(track)
+                self._extend(track, image, frame_index, boxes[b], points[b] if points is not None else None)
+
+    def _extend(self, track, image, frame_index, box, points):
+        track.box = box
+        track.last_frame = frame_index
+        track.hits += 1
+        track.missed = 0
+        track.offer(face_quality(image, box), frame_index, image, box, points, self.embed_frames)
+
+    def tracks(self, min_hits=TRACK_MIN_HITS):
+        # Short clips cannot satisfy a minimum meant for long ones
+        min_hits = min(min_hits, max(1, self.frames // 2))
+        return [track for track in self.finished + self.active if track.hits >= min_hits and track.candidates]
+
+
+def vote_tracks(tracks, known_embeddings, threshold=None):
+    """
+    Embeds every track's best crops in one batch and matches them against the
+    gallery. A track takes the identity with the most votes above `threshold`
+    (ties go to the higher mean score) when it wins at least half its crops.
+    threshold=None uses the gallery's calibrated threshold.
+    :return: One dict per track with trackId, name ("unknown" if undecided), votes, score and frames.
+    """
+    faces = [candidate[2] for track in tracks for candidate in track.candidates]
+    landmarks = [candidate[3] for track in tracks for candidate in track.candidates]
+    if not faces:
+        return []
+    embeddings = embed_aligned_faces(np.stack(faces), landmarks, is_rgb=True)
+    gallery = as_gallery(known_embeddings)
+    threshold = gallery.resolve_threshold(threshold)
+    ids, scores = gallery.match(embeddings, top_k=1)
+    if ids.shape[1] == 0:  # empty gallery
+        ids, scores = np.full((len(faces), 1), None, dtype=object), np.zeros((len(faces), 1))
+
+    results, row = [], 0
+    for track in tracks:
+        n = len(track.candidates)
+        tally = {}
+        for person_id, score in zip(ids[row:row + n, 0], scores[row:row + n, 0]):
+            if person_id is not None and score > threshold:
+                tally.setdefault(person_id, []).append(float(score))
+        row += n
+
+        name, votes, score = "unknown", 0, None
+        if tally:
+            best = max(tally, key=lambda person_id: (len(tally[person_id]), np.mean(tally[person_id])))
+            if 2 * len(tally[best]) >= n:
+                name, votes, score = best, len(tally[best]), round(float(np.mean(tally[best])), 4)
+        results.append({
+            "trackId": track.track_id,
+            "name": name,
+            "votes": votes,
+            "score": score,
+            "frames": [track.first_frame, track.last_frame],
+            "hits": track.hits,
+        })
+    return results
+
+
+def iter_video_frames(data, suffix=".mp4", stride=None, max_frames=None):
+    """Yields (frame_index, BGR frame) for every `stride`-th frame of an encoded video, up to max_frames."""
+    stride = max(1, stride or VIDEO_FRAME_STRIDE)
+    max_frames = max_frames or VIDEO_MAX_FRAMES
+    # OpenCV reads containers from files only
+    with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+        f.write(data)
+        f.flush()
+        capture = cv2.VideoCapture(f.name)
+        try:
+            if not capture.isOpened():
+                raise ValueError("Could not open the uploaded video")
+            index = produced = 0
+            while produced < max_frames:
+                if index % stride:
+                    # grab() skips a frame without decoding it into an image
+                    if not capture.grab():
+                        break
+                else:
+                    ok, frame = capture.read()
+                    if not ok:
+                        break
+                    yield index, frame
+                    produced += 1
+                index += 1
+        finally:
+            capture.release()
+
+
+def iter_burst_frames(encoded_frames, max_frames=None):
+    """Yields (frame_index, BGR frame) for encoded still images, decoding one at a time."""
+    max_frames = max_frames or VIDEO_MAX_FRAMES
+    for index, data in enumerate(encoded_frames):
+        if index >= max_frames:
+            break
+        frame = decode_image(data)
+        if frame is None:
+            raise ValueError(f"Could not decode frame {index}")
+        yield index, frame
@@ -0,0 +1,186 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Training jobs allowed to run at once per process; further jobs queue
+TRAINING_MAX_CONCURRENT_JOBS = int(os.environ.get("TRAINING_MAX_CONCURRENT_JOBS", 2))
+# Local SQLite file holding job status, shared by all workers on the host
+TRAINING_JOBS_DB = os.environ.get("TRAINING_JOBS_DB", "/tmp/training_jobs.sqlite3")
+# Minimum seconds between progress writes for one job
+PROGRESS_FLUSH_SECONDS = 0.5
+# Seconds between heartbeats for the jobs a process owns
+TRAINING_JOB_HEARTBEAT_SECONDS = float(os.environ.get("TRAINING_JOB_HEARTBEAT_SECONDS", 15))
+# Queued or running jobs without a heartbeat for this long are marked failed (their worker died)
+TRAINING_JOB_STALE_SECONDS = float(os.environ.get("TRAINING_JOB_STALE_SECONDS", 120))
+
+_COLUMNS = ("id", "kind", "status", "total", "processed", "faces_found", "failures",
+            "created_at", "started_at", "finished_at", "error", "result")
+_STALE_JOB_ERROR = "Training worker exited before the job finished"
+
+
+class TrainingJobStore:
+    """Job status rows in a local SQLite database; no external services needed."""
+
+    def __init__(self, path=TRAINING_JOBS_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        # Jobs queued or running in this process, kept alive by the heartbeat thread
+        self._owned = set()
+        self._heartbeat_thread = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS training_jobs ("
+                " id TEXT PRIMARY KEY, kind TEXT, status TEXT, total INTEGER,"
+                " processed INTEGER DEFAULT 0, faces_found INTEGER DEFAULT 0, failures INTEGER DEFAULT 0,"
+                " created_at REAL, started_at REAL, finished_at REAL, error TEXT, result TEXT,"
+                " heartbeat_at REAL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(training_jobs)")}
+            if "heartbeat_at" not in columns:
+                conn.execute("ALTER TABLE training_jobs ADD COLUMN heartbeat_at REAL")
+            self._fail_stale(conn)
+
+    @contextmanager
+    def _connect(self):
+        # sqlite3's own context manager only commits; closing() releases the file handle too
+        with closing(sqlite3.connect(self.path, timeout=10)) as conn, conn:
+            yield conn
+
+    def _fail_stale(self, conn, job_id=None):
+        # Jobs whose owning process died (restart, OOM kill, deploy) would otherwise stay queued forever
+        now = time.time()
+        query = ("UPDATE training_jobs SET status = 'failed', finished_at = ?, error = ?"
+                 " WHERE status IN ('queued', 'running') AND COALESCE(heartbeat_at, created_at) < ?")
+        params = (now, _STALE_JOB_ERROR, now - TRAINING_JOB_STALE_SECONDS)
+        if job_id is not None:
+            query += " AND id = ?"
+            params += (job_id,)
+        conn.execute(query, params)
+
+    def _heartbeat_forever(self):
+        while True:
+            time.sleep(TRAINING_JOB_HEARTBEAT_SECONDS)
+            with self._lock:
+                owned = list(self._owned)
+            if not owned:
+                continue
+            try:
+                with self._lock, self._connect() as conn:
+                    conn.execute(
+                        f"UPDATE training_jobs SET heartbeat_at = ? WHERE id IN ({', '.join('?' * len(owned))})",
+                        (time.time(), *owned),
+                    )
+            except sqlite3.Error as e:
+                print(f"⚠️ Training job heartbeat failed: {e}")
+
+    def create(self, kind, total):
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO training_jobs (id, kind, status, total, created_at, heartbeat_at)"
+                " VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, total, now, now),
+            )
+            self._owned.add(job_id)
+            if self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(
+                    target=self._heartbeat_forever, name="training-job-heartbeat", daemon=True
+                )
+                self._heartbeat_thread.start()
+        return job_id
+
+    def release(self, job_id):
+        """Stops heartbeating a job once this process has recorded its final status."""
+        with self._lock:
+            self._owned.discard(job_id)
+
+    def update(self, job_id, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._connect() as conn:
+            conn.execute(f"UPDATE training_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            self._fail_stale(conn, job_id)
+            row = conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM training_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(_COLUMNS, row))
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["eta_seconds"] = _eta(job)
+        return job
+
+
+def _eta(job):
+    if job["status"] != "running" or not job["processed"] or not job["total"]:
+        return None
+    elapsed = time.time() - job["started_at"]
+    remaining = max(job["total"] - job["processed"], 0)
+    return round(elapsed / job["processed"] * remaining, 1)
+
+
+class _JobProgress:
+    """Progress callback handed to the embedding functions; batches writes to the store."""
+
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+        self.counts = {"processed": 0, "faces_found": 0, "failures": 0}
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, processed=0, faces_found=0, failures=0):
+        with self._lock:
+            self.counts["processed"] += processed
+            self.counts["faces_found"] += faces_found
+            self.counts["failures"] += failures
+            if time.monotonic() - self._last_flush >= PROGRESS_FLUSH_SECONDS:
+                self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        self.store.update(self.job_id, **self.counts)
+
+
+job_store = TrainingJobStore()
+_executor = ThreadPoolExecutor(max_workers=TRAINING_MAX_CONCURRENT_JOBS, thread_name_prefix="training-job")
+
+
+def submit_training_job(kind, total, train):
+    """
+    Queues `train(progress)` on the background executor and returns the job ID.
+    `train` returns a JSON-serializable result stored on the job when it succeeds.
+    """
+    job_id = job_store.create(kind, total)
+
+    def run():
+        progress = _JobProgress(job_store, job_id)
+        job_store.update(job_id, status="running", started_at=time.time())
+        try:
+            result = train(progress)
+            progress.flush()
+            job_store.update(job_id, status="succeeded", finished_at=time.time(), result=result)
+        except Exception as e:
+            print(f"❌ Training job {job_id} failed: {e}")
+            progress.flush()
+            job_store.update(job_id, status="failed", finished_at=time.time(), error=str(e))
+        finally:
+            job_store.release(job_id)
+
+    _executor.submit(run)
+    return job_id
+
+
+def get_training_job(job_id):
+    return job_store.get(job_id)
@@ -0,0 +1,46 @@
+# image_pipeline.py
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.s3_utils import download_image_from_s3_url
+
+# Threads fetching and decoding upcoming images
+IMAGE_PREFETCH_WORKERS = int(os.environ.get('IMAGE_PREFETCH_WORKERS', 4))
+# Maximum number of images downloaded ahead of the one being processed
+IMAGE_PREFETCH_DEPTH = int(os.environ.get('IMAGE_PREFETCH_DEPTH', 8))
+
+_END = object()
+
+
+def prefetch_images(image_urls, fetch=download_image_from_s3_url,
+                    workers=IMAGE_PREFETCH_WORKERS, depth=IMAGE_PREFETCH_DEPTH):
+    """
+    Streams images in input order while the next ones download and decode in the background.
+    :param image_urls: Iterable of image URLs.
+    :param fetch: Callable turning a URL into a decoded image.
+    :param workers: Number of download threads.
+    :param depth: Maximum number of images fetched ahead (bounds memory).
+    :return: Generator of (image_url, future); future.result() returns the image or
+             re-raises the exception `fetch` raised for that URL.
+    """
+    urls = iter(image_urls)
+    pending = deque()
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='image-prefetch')
+
+    def fill():
+        while len(pending) < max(1, depth):
+            url = next(urls, _END)
+            if url is _END:
+                return
+            pending.append((url, pool.submit(fetch, url)))
+
+    try:
+        fill()
+        while pending:
+            url, future = pending.popleft()
+            fill()
+            yield url, future
+    finally:
+        # Drop queued downloads if the consumer stops early
+        pool.shutdown(wait=False, cancel_futures=True)
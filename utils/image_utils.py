@@ -0,0 +1,137 @@
+# image_utils.py
+import os
+import cv2
+import numpy as np
+
+from metrics import timed
+
+# Detection runs on a JPEG decoded at 1/2, 1/4 or 1/8 scale as long as the long
+# edge stays at least this many pixels; crops still come from a full decode.
+# 0 detects on the full decode.
+IMAGE_DECODE_MAX_EDGE = int(os.environ.get('IMAGE_DECODE_MAX_EDGE', 0))
+
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+# Start-of-frame markers carry the image size; C4, C8 and CC are other segments
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(data) -> tuple:
+    """
+    Reads the (width, height) of a JPEG from its SOF header without decoding it.
+    :param data: Encoded image bytes.
+    :return: (width, height), or None if the bytes are not a readable JPEG.
+    """
+    data = memoryview(data).cast('B')
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker in _SOF_MARKERS:
+            height = (data[i + 5] << 8) | data[i + 6]
+            width = (data[i + 7] << 8) | data[i + 8]
+            return width, height
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:  # markers without a length
+            i += 2
+            continue
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return None
+
+
+@timed('decode')
+def decode_image(data, max_edge: int = 0) -> np.ndarray:
+    """
+    Decodes encoded image bytes to a BGR array, optionally using libjpeg's
+    reduced-size decoding when the image is larger than needed.
+    :param data: Encoded image bytes.
+    :param max_edge: Smallest acceptable long edge after reduction (0 = full size, as crops need).
+    :return: BGR image, or None if the bytes cannot be decoded.
+    """
+    buffer = np.frombuffer(data, np.uint8)
+    flag = cv2.IMREAD_COLOR
+    size = jpeg_size(data) if max_edge else None
+    if size is not None:
+        long_edge = max(size)
+        for factor, reduced_flag in _REDUCED_FLAGS:
+            if long_edge // factor >= max_edge:
+                flag = reduced_flag
+                break
+    return cv2.imdecode(buffer, flag)
+
+
+def decode_for_detection(data, max_edge: int = None) -> tuple:
+    """
+    Decodes an image at full resolution for cropping, plus a reduced-size copy
+    for face detection when the JPEG is large enough to allow one.
+    :param data: Encoded image bytes.
+    :param max_edge: Passed to decode_image for the preview; defaults to IMAGE_DECODE_MAX_EDGE (0 = no preview).
+    :return: (image, preview); image is None if the bytes cannot be decoded, preview is None
+             when no reduced decode applies.
+    """
+    max_edge = IMAGE_DECODE_MAX_EDGE if max_edge is None else max_edge
+    image = decode_image(data)
+    if image is None or not max_edge:
+        return image, None
+    preview = decode_image(data, max_edge)
+    if preview is None or preview.shape[:2] == image.shape[:2]:
+        return image, None
+    return image, preview
+
+
+def resize_to_max_edge(image: np.ndarray, max_edge: int) -> tuple:
+    """
+    Downscales an image so its long edge is at most max_edge.
+    :return: (image, scale) where scale = new size / original size (1.0 if unchanged).
+    """
+    height, width = image.shape[:2]
+    long_edge = max(height, width)
+    if not max_edge or long_edge <= max_edge:
+        return image, 1.0
+    scale = max_edge / long_edge
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+
+
+def tile_windows(width: int, height: int, tile: int, overlap: float) -> list:
+    """(x1, y1, x2, y2) windows of at most tile x tile covering the image, overlapping by `overlap`."""
+    stride = max(1, int(tile * (1.0 - overlap)))
+
+    def starts(length):
+        if length <= tile:
+            return [0]
+        positions = list(range(0, length - tile, stride))
+        return positions + [length - tile]
+
+    return [(x, y, min(x + tile, width), min(y + tile, height)) for y in starts(height) for x in starts(width)]
+
+
+def merge_boxes(boxes: np.ndarray, iou_threshold: float = 0.5, containment_threshold: float = 0.7) -> np.ndarray:
+    """
+    Greedy NMS for detections without scores, largest box first. A box is also
+    dropped when most of it lies inside a kept box, which removes the partial
+    faces cut at tile borders.
+    :return: Indices of the boxes to keep.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    areas = np.prod(np.maximum(boxes[:, 2:] - boxes[:, :2], 0), axis=1)
+    order = np.argsort(-areas, kind='stable')
+    keep = []
+    while len(order):
+        i, rest = order[0], order[1:]
+        keep.append(i)
+        top_left = np.maximum(boxes[i, :2], boxes[rest, :2])
+        bottom_right = np.minimum(boxes[i, 2:], boxes[rest, 2:])
+        inter = np.prod(np.maximum(bottom_right - top_left, 0), axis=1)
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-9)
+        contained = inter / np.maximum(areas[rest], 1e-9)
+        order = rest[(iou <= iou_threshold) & (contained <= containment_threshold)]
+    return np.array(keep, dtype=np.int64)
@@ -3,16 +3,57 @@ import os
 import cv2
 import numpy as np
 import boto3
+import fcntl
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from io import BytesIO
+import json
 import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils.image_utils import decode_image
+from metrics import timed
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 _s3_client = None
 
+# HTTP policy for image downloads (S3 public URLs and other image hosts)
+HTTP_TIMEOUT_SECONDS = float(os.environ.get('HTTP_TIMEOUT_SECONDS', 15))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+HTTP_BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', 0.5))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 16))
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+# S3 connection pool; should be at least S3_UPLOAD_WORKERS
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 32))
+S3_MAX_ATTEMPTS = int(os.environ.get('S3_MAX_ATTEMPTS', 5))
+# Threads uploading face crops concurrently
+S3_UPLOAD_WORKERS = int(os.environ.get('S3_UPLOAD_WORKERS', 16))
+# Return crop URLs before the uploads finish; pending uploads are spooled to disk and retried
+S3_UPLOAD_BACKGROUND = os.environ.get('S3_UPLOAD_BACKGROUND', '').lower() in ('1', 'true', 'yes')
+S3_UPLOAD_SPOOL_DIR = os.environ.get('S3_UPLOAD_SPOOL_DIR', '/tmp/s3_upload_spool')
+S3_UPLOAD_RETRY_LIMIT = int(os.environ.get('S3_UPLOAD_RETRY_LIMIT', 8))
+S3_UPLOAD_RETRY_BASE_SECONDS = float(os.environ.get('S3_UPLOAD_RETRY_BASE_SECONDS', 2))
+# How often each process sweeps the spool for uploads whose owning process died
+S3_UPLOAD_RECOVER_INTERVAL_SECONDS = float(os.environ.get('S3_UPLOAD_RECOVER_INTERVAL_SECONDS', 30))
+# Uploads that ran out of retries stay in the spool as .failed files for this long
+S3_UPLOAD_FAILED_RETENTION_SECONDS = float(os.environ.get('S3_UPLOAD_FAILED_RETENTION_SECONDS', 7 * 24 * 3600))
+
+_upload_pool = None
+_upload_pool_lock = threading.Lock()
+# Spooled uploads this process owns: meta path -> fd holding the entry's flock lease
+_leases = {}
+_leases_lock = threading.Lock()
+
 def _get_s3_client():
     """Initializes and returns a singleton S3 client."""
     global _s3_client
@@ -29,11 +70,79 @@ def _get_s3_client():
             's3',
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
-            region_name=aws_region
+            region_name=aws_region,
+            config=Config(
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': 'adaptive'},
+                tcp_keepalive=True,
+            )
         )
         logger.info(f"S3 client initialized for region: {aws_region}")
     return _s3_client
 
+def s3_object_url(bucket_name: str, s3_key: str) -> str:
+    """The public URL an object gets once uploaded; known before the upload finishes."""
+    return f"https://{bucket_name}.s3.{os.environ.get('AWS_REGION')}.amazonaws.com/{s3_key}"
+
+def _get_http_session() -> requests.Session:
+    """Returns a process-wide requests session with pooled keep-alive connections and retries."""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                retry = Retry(
+                    total=HTTP_MAX_RETRIES,
+                    backoff_factor=HTTP_BACKOFF_FACTOR,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=frozenset(['GET', 'HEAD']),
+                )
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _http_session = session
+    return _http_session
+
+@timed('http_download')
+def download_bytes_from_url(url: str) -> bytes:
+    """
+    Downloads a URL through the pooled HTTP session.
+    :param url: The URL to fetch.
+    :return: The response body.
+    :raises requests.exceptions.RequestException: On network errors, timeouts or 4xx/5xx responses.
+    """
+    response = _get_http_session().get(url, timeout=HTTP_TIMEOUT_SECONDS)
+    response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
+    return response.content
+
+@timed('http_download')
+def download_url_if_changed(url: str, etag: str = None) -> tuple:
+    """
+    Downloads a URL unless it still has the given ETag (conditional GET), in one round trip.
+    :param url: The URL to fetch.
+    :param etag: ETag of the copy the caller already has, or None for a plain GET.
+    :return: (body, etag); body is None when the server answered 304 Not Modified.
+    :raises requests.exceptions.RequestException: On network errors, timeouts or 4xx/5xx responses.
+    """
+    headers = {'If-None-Match': etag} if etag else None
+    response = _get_http_session().get(url, timeout=HTTP_TIMEOUT_SECONDS, headers=headers)
+    if etag and response.status_code == 304:
+        return None, etag
+    response.raise_for_status()
+    return response.content, response.headers.get('ETag')
+
+@timed('jpeg_encode')
+def encode_jpeg(image_array: np.ndarray) -> bytes:
+    """
+    Encodes a NumPy image array as JPEG, copying the encoder's buffer once.
+    :raises ValueError: If the array cannot be encoded.
+    """
+    is_success, buffer = cv2.imencode(".jpg", image_array)
+    if not is_success:
+        raise ValueError("Could not encode image array to JPEG format.")
+    return buffer.tobytes()
+
+@timed('s3_upload')
 def upload_image_array_to_s3(image_array: np.ndarray, bucket_name: str, s3_key: str) -> str:
     """
     Uploads a NumPy image array to an S3 bucket.
@@ -45,21 +154,14 @@ def upload_image_array_to_s3(image_array: np.ndarray, bucket_name: str, s3_key:
     """
     s3 = _get_s3_client()
     try:
-        # Encode the NumPy array to JPEG bytes in memory
-        is_success, buffer = cv2.imencode(".jpg", image_array)
-        if not is_success:
-            raise ValueError("Could not encode image array to JPEG format.")
-
-        byte_obj = BytesIO(buffer.tobytes())
-
         s3.put_object(
             Bucket=bucket_name,
             Key=s3_key,
-            Body=byte_obj.getvalue(),
+            Body=encode_jpeg(image_array),
             ContentType='image/jpeg',
             # ACL='public-read' # Only include if your bucket policy allows/requires ACLs
         )
-        s3_url = f"https://{bucket_name}.s3.{os.environ.get('AWS_REGION')}.amazonaws.com/{s3_key}"
+        s3_url = s3_object_url(bucket_name, s3_key)
         logger.info(f"Successfully uploaded image to S3: {s3_url}")
         return s3_url
     except ClientError as e:
@@ -69,6 +171,7 @@ def upload_image_array_to_s3(image_array: np.ndarray, bucket_name: str, s3_key:
         logger.error(f"An unexpected error occurred during image upload: {e}")
         raise
 
+@timed('s3_upload')
 def upload_file_to_s3(local_filepath: str, bucket_name: str, s3_key: str) -> str:
     """
     Uploads a local file to an S3 bucket.
@@ -81,7 +184,7 @@ def upload_file_to_s3(local_filepath: str, bucket_name: str, s3_key: str) -> str
     s3 = _get_s3_client()
     try:
         s3.upload_file(local_filepath, bucket_name, s3_key)
-        s3_url = f"https://{bucket_name}.s3.{os.environ.get('AWS_REGION')}.amazonaws.com/{s3_key}"
+        s3_url = s3_object_url(bucket_name, s3_key)
         logger.info(f"Successfully uploaded file to S3: {s3_url}")
         return s3_url
     except ClientError as e:
@@ -94,6 +197,49 @@ def upload_file_to_s3(local_filepath: str, bucket_name: str, s3_key: str) -> str
         logger.error(f"An unexpected error occurred during file upload: {e}")
         raise
 
+@timed('s3_upload')
+def upload_bytes_to_s3(data: bytes, bucket_name: str, s3_key: str, content_type: str = 'application/octet-stream') -> str:
+    """
+    Uploads an in-memory buffer to an S3 bucket.
+    :param data: Bytes to store.
+    :param bucket_name: Name of the S3 bucket.
+    :param s3_key: Desired key (path/filename) for the object in S3.
+    :param content_type: MIME type stored with the object.
+    :return: The public URL of the uploaded object.
+    :raises ClientError: If there's an issue with S3 upload.
+    """
+    s3 = _get_s3_client()
+    try:
+        s3.put_object(Bucket=bucket_name, Key=s3_key, Body=data, ContentType=content_type)
+        s3_url = s3_object_url(bucket_name, s3_key)
+        logger.info(f"Successfully uploaded {len(data)} bytes to S3: {s3_url}")
+        return s3_url
+    except ClientError as e:
+        logger.error(f"S3 upload error for key '{s3_key}': {e}")
+        raise
+
+def put_bytes_if_match(data: bytes, bucket_name: str, s3_key: str, etag: str,
+                       content_type: str = 'application/octet-stream') -> str:
+    """
+    Conditional write for read-modify-write updates shared by several processes.
+    :param data: Bytes to store.
+    :param bucket_name: Name of the S3 bucket.
+    :param s3_key: Key of the object in S3.
+    :param etag: ETag the object must still have, or None to write only if the object does not exist yet.
+    :return: The ETag of the stored object.
+    :raises ClientError: is_precondition_failed(e) is True if another writer changed the object first.
+    """
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    try:
+        response = _get_s3_client().put_object(Bucket=bucket_name, Key=s3_key, Body=data, ContentType=content_type,
+                                               **condition)
+        logger.info(f"Successfully uploaded {len(data)} bytes to S3: {s3_object_url(bucket_name, s3_key)}")
+        return response.get('ETag')
+    except ClientError as e:
+        if not is_precondition_failed(e):
+            logger.error(f"S3 upload error for key '{s3_key}': {e}")
+        raise
+
 def download_image_from_s3_url(image_url: str) -> np.ndarray:
     """
     Downloads an image from a given URL and returns it as a NumPy array.
@@ -103,10 +249,7 @@ def download_image_from_s3_url(image_url: str) -> np.ndarray:
     :raises ValueError: If the image cannot be decoded.
     """
     try:
-        response = requests.get(image_url)
-        response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-        img_array = np.frombuffer(response.content, np.uint8)
-        img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+        img = decode_image(download_bytes_from_url(image_url))
         if img is None:
             raise ValueError(f"Could not decode image from URL: {image_url}")
         logger.info(f"Successfully downloaded and decoded image from URL: {image_url}")
@@ -118,6 +261,7 @@ def download_image_from_s3_url(image_url: str) -> np.ndarray:
         logger.error(f"An unexpected error occurred during image download/decode: {e}")
         raise
 
+@timed('s3_download')
 def download_file_from_s3(bucket_name: str, s3_key: str, local_filepath: str):
     """
     Downloads a file from S3 to a local path.
@@ -136,3 +280,238 @@ def download_file_from_s3(bucket_name: str, s3_key: str, local_filepath: str):
     except Exception as e:
         logger.error(f"An unexpected error occurred during file download: {e}")
         raise
+
+def is_not_found_error(error: ClientError) -> bool:
+    """True if a ClientError means the S3 object does not exist."""
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+def is_precondition_failed(error: ClientError) -> bool:
+    """True if a conditional S3 write lost to a concurrent writer."""
+    return error.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict')
+
+@timed('s3_head')
+def head_s3_object(bucket_name: str, s3_key: str) -> dict:
+    """
+    Fetches the metadata of an S3 object without downloading its body.
+    :param bucket_name: Name of the S3 bucket.
+    :param s3_key: Key of the object in S3.
+    :return: Dict with the object's 'ETag', 'LastModified' and 'ContentLength'.
+    :raises ClientError: If the object does not exist or cannot be read.
+    """
+    s3 = _get_s3_client()
+    try:
+        response = s3.head_object(Bucket=bucket_name, Key=s3_key)
+        return {
+            'ETag': response.get('ETag'),
+            'LastModified': response.get('LastModified'),
+            'ContentLength': response.get('ContentLength'),
+        }
+    except ClientError as e:
+        # Callers probe for optional objects, so a missing key is not an error here
+        if not is_not_found_error(e):
+            logger.error(f"S3 head error for key '{s3_key}': {e}")
+        raise
+
+@timed('s3_download')
+def download_bytes_from_s3(bucket_name: str, s3_key: str) -> tuple:
+    """
+    Downloads an S3 object into memory.
+    :param bucket_name: Name of the S3 bucket.
+    :param s3_key: Key of the object in S3.
+    :return: Tuple of (body bytes, metadata dict with 'ETag' and 'LastModified').
+    :raises ClientError: If there's an issue with S3 download.
+    """
+    s3 = _get_s3_client()
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=s3_key)
+        body = response['Body'].read()
+        logger.info(f"Successfully downloaded '{s3_key}' from S3 ({len(body)} bytes)")
+        return body, {'ETag': response.get('ETag'), 'LastModified': response.get('LastModified')}
+    except ClientError as e:
+        logger.error(f"S3 download error for key '{s3_key}': {e}")
+        raise
+
+def _get_upload_pool() -> ThreadPoolExecutor:
+    """Returns the process-wide upload thread pool, resuming spooled uploads left by earlier processes."""
+    global _upload_pool
+    if _upload_pool is None:
+        with _upload_pool_lock:
+            if _upload_pool is None:
+                _upload_pool = ThreadPoolExecutor(max_workers=max(1, S3_UPLOAD_WORKERS), thread_name_prefix='s3-upload')
+                threading.Thread(target=_recover_spooled_uploads_forever, name='s3-upload-recovery', daemon=True).start()
+    return _upload_pool
+
+@timed('s3_upload')
+def _put_bytes(data: bytes, bucket_name: str, s3_key: str, content_type: str):
+    _get_s3_client().put_object(Bucket=bucket_name, Key=s3_key, Body=data, ContentType=content_type)
+
+def upload_image_arrays_to_s3(image_arrays, bucket_name: str, s3_keys, background: bool = None) -> list:
+    """
+    Uploads many NumPy image arrays as JPEGs concurrently.
+    :param image_arrays: Sequence of NumPy image arrays.
+    :param bucket_name: Name of the S3 bucket.
+    :param s3_keys: One key per image.
+    :param background: Return as soon as the uploads are spooled to disk instead of waiting for S3
+                       (defaults to S3_UPLOAD_BACKGROUND). Failed background uploads are retried.
+    :return: The public URLs of the images, in input order.
+    :raises ClientError: If a foreground upload fails.
+    """
+    background = S3_UPLOAD_BACKGROUND if background is None else background
+    pool = _get_upload_pool()
+    if background:
+        for image_array, s3_key in zip(image_arrays, s3_keys):
+            _enqueue_upload(encode_jpeg(image_array), bucket_name, s3_key, 'image/jpeg')
+        return [s3_object_url(bucket_name, s3_key) for s3_key in s3_keys]
+
+    futures = [
+        pool.submit(lambda image_array, s3_key: _put_bytes(encode_jpeg(image_array), bucket_name, s3_key, 'image/jpeg'),
+                    image_array, s3_key)
+        for image_array, s3_key in zip(image_arrays, s3_keys)
+    ]
+    urls = []
+    for future, s3_key in zip(futures, s3_keys):
+        try:
+            future.result()
+        except ClientError as e:
+            logger.error(f"S3 upload error for key '{s3_key}': {e}")
+            raise
+        urls.append(s3_object_url(bucket_name, s3_key))
+    logger.info(f"Successfully uploaded {len(urls)} images to S3 bucket '{bucket_name}'")
+    return urls
+
+def _lease_path(meta_path: str) -> str:
+    return f"{meta_path[:-len('.json')]}.lease"
+
+def _claim(meta_path: str) -> bool:
+    """
+    Takes the lease on a spooled upload. The lease is an flock on <id>.lease held
+    for as long as this process owns the upload, including retry back-off; the
+    kernel drops it if the process dies, which is what lets another process resume it.
+    """
+    fd = os.open(_lease_path(meta_path), os.O_CREAT | os.O_RDWR, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    with _leases_lock:
+        _leases[meta_path] = fd
+    return True
+
+def _release(meta_path: str):
+    with _leases_lock:
+        fd = _leases.pop(meta_path, None)
+    if fd is None:
+        return
+    try:
+        os.remove(_lease_path(meta_path))
+    except FileNotFoundError:
+        pass
+    os.close(fd)
+
+def _enqueue_upload(data: bytes, bucket_name: str, s3_key: str, content_type: str):
+    """Writes the upload to the spool directory, then uploads it on the pool."""
+    os.makedirs(S3_UPLOAD_SPOOL_DIR, exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    data_path = os.path.join(S3_UPLOAD_SPOOL_DIR, f"{upload_id}.data")
+    meta_path = os.path.join(S3_UPLOAD_SPOOL_DIR, f"{upload_id}.json")
+    # Leased before it is listed, so no recovery sweep can pick it up
+    _claim(meta_path)
+    with open(data_path, 'wb') as f:
+        f.write(data)
+    # The metadata file appears last, so a listed upload always has its data
+    with open(f"{meta_path}.tmp{os.getpid()}", 'w') as f:
+        json.dump({'bucket': bucket_name, 'key': s3_key, 'content_type': content_type, 'attempts': 0}, f)
+    os.replace(f"{meta_path}.tmp{os.getpid()}", meta_path)
+    _get_upload_pool().submit(_upload_spooled, meta_path, data)
+
+def _upload_spooled(meta_path: str, data: bytes = None):
+    """Uploads a spooled entry this process holds the lease on, and releases it unless a retry is scheduled."""
+    data_path = f"{meta_path[:-len('.json')]}.data"
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if data is None:
+            with open(data_path, 'rb') as f:
+                data = f.read()
+    except FileNotFoundError:
+        _release(meta_path)
+        return  # finished by another worker
+    try:
+        _put_bytes(data, meta['bucket'], meta['key'], meta['content_type'])
+    except Exception as e:
+        meta['attempts'] += 1
+        if meta['attempts'] >= S3_UPLOAD_RETRY_LIMIT:
+            logger.error(f"Giving up on background upload of '{meta['key']}' after {meta['attempts']} attempts: {e}")
+            # Kept (with its payload) for inspection until the sweep expires it
+            for path in (meta_path, data_path):
+                try:
+                    os.replace(path, f"{path}.failed")
+                    os.utime(f"{path}.failed")
+                except FileNotFoundError:
+                    pass
+            _release(meta_path)
+            return
+        delay = S3_UPLOAD_RETRY_BASE_SECONDS * 2 ** (meta['attempts'] - 1)
+        logger.warning(f"Background upload of '{meta['key']}' failed ({e}); retrying in {delay:.1f}s")
+        with open(f"{meta_path}.tmp{os.getpid()}", 'w') as f:
+            json.dump(meta, f)
+        os.replace(f"{meta_path}.tmp{os.getpid()}", meta_path)
+        # The lease stays held through the back-off
+        timer = threading.Timer(delay, lambda: _get_upload_pool().submit(_upload_spooled, meta_path, data))
+        timer.daemon = True
+        timer.start()
+        return
+    for path in (meta_path, data_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    _release(meta_path)
+    logger.info(f"Background upload finished: {s3_object_url(meta['bucket'], meta['key'])}")
+
+def _recover_spooled_uploads():
+    """
+    Resumes spooled uploads whose lease nobody holds, i.e. whose owning process exited,
+    and deletes failed uploads older than S3_UPLOAD_FAILED_RETENTION_SECONDS.
+    """
+    if not os.path.isdir(S3_UPLOAD_SPOOL_DIR):
+        return
+    for name in os.listdir(S3_UPLOAD_SPOOL_DIR):
+        path = os.path.join(S3_UPLOAD_SPOOL_DIR, name)
+        if name.endswith('.failed'):
+            try:
+                if time.time() - os.path.getmtime(path) > S3_UPLOAD_FAILED_RETENTION_SECONDS:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        if name.endswith('.lease'):
+            # Left behind by a process that died after finishing the upload, or while
+            # enqueueing it before its metadata was written (an upload being enqueued
+            # holds its lease, so it cannot be claimed here)
+            meta_path = f"{path[:-len('.lease')]}.json"
+            if not os.path.exists(meta_path) and meta_path not in _leases and _claim(meta_path):
+                try:
+                    os.remove(f"{path[:-len('.lease')]}.data")
+                except FileNotFoundError:
+                    pass
+                _release(meta_path)
+            continue
+        if not name.endswith('.json') or path in _leases:
+            continue
+        try:
+            claimed = _claim(path)
+        except OSError:
+            continue
+        if claimed:
+            logger.info(f"Resuming spooled upload {name}")
+            _get_upload_pool().submit(_upload_spooled, path)
+
+def _recover_spooled_uploads_forever():
+    while True:
+        try:
+            _recover_spooled_uploads()
+        except Exception as e:
+            logger.warning(f"Spooled upload recovery sweep failed: {e}")
+        time.sleep(S3_UPLOAD_RECOVER_INTERVAL_SECONDS)